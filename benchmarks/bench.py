@@ -0,0 +1,366 @@
+"""Reproducible benchmarks for both FileEncryptor implementations and their HTTP routes.
+
+Usage:
+    python benchmarks/bench.py run --output baseline.json
+    python benchmarks/bench.py run --output current.json
+    python benchmarks/bench.py compare baseline.json current.json --threshold 10
+
+Everything runs offline against temporary directories; nothing touches the
+apps' own uploads/ folders.
+"""
+import argparse
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import secrets
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS = ('key_based', 'password_based')
+PASSWORD = 'benchmark-password'
+KEY_HEX = '42' * 32
+
+QUICK_SIZES = [1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+FULL_SIZES = QUICK_SIZES + [256 * 1024 * 1024, 1024 * 1024 * 1024]
+
+
+def load_app(name: str, workdir: str):
+    """Import <name>/app.py under a unique module name, with uploads/ inside workdir"""
+    # The KDF runs inline: pool workers could not re-import a module loaded from a path
+    os.environ['KDF_POOL_WORKERS'] = '0'
+    # Skip KDF calibration; benchmarks construct their own FileEncryptor (PBKDF2 by default)
+    os.environ.setdefault('KDF_TARGET_MS', '0')
+    # Pin the cipher suite so HTTP results do not depend on the apps' startup benchmark
+    os.environ.setdefault('CIPHER_SUITE', 'aes-256-gcm')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    # The app imports its sibling modules (encryptor, metrics, catalog...) from its own directory.
+    # Both apps use the same module names, so drop every module the other app loaded first.
+    sys.path.insert(0, os.path.join(ROOT, name))
+    app_dirs = tuple(os.path.join(ROOT, app) + os.sep for app in APPS)
+    for module_name, loaded in list(sys.modules.items()):
+        if (getattr(loaded, '__file__', None) or '').startswith(app_dirs):
+            del sys.modules[module_name]
+    try:
+        spec = importlib.util.spec_from_file_location(f'{name}_app', os.path.join(ROOT, name, 'app.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # FileEncryptor and its helpers (cipher suites, key cache) live in encryptor.py
+        module.engine = sys.modules['encryptor']
+    finally:
+        sys.path.pop(0)
+        os.chdir(cwd)
+    module.app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.makedirs(module.app.config['UPLOAD_FOLDER'], exist_ok=True)
+    return module
+
+
+def write_random_file(path: str, size: int):
+    """Write size random bytes without holding them all in memory"""
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 4 * 1024 * 1024)
+            f.write(secrets.token_bytes(chunk))
+            remaining -= chunk
+
+
+def human(size: int) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size}{unit}'
+        size //= 1024
+    return f'{size}TB'
+
+
+def credential(name: str) -> str:
+    return KEY_HEX if name == 'key_based' else PASSWORD
+
+
+def timed(fn, repeat: int) -> float:
+    """Median wall time of fn over repeat runs"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_throughput(name: str, module, workdir: str, sizes: list, repeat: int) -> dict:
+    """Encrypt/decrypt MB/s per file size"""
+    results = {}
+    encryptor = module.FileEncryptor()
+    cred = credential(name)
+    for size in sizes:
+        plain = os.path.join(workdir, f'plain-{size}')
+        enc = plain + '.enc'
+        dec = plain + '.dec'
+        write_random_file(plain, size)
+        runs = repeat if size <= 64 * 1024 * 1024 else 1
+
+        encrypt_time = timed(lambda: encryptor.encrypt_file(plain, enc, cred), runs)
+        decrypt_time = timed(lambda: encryptor.decrypt_file(enc, dec, cred), runs)
+        results[f'{name}.encrypt.{human(size)}'] = {'value': size / encrypt_time / 1e6, 'unit': 'MB/s', 'better': 'higher'}
+        results[f'{name}.decrypt.{human(size)}'] = {'value': size / decrypt_time / 1e6, 'unit': 'MB/s', 'better': 'higher'}
+        for path in (plain, enc, dec):
+            os.remove(path)
+    return results
+
+
+def bench_kdf(module, repeat: int) -> dict:
+    """PBKDF2 latency (cache disabled) and cached derive_key latency"""
+    salt = secrets.token_bytes(16)
+    uncached = module.FileEncryptor()
+    cached = module.FileEncryptor(key_cache=module.engine.DerivedKeyCache())
+    cached.derive_key(PASSWORD, salt)
+    return {
+        'password_based.pbkdf2': {
+            'value': timed(lambda: uncached.derive_key(PASSWORD, salt), repeat) * 1000,
+            'unit': 'ms', 'better': 'lower'
+        },
+        'password_based.derive_key_cached': {
+            'value': timed(lambda: cached.derive_key(PASSWORD, salt), repeat) * 1000,
+            'unit': 'ms', 'better': 'lower'
+        }
+    }
+
+
+def bench_ciphers(module, repeat: int) -> dict:
+    """Raw seal throughput of each cipher suite (the apps' startup benchmark, on 16MB)"""
+    runs = [module.engine.benchmark_cipher_suites(16 * 1024 * 1024) for _ in range(repeat)]
+    return {
+        f'cipher.{suite}.seal': {'value': statistics.median(run[suite] for run in runs), 'unit': 'MB/s', 'better': 'higher'}
+        for suite in module.engine.CIPHER_SUITES
+    }
+
+
+def rss_child(name: str, op: str, plain: str, queue):
+    """Run one operation in a fresh process and report the process's peak RSS.
+    
+    This is an absolute peak (imports included): with streaming it stays near the
+    import footprint, and a change that buffers whole files shows up as growth.
+    """
+    workdir = os.path.dirname(plain)
+    module = load_app(name, workdir)
+    encryptor = module.FileEncryptor()
+    if op == 'encrypt':
+        encryptor.encrypt_file(plain, plain + '.enc2', credential(name))
+    else:
+        encryptor.decrypt_file(plain + '.enc', plain + '.dec', credential(name))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    queue.put(peak * scale / 1e6)
+
+
+def bench_rss(name: str, module, size: int) -> dict:
+    """Peak RSS (MB) per operation on a file of `size` bytes, each in a fresh process"""
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='bench-rss-')
+    try:
+        plain = os.path.join(workdir, 'plain')
+        write_random_file(plain, size)
+        module.FileEncryptor().encrypt_file(plain, plain + '.enc', credential(name))
+
+        ctx = multiprocessing.get_context('spawn')
+        for op in ('encrypt', 'decrypt'):
+            queue = ctx.Queue()
+            proc = ctx.Process(target=rss_child, args=(name, op, plain, queue))
+            proc.start()
+            value = queue.get()
+            proc.join()
+            results[f'{name}.{op}_peak_rss.{human(size)}'] = {'value': value, 'unit': 'MB', 'better': 'lower'}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def bench_http(name: str, module, size: int, concurrency_levels: list, requests_per_level: int) -> dict:
+    """End-to-end /encrypt, /decrypt and /download latency through Flask's test client.
+
+    The derived-key cache is off, so every password_based request pays for the KDF
+    (/decrypt would otherwise reuse the key of the one file it decrypts).
+    """
+    results = {}
+    cred_field = 'key' if name == 'key_based' else 'password'
+    payload = secrets.token_bytes(size)
+
+    # One stored file for /download and the bytes of an encrypted file for /decrypt
+    client = module.app.test_client()
+    response = client.post('/encrypt', data={cred_field: credential(name), 'file': (io.BytesIO(payload), 'seed.bin')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    encrypted = client.get('/download/seed.bin.enc').data
+
+    def encrypt(c, i):
+        return c.post('/encrypt', data={cred_field: credential(name), 'file': (io.BytesIO(payload), f'e{i}.bin')},
+                      content_type='multipart/form-data')
+
+    def decrypt(c, i):
+        return c.post('/decrypt', data={'use_metadata': 'false', cred_field: credential(name),
+                                        'output_name': f'd{i}.bin',
+                                        'encrypted_file': (io.BytesIO(encrypted), f'd{i}.bin.enc')},
+                      content_type='multipart/form-data')
+
+    def download(c, i):
+        return c.get('/download/seed.bin.enc')
+
+    key_cache = getattr(module.encryptor, 'key_cache', None)
+    module.encryptor.key_cache = None
+    try:
+        for route, call in (('encrypt', encrypt), ('decrypt', decrypt), ('download', download)):
+            for concurrency in concurrency_levels:
+                latencies = []
+                lock = threading.Lock()
+                counter = iter(range(requests_per_level))
+
+                def worker():
+                    c = module.app.test_client()
+                    while True:
+                        with lock:
+                            i = next(counter, None)
+                        if i is None:
+                            return
+                        start = time.perf_counter()
+                        r = call(c, i)
+                        r.get_data()
+                        elapsed = time.perf_counter() - start
+                        assert r.status_code == 200, r.get_data(as_text=True)
+                        with lock:
+                            latencies.append(elapsed)
+
+                start = time.perf_counter()
+                threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                wall = time.perf_counter() - start
+
+                latencies.sort()
+                prefix = f'{name}.http.{route}.{human(size)}.c{concurrency}'
+                results[f'{prefix}.p50'] = {'value': latencies[len(latencies) // 2] * 1000, 'unit': 'ms', 'better': 'lower'}
+                results[f'{prefix}.p99'] = {'value': latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000,
+                                            'unit': 'ms', 'better': 'lower'}
+                results[f'{prefix}.rps'] = {'value': len(latencies) / wall, 'unit': 'req/s', 'better': 'higher'}
+    finally:
+        module.encryptor.key_cache = key_cache
+    return results
+
+
+def environment() -> dict:
+    from importlib.metadata import version
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'cryptography': version('cryptography'),
+        'flask': version('flask'),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+
+
+def run(args):
+    sizes = FULL_SIZES if args.full else QUICK_SIZES
+    if args.sizes:
+        sizes = [int(s) for s in args.sizes.split(',')]
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        for name in APPS:
+            print(f'== {name}', flush=True)
+            module = load_app(name, workdir)
+            results.update(bench_throughput(name, module, workdir, sizes, args.repeat))
+            if name == 'key_based':
+                results.update(bench_ciphers(module, args.repeat))
+            if name == 'password_based':
+                results.update(bench_kdf(module, args.repeat))
+            if not args.skip_rss:
+                results.update(bench_rss(name, module, args.rss_size))
+            if not args.skip_http:
+                results.update(bench_http(name, module, args.http_size, args.concurrency, args.requests))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for key, result in sorted(results.items()):
+        print(f"{key:55s} {result['value']:12.2f} {result['unit']}")
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+    print(f'Wrote {args.output}')
+
+
+def compare(args) -> int:
+    """Print per-metric changes; exit non-zero if any metric regressed beyond the threshold"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    regressions = 0
+    for key in sorted(baseline['results']):
+        if key not in current['results']:
+            continue
+        old = baseline['results'][key]
+        new = current['results'][key]
+        if old['value'] == 0:
+            continue
+        change = (new['value'] - old['value']) / old['value'] * 100
+        worse = -change if old['better'] == 'higher' else change
+        flag = ''
+        if worse > args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{key:55s} {old['value']:12.2f} -> {new['value']:12.2f} {new['unit']:6s} {change:+7.1f}%{flag}")
+
+    if baseline['environment'] != current['environment']:
+        changed = [k for k in baseline['environment'] if k != 'timestamp'
+                   and baseline['environment'].get(k) != current['environment'].get(k)]
+        if changed:
+            print(f"Note: environment differs ({', '.join(changed)})")
+    print(f'{regressions} regression(s) over {args.threshold}%')
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='Run the benchmarks and write a JSON baseline')
+    run_parser.add_argument('--output', default='bench_results.json')
+    run_parser.add_argument('--full', action='store_true', help='Include 256MB and 1GB files')
+    run_parser.add_argument('--sizes', help='Comma-separated file sizes in bytes (overrides --full)')
+    run_parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement (median is kept)')
+    run_parser.add_argument('--rss-size', type=int, default=64 * 1024 * 1024, help='File size for peak RSS runs')
+    run_parser.add_argument('--http-size', type=int, default=64 * 1024, help='Upload size for HTTP runs')
+    run_parser.add_argument('--concurrency', type=lambda s: [int(c) for c in s.split(',')], default=[1, 4, 16])
+    run_parser.add_argument('--requests', type=int, default=64, help='Requests per route and concurrency level')
+    run_parser.add_argument('--skip-rss', action='store_true')
+    run_parser.add_argument('--skip-http', action='store_true')
+
+    compare_parser = sub.add_parser('compare', help='Compare two result files and flag regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help='Allowed slowdown in percent')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
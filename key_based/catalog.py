@@ -0,0 +1,238 @@
+"""SQLite catalog of the artifacts stored in UPLOAD_FOLDER.
+
+Replaces the per-file .meta sidecars and os.path.exists probing: lookups, listings
+and eviction are indexed queries, so they stay cheap however many files are stored.
+An artifact's row and its file are published together under the database write lock.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS artifacts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        format_version INTEGER,
+        nonce TEXT,
+        salt TEXT,
+        created REAL NOT NULL,
+        owner TEXT,
+        metadata TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS artifacts_created ON artifacts (created)',
+    'CREATE INDEX IF NOT EXISTS artifacts_owner ON artifacts (owner, id)',
+)
+
+COLUMNS = ('id', 'name', 'kind', 'size', 'format_version', 'nonce', 'salt', 'created', 'owner', 'metadata')
+SIDECAR_SUFFIX = '.meta'
+DATABASE_SUFFIXES = ('', '-wal', '-shm', '-journal')  # SQLite's files for the database
+
+
+class ArtifactNameError(ValueError):
+    """An artifact name that is not a plain file name directly inside the folder"""
+
+
+class Catalog:
+    def __init__(self, database: str, folder: str, max_age: float = 0, max_bytes: int = 0,
+                 evict_interval: float = 60):
+        self.database = os.path.abspath(database)
+        self.folder = os.path.abspath(folder)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.last_evicted = 0.0
+        self.local = threading.local()
+        # Every server process opens the catalog; the write lock makes exactly one of them create it
+        conn = self.connect()
+        sidecars = []
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            fresh = conn.execute("SELECT name FROM sqlite_master WHERE name = 'artifacts'").fetchone() is None
+            for statement in SCHEMA:
+                conn.execute(statement)
+            if fresh:
+                sidecars = self.backfill(conn)
+        # The catalog now holds the sidecar contents
+        for sidecar in sidecars:
+            os.remove(sidecar)
+
+    def connect(self) -> sqlite3.Connection:
+        """Per-thread connection (sqlite3 connections cannot be shared across threads)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.database, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def valid_name(self, name: str) -> bool:
+        """A plain file name: no path separators, not '.', '..' or hidden (like partial outputs), not the database"""
+        return bool(name) and not name.startswith('.') and not any(c in name for c in ('/', '\\', '\0')) \
+            and self.path(name) not in [self.database + suffix for suffix in DATABASE_SUFFIXES]
+
+    def check_name(self, name: str) -> str:
+        """Return name if it can be published, else raise ArtifactNameError"""
+        if not self.valid_name(name):
+            raise ArtifactNameError(f"Invalid file name: {name!r}")
+        return name
+
+    @staticmethod
+    def record(row: sqlite3.Row) -> dict:
+        record = dict(row)
+        record['metadata'] = json.loads(record['metadata']) if record['metadata'] else None
+        return record
+
+    def publish(self, partial_path: str, name: str, kind: str, metadata: dict = None, owner: str = None) -> dict:
+        """Move a finished output into place and record it in one transaction.
+
+        The row is inserted first, which takes the write lock, and the file is renamed
+        before commit: a failed rename rolls the row back, and a failed commit removes
+        the file, so the catalog and the folder never disagree. On any failure the
+        partial file is removed too, so nothing is left behind in the folder.
+        """
+        metadata = metadata or {}
+        moved = False
+        try:
+            output_path = self.path(self.check_name(name))
+            values = (name, kind, os.path.getsize(partial_path), metadata.get('format_version'),
+                      metadata.get('nonce'), metadata.get('salt'), time.time(), owner,
+                      json.dumps(metadata) if metadata else None)
+            conn = self.connect()
+            with conn:
+                # Re-publishing a name replaces the old row (and file), and moves it to the newest id
+                conn.execute('DELETE FROM artifacts WHERE name = ?', (name,))
+                cursor = conn.execute('INSERT INTO artifacts (name, kind, size, format_version, nonce, salt, '
+                                      'created, owner, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+                os.replace(partial_path, output_path)
+                moved = True
+        except Exception:
+            if moved and os.path.exists(output_path):
+                os.remove(output_path)
+            elif not moved and os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        self.maybe_evict()
+        return dict(zip(COLUMNS, (cursor.lastrowid,) + values[:-1] + (metadata or None,)))
+
+    def update_metadata(self, name: str, metadata: dict, apply=None) -> bool:
+        """Replace an artifact's metadata; False if there is no such artifact.
+
+        `apply`, if given, runs under the write lock before commit (e.g. to rewrite the file
+        to match the new metadata); if it raises, the row is left unchanged.
+        """
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            updated = conn.execute('UPDATE artifacts SET metadata = ? WHERE name = ?',
+                                   (json.dumps(metadata) if metadata else None, name)).rowcount == 1
+            if updated and apply is not None:
+                apply()
+        return updated
+
+    def get(self, name: str) -> dict:
+        """Look up an artifact by name, or None"""
+        row = self.connect().execute('SELECT * FROM artifacts WHERE name = ?', (name,)).fetchone()
+        return self.record(row) if row is not None else None
+
+    def list(self, limit: int = 50, cursor: int = None, owner: str = None) -> tuple:
+        """Newest-first page of artifacts, returned with the cursor for the next page (or None).
+
+        Keyset pagination on the id, so deep pages cost the same as the first.
+        """
+        query, args = 'SELECT * FROM artifacts WHERE 1 = 1', []
+        if cursor is not None:
+            query += ' AND id < ?'
+            args.append(cursor)
+        if owner is not None:
+            query += ' AND owner = ?'
+            args.append(owner)
+        query += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit + 1)
+        rows = self.connect().execute(query, args).fetchall()
+        records = [self.record(row) for row in rows[:limit]]
+        return records, records[-1]['id'] if len(rows) > limit else None
+
+    def usage(self) -> tuple:
+        """(total bytes, artifact count)"""
+        return tuple(self.connect().execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM artifacts').fetchone())
+
+    def evict(self, max_age: float = 0, max_bytes: int = 0) -> list:
+        """Delete the oldest artifacts older than max_age seconds or beyond max_bytes in total.
+
+        Rows and files are removed under the write lock, so a concurrent publish of the
+        same name is never deleted by mistake. Returns the evicted names.
+        """
+        conn = self.connect()
+        evicted = []
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            doomed = []
+            if max_age:
+                doomed += conn.execute('SELECT id, name, size FROM artifacts WHERE created < ? ORDER BY created',
+                                       (time.time() - max_age,)).fetchall()
+            if max_bytes:
+                total = self.usage()[0] - sum(row['size'] for row in doomed)
+                seen = {row['id'] for row in doomed}
+                for row in conn.execute('SELECT id, name, size FROM artifacts ORDER BY id'):
+                    if total <= max_bytes:
+                        break
+                    if row['id'] not in seen:
+                        doomed.append(row)
+                        total -= row['size']
+            for row in doomed:
+                conn.execute('DELETE FROM artifacts WHERE id = ?', (row['id'],))
+                try:
+                    # A bad name can only come from an older release; its file is left alone
+                    if self.valid_name(row['name']):
+                        os.remove(self.path(row['name']))
+                except FileNotFoundError:
+                    pass
+                evicted.append(row['name'])
+        return evicted
+
+    def maybe_evict(self):
+        """Apply the configured limits, at most once per evict_interval seconds"""
+        if not (self.max_age or self.max_bytes) or time.time() - self.last_evicted < self.evict_interval:
+            return
+        self.last_evicted = time.time()
+        evicted = self.evict(self.max_age, self.max_bytes)
+        if evicted:
+            print(f"Catalog evicted {len(evicted)} artifact(s)")
+
+    def backfill(self, conn: sqlite3.Connection) -> list:
+        """Catalog files left in the folder by versions that used .meta sidecars (once, on a new database).
+
+        Returns the sidecar paths that were imported.
+        """
+        try:
+            names = sorted(os.listdir(self.folder), key=lambda n: os.path.getmtime(self.path(n)))
+        except FileNotFoundError:
+            return []
+        database = os.path.abspath(self.database)
+        sidecars = []
+        for name in names:
+            path = self.path(name)
+            if name.endswith(SIDECAR_SUFFIX) or name.startswith('.') or not os.path.isfile(path) \
+                    or os.path.abspath(path).startswith(database):
+                continue
+            metadata = None
+            sidecar = path + SIDECAR_SUFFIX
+            if os.path.exists(sidecar):
+                with open(sidecar) as f:
+                    metadata = json.load(f)
+                sidecars.append(sidecar)
+            kind = 'encrypted' if metadata or name.endswith('.enc') else 'decrypted'
+            metadata = metadata or {}
+            conn.execute('INSERT OR IGNORE INTO artifacts (name, kind, size, format_version, nonce, salt, '
+                         'created, owner, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?)',
+                         (name, kind, os.path.getsize(path), metadata.get('format_version'), metadata.get('nonce'),
+                          metadata.get('salt'), os.path.getmtime(path), json.dumps(metadata) if metadata else None))
+        return sidecars
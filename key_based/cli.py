@@ -0,0 +1,265 @@
+"""Encrypt or decrypt whole directory trees from the command line, without Flask.
+
+    python cli.py generate-key > master.key
+    python cli.py encrypt SOURCE DEST --key-file master.key [--workers 8] [--processes] [--compress]
+    python cli.py decrypt SOURCE DEST --key-file master.key
+
+Each file under SOURCE is written to the same relative path under DEST (with .enc added
+or removed), in the web app's container format, using the same FileEncryptor. Files are
+processed in parallel and every finished file is appended to a manifest in DEST, so a
+run that was interrupted skips what is already done when it is started again.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from cryptography.exceptions import InvalidTag
+
+from encryptor import (COMPRESSION, ENVELOPE_ENCRYPTION, LEGACY_CIPHER, PARALLEL_WORKERS, FileEncryptor,
+                       KeyFormatError, select_cipher_suite)
+
+MANIFEST_NAME = '.fileenc-manifest.jsonl'
+PARTIAL_SUFFIX = '.part'
+CREDENTIAL_FIELDS = ('key_hex', 'key_base64')  # kept out of the manifest
+TASKS_PER_WORKER = 4  # files queued per worker, so huge trees are not submitted all at once
+PROGRESS_INTERVAL = 10.0  # seconds between progress lines when stderr is not a terminal
+
+job = {}  # per process: the run's settings and its FileEncryptor, set by init_worker
+
+
+def init_worker(settings: dict):
+    job.update(settings)
+    # With several files in flight, each file is sealed on its worker alone
+    job['encryptor'] = FileEncryptor(cipher=settings['cipher'], envelope=settings['envelope'],
+                                     workers=1 if settings['workers'] > 1 else PARALLEL_WORKERS,
+                                     log=lambda message: None)
+
+
+def output_name(mode: str, name: str) -> str:
+    return name + '.enc' if mode == 'encrypt' else name[:-len('.enc')]
+
+
+def process_file(name: str) -> dict:
+    """Encrypt or decrypt one file of the tree; returns its manifest entry.
+
+    The output is written beside its final path and renamed into place when complete,
+    so an interrupted run never leaves a truncated file under the final name.
+    """
+    encryptor = job['encryptor']
+    output = output_name(job['mode'], name)
+    output_path = os.path.join(job['dest'], output)
+    partial = output_path + PARTIAL_SUFFIX
+    entry = {'path': name, 'output': output}
+    started = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if job['mode'] == 'encrypt':
+            metadata = encryptor.encrypt_file(os.path.join(job['source'], name), partial, job['key'],
+                                              job['compression'])
+            metadata['output_file'] = os.path.basename(output_path)
+            entry['metadata'] = {k: v for k, v in metadata.items() if k not in CREDENTIAL_FIELDS}
+        else:
+            with open(os.path.join(job['source'], name), 'rb') as src, open(partial, 'wb') as dst:
+                plaintext, _ = encryptor.open_plaintext(src, encryptor.parse_key(job['key']))
+                for block in plaintext:
+                    dst.write(block)
+        os.replace(partial, output_path)
+        entry['status'] = 'ok'
+    except Exception as e:
+        entry.update(status='failed',
+                     error='Authentication failed (wrong key or damaged file)' if isinstance(e, InvalidTag) else repr(e))
+        if os.path.exists(partial):
+            os.remove(partial)
+    entry['seconds'] = round(time.perf_counter() - started, 3)
+    return entry
+
+
+def load_manifest(path: str) -> dict:
+    """Latest manifest entry per source path (a line cut short by a crash is ignored)"""
+    entries = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[entry['path']] = entry
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def plan(mode: str, source: str, dest: str, manifest: dict) -> tuple:
+    """Walk source for the files still to process: ([(name, size, mtime_ns)], files already done)"""
+    tasks, done = [], 0
+    skip = {os.path.abspath(dest)}
+    for root, dirs, files in os.walk(source):
+        # DEST may be inside SOURCE
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) not in skip)
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            if filename == MANIFEST_NAME or filename.endswith(PARTIAL_SUFFIX) or not os.path.isfile(path) \
+                    or (mode == 'decrypt' and not filename.endswith('.enc')):
+                continue
+            name = os.path.relpath(path, source)
+            stat = os.stat(path)
+            entry = manifest.get(name)
+            if entry is not None and entry['status'] == 'ok' and entry['size'] == stat.st_size \
+                    and entry['mtime_ns'] == stat.st_mtime_ns \
+                    and os.path.exists(os.path.join(dest, entry['output'])):
+                done += 1
+                continue
+            tasks.append((name, stat.st_size, stat.st_mtime_ns))
+    return tasks, done
+
+
+def format_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+class Progress:
+    """Files and bytes done, throughput and ETA, written to stderr"""
+
+    def __init__(self, files: int, total_bytes: int, stream=sys.stderr):
+        self.files = files
+        self.total_bytes = total_bytes
+        self.stream = stream
+        self.interactive = stream.isatty()
+        self.started = time.perf_counter()
+        self.last_shown = self.started
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def update(self, size: int, ok: bool):
+        self.done += 1
+        self.failed += not ok
+        self.bytes += size
+        now = time.perf_counter()
+        if self.interactive or now - self.last_shown >= PROGRESS_INTERVAL or self.done == self.files:
+            self.last_shown = now
+            self.show(now)
+
+    def note(self, message: str):
+        """Print a message on its own line, clear of the progress line"""
+        self.stream.write(('\n' if self.interactive and self.done else '') + message + '\n')
+        self.stream.flush()
+
+    def show(self, now: float):
+        elapsed = max(now - self.started, 1e-6)
+        rate = self.bytes / elapsed
+        eta = (self.total_bytes - self.bytes) / rate if rate else 0
+        line = (f'{self.done}/{self.files} files  {format_bytes(self.bytes)}/{format_bytes(self.total_bytes)}  '
+                f'{format_bytes(rate)}/s  {self.failed} failed  ETA {eta:.0f}s')
+        if self.interactive:
+            self.stream.write('\r' + line + ('\n' if self.done == self.files else ''))
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+def run_pool(tasks: list, workers: int, processes: bool, settings: dict):
+    """Yield (task, manifest entry) as files finish, with at most TASKS_PER_WORKER * workers queued"""
+    if processes:
+        pool = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(settings,))
+    else:
+        init_worker(settings)
+        pool = ThreadPoolExecutor(workers)
+    with pool:
+        queue = iter(tasks)
+        running = {}
+        while True:
+            for task in queue:
+                running[pool.submit(process_file, task[0])] = task
+                if len(running) >= TASKS_PER_WORKER * workers:
+                    break
+            if not running:
+                return
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield running.pop(future), future.result()
+
+
+def read_key(args) -> str:
+    if args.key_file:
+        with open(args.key_file) as f:
+            return f.read().strip()
+    if os.environ.get('FILEENC_KEY'):
+        return os.environ['FILEENC_KEY'].strip()
+    raise SystemExit('A key is required: --key-file PATH or FILEENC_KEY (create one with: cli.py generate-key)')
+
+
+def run(args) -> int:
+    key = read_key(args)
+    try:
+        FileEncryptor().parse_key(key)  # fail on a malformed key before touching any file
+    except KeyFormatError as e:
+        raise SystemExit(str(e))
+    if not os.path.isdir(args.source):
+        raise SystemExit(f'Not a directory: {args.source}')
+    os.makedirs(args.dest, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.dest, MANIFEST_NAME)
+    tasks, done = plan(args.mode, args.source, args.dest, load_manifest(manifest_path))
+    print(f'{args.mode}: {len(tasks)} file(s) to process, {done} already done', file=sys.stderr)
+    if not tasks:
+        return 0
+    settings = {
+        'mode': args.mode,
+        'source': args.source,
+        'dest': args.dest,
+        'key': key,
+        'compression': COMPRESSION if args.compress else None,
+        'cipher': select_cipher_suite() if args.mode == 'encrypt' else LEGACY_CIPHER,
+        'envelope': ENVELOPE_ENCRYPTION,
+        'workers': args.workers
+    }
+    progress = Progress(len(tasks), sum(task[1] for task in tasks))
+    with open(manifest_path, 'a') as manifest:
+        for (name, size, mtime_ns), entry in run_pool(tasks, args.workers, args.processes, settings):
+            entry.update(size=size, mtime_ns=mtime_ns)
+            manifest.write(json.dumps(entry) + '\n')
+            # Durable before the file counts as done, so a crash can only redo work
+            manifest.flush()
+            os.fsync(manifest.fileno())
+            if entry['status'] != 'ok':
+                progress.note(f"Failed: {name}: {entry['error']}")
+            progress.update(size, entry['status'] == 'ok')
+    return 1 if progress.failed else 0
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Encrypt or decrypt directory trees in the file encryption '
+                                                 'container format.')
+    commands = parser.add_subparsers(dest='mode', required=True)
+    commands.add_parser('generate-key', help='Print a new random 256-bit key (hex)')
+    for mode in ('encrypt', 'decrypt'):
+        command = commands.add_parser(mode, help=f'{mode.capitalize()} every file under SOURCE into DEST')
+        command.add_argument('source', help='Directory to read')
+        command.add_argument('dest', help='Directory to write (created if missing)')
+        command.add_argument('--key-file', help='File holding the hex or base64 key (default: $FILEENC_KEY)')
+        command.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                             help='Files processed in parallel (default: CPU count)')
+        command.add_argument('--processes', action='store_true',
+                             help='Use a process pool instead of threads')
+        command.add_argument('--manifest', help=f'Manifest path (default: DEST/{MANIFEST_NAME})')
+        if mode == 'encrypt':
+            command.add_argument('--compress', action='store_true',
+                                 help=f'Compress before encrypting ({COMPRESSION}), skipped for incompressible files')
+        else:
+            command.set_defaults(compress=False)
+    args = parser.parse_args(argv)
+    if args.mode == 'generate-key':
+        print(FileEncryptor().generate_key()[1])
+        return 0
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
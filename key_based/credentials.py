@@ -0,0 +1,45 @@
+"""Credentials the server has to keep between requests, sealed before they reach the catalog database.
+
+A resumable upload needs its key for every chunk, and a background job needs its key or
+password when a worker gets to it. Both are stored in SQLite next to the outputs, so they
+are sealed with AES-256-GCM under a server secret that is never written there: whoever
+can read the upload folder cannot decrypt in-progress uploads or queued jobs with them.
+
+The secret is CREDENTIAL_SECRET (64 hex digits). gunicorn.conf.py generates one per server
+start for its workers, so upload sessions and queued jobs do not outlive a restart unless
+it is set explicitly; a process started any other way generates its own.
+"""
+import os
+import secrets
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+NONCE_SIZE = 12
+
+
+class CredentialBox:
+    def __init__(self, secret: bytes):
+        self.aead = AESGCM(secret)
+
+    def seal(self, value: bytes, context: str) -> bytes:
+        """Encrypt value, bound to context (e.g. the row it is stored in) so it cannot be moved to another"""
+        nonce = secrets.token_bytes(NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, value, context.encode('utf-8'))
+
+    def open(self, sealed: bytes, context: str) -> bytes:
+        """Decrypt a sealed value; raises InvalidTag if it was sealed under another secret or context"""
+        return self.aead.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], context.encode('utf-8'))
+
+
+def server_secret() -> bytes:
+    """CREDENTIAL_SECRET, or a fresh random secret for this process when it is not set"""
+    value = os.environ.get('CREDENTIAL_SECRET')
+    if not value:
+        return secrets.token_bytes(32)
+    try:
+        secret = bytes.fromhex(value)
+    except ValueError:
+        secret = b''
+    if len(secret) != 32:
+        raise ValueError("CREDENTIAL_SECRET must be 64 hex digits (32 bytes)")
+    return secret
@@ -0,0 +1,120 @@
+"""Content-addressed store of encrypted objects, so identical uploads under one key are stored once.
+
+Each object is a container in UPLOAD_FOLDER/.objects named by its content id, a keyed
+hash of the plaintext (FileEncryptor.content_hasher): ids match only for the same
+content under the same key. Cataloged names are hard links to their object, so
+downloads, streaming and eviction work on them unchanged, and the link count is the
+object's reference count: an object no name links to any more is deleted by collect().
+"""
+import os
+import time
+
+from catalog import Catalog
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS objects (
+        id TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+        created REAL NOT NULL
+    )''',
+)
+
+OBJECTS_FOLDER = '.objects'
+
+
+class DedupStore:
+    def __init__(self, catalog: Catalog, collect_interval: float = 60):
+        self.catalog = catalog
+        self.collect_interval = collect_interval
+        self.last_collected = 0.0
+        os.makedirs(self.catalog.path(OBJECTS_FOLDER), exist_ok=True)
+        conn = self.catalog.connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def path(self, content_id: str) -> str:
+        return self.catalog.path(os.path.join(OBJECTS_FOLDER, content_id + '.enc'))
+
+    def link(self, content_id: str, path: str) -> bool:
+        """Hard-link the object for content_id at path (a partial output, published as usual); False if there is none"""
+        self.maybe_collect()
+        with self.catalog.connect() as conn:
+            # Under the write lock, so collect() cannot delete the object in between
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('SELECT 1 FROM objects WHERE id = ?', (content_id,)).fetchone() is None:
+                return False
+            try:
+                os.link(self.path(content_id), path)
+            except FileNotFoundError:
+                conn.execute('DELETE FROM objects WHERE id = ?', (content_id,))
+                return False
+            conn.execute('UPDATE objects SET hits = hits + 1 WHERE id = ?', (content_id,))
+        return True
+
+    def store(self, content_id: str, path: str) -> bool:
+        """Make the finished container at path the object for content_id.
+
+        If another request stored the same content first, path is replaced by a link to
+        that object instead, and False is returned. Either way path stays in place, to be
+        published like any other output.
+        """
+        self.maybe_collect()
+        with self.catalog.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('SELECT 1 FROM objects WHERE id = ?', (content_id,)).fetchone() is not None:
+                try:
+                    os.link(self.path(content_id), path + '.link')
+                except FileNotFoundError:
+                    conn.execute('DELETE FROM objects WHERE id = ?', (content_id,))
+                else:
+                    os.replace(path + '.link', path)
+                    conn.execute('UPDATE objects SET hits = hits + 1 WHERE id = ?', (content_id,))
+                    return False
+            try:
+                os.link(path, self.path(content_id))
+            except FileExistsError:
+                # An object file without a row (e.g. the row was lost in a crash): replace it
+                os.remove(self.path(content_id))
+                os.link(path, self.path(content_id))
+            conn.execute('INSERT INTO objects (id, size, created) VALUES (?, ?, ?)',
+                         (content_id, os.path.getsize(path), time.time()))
+        return True
+
+    def refs(self, content_id: str) -> int:
+        """Names linked to an object"""
+        try:
+            return os.stat(self.path(content_id)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def usage(self) -> tuple:
+        """(stored object bytes, object count)"""
+        return tuple(self.catalog.connect().execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM objects').fetchone())
+
+    def collect(self) -> list:
+        """Delete the objects no name links to any more; returns their ids"""
+        collected = []
+        with self.catalog.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for row in conn.execute('SELECT id FROM objects').fetchall():
+                if self.refs(row['id']) > 0:
+                    continue
+                conn.execute('DELETE FROM objects WHERE id = ?', (row['id'],))
+                try:
+                    os.remove(self.path(row['id']))
+                except FileNotFoundError:
+                    pass
+                collected.append(row['id'])
+        return collected
+
+    def maybe_collect(self):
+        """Collect unreferenced objects, at most once per collect_interval seconds"""
+        if time.time() - self.last_collected < self.collect_interval:
+            return
+        self.last_collected = time.time()
+        collected = self.collect()
+        if collected:
+            print(f"Dedup store deleted {len(collected)} unreferenced object(s)")
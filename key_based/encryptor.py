@@ -0,0 +1,835 @@
+"""FileEncryptor and the segmented container format, independent of Flask.
+
+Shared by the web app (app.py) and the bulk command-line tool (cli.py). Importing this
+module has no side effects beyond reading its settings from the environment.
+"""
+import os
+import json
+import struct
+import zlib
+import time
+import itertools
+import hashlib
+import hmac
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.keywrap import InvalidUnwrap, aes_key_unwrap, aes_key_wrap
+import base64
+import secrets
+try:
+    import zstandard
+except ImportError:  # optional: zlib is always available
+    zstandard = None
+from metrics import Registry, StageTimer
+
+# Segmented container format:
+#   magic(4) | version(1) | header length(4) | JSON header | segment*
+# Each segment is AES-GCM(plaintext[segment_size]) + 16-byte tag, sealed with
+# nonce = prefix(7) || counter(4) || final flag(1) so reordering and truncation fail.
+FORMAT_MAGIC = b'FENC'
+# Version 3 added the cipher, wrapped_key and compression header fields, which change how
+# the body is read: a version 2 reader refuses the file instead of misreading it. Version 2
+# files are still read, and a header field this code does not know is refused, not ignored.
+FORMAT_VERSION = 3
+READABLE_VERSIONS = (2, 3)
+HEADER_FIELDS = frozenset({'cipher', 'segment_size', 'nonce', 'wrapped_key', 'compression'})
+SEGMENT_SIZE = 64 * 1024
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+MAX_HEADER_SIZE = 64 * 1024
+MAX_SEGMENTS = 2 ** 32 - 1
+STREAM_CHUNK_SIZE = 256 * 1024
+MAX_REPORTED_FAILURES = 100  # failed segments listed per file by verify
+
+# AEAD cipher suites for segments. All take a 256-bit key and a 96-bit nonce and add a
+# 16-byte tag, so the container layout is shared; the suite is named in the header.
+CIPHER_SUITES = {'aes-256-gcm': AESGCM, 'chacha20-poly1305': ChaCha20Poly1305}
+LEGACY_CIPHER = 'aes-256-gcm'  # containers without a "cipher" header field
+# 'auto' benchmarks the suites at startup and encrypts new files with the fastest on this host
+# (under gunicorn, once in the master: see host_calibration)
+CIPHER_SUITE = os.environ.get('CIPHER_SUITE', 'auto')
+CIPHER_BENCHMARK_BYTES = 4 * 1024 * 1024
+CIPHER_BENCHMARK_MARGIN = 1.2  # another suite must be this much faster to replace AES-GCM
+
+# Envelope encryption: each file is sealed with a random data key, stored in the header
+# wrapped (AES key wrap, RFC 3394) by the user's key, so rotating the user's key only
+# rewrites the header (/rewrap). ENVELOPE_ENCRYPTION=0 seals with the user's key directly.
+ENVELOPE_ENCRYPTION = os.environ.get('ENVELOPE_ENCRYPTION', '1') != '0'
+
+# Files at least PARALLEL_THRESHOLD bytes are sealed on a thread pool (the AEADs release the GIL)
+PARALLEL_WORKERS = int(os.environ.get('PARALLEL_WORKERS', os.cpu_count() or 1))
+PARALLEL_THRESHOLD = int(os.environ.get('PARALLEL_THRESHOLD', 8 * 1024 * 1024))
+PARALLEL_BATCH_SEGMENTS = 16  # segments per pool task, to amortize scheduling overhead
+
+# Optional compression before encryption, requested per upload with compress=true.
+# The first segment is probed with fast zlib and compression is skipped when it
+# does not shrink (media, archives, already encrypted data).
+COMPRESSION_ALGORITHMS = ('zstd', 'zlib') if zstandard else ('zlib',)
+COMPRESSION = os.environ.get('COMPRESSION', COMPRESSION_ALGORITHMS[0])
+COMPRESSION_LEVELS = {'zlib': 6, 'zstd': 3}
+COMPRESSION_PROBE_SIZE = 16 * 1024
+COMPRESSION_PROBE_RATIO = 0.9  # compress only if the probe shrinks below this fraction
+
+# Browser-side encryption (static/js/app.js) uses WebCrypto, which has AES-GCM but not
+# ChaCha20-Poly1305, and CompressionStream('deflate'), whose output is zlib
+CLIENT_CIPHER = 'aes-256-gcm'
+CLIENT_COMPRESSION = 'zlib'
+
+# Deduplication (DEDUP_STORE in app.py): content ids are HMACs of the plaintext under a
+# subkey of the user's key, so they only match for the same content under the same key
+DEDUP_CONTEXT = b'fileenc-dedup-v1'
+
+# Pipeline metrics (app.py adds its request metrics to the same registry, served at /metrics).
+# METRICS_DIR, set by gunicorn.conf.py, makes every scrape report totals over all workers.
+metrics = Registry(os.environ.get('METRICS_DIR') or None)
+STAGE_SECONDS = metrics.histogram('fileenc_stage_seconds', 'Time per request spent in each pipeline stage', ('stage',))
+BYTES_PROCESSED = metrics.counter('fileenc_bytes_processed_total', 'Plaintext bytes encrypted or decrypted', ('operation',))
+ERRORS = metrics.counter('fileenc_errors_total', 'Failures by type', ('type',))
+
+class KeyFormatError(ValueError):
+    """Raised by parse_key for keys that are not 256-bit hex or base64"""
+
+def error_type(error: Exception) -> str:
+    """Classify a failure for fileenc_errors_total"""
+    if isinstance(error, InvalidTag):
+        return 'auth_tag'
+    if isinstance(error, KeyFormatError):
+        return 'key_format'
+    if isinstance(error, ValueError):
+        return 'invalid_input'
+    if isinstance(error, OSError):
+        return 'io'
+    return 'other'
+
+def benchmark_cipher_suites(size: int = CIPHER_BENCHMARK_BYTES, segment_size: int = SEGMENT_SIZE) -> dict:
+    """Seal size bytes in segment_size pieces with each suite; returns MB/s per suite"""
+    key = secrets.token_bytes(32)
+    nonce = secrets.token_bytes(12)
+    segment = secrets.token_bytes(segment_size)
+    speeds = {}
+    for name, suite in CIPHER_SUITES.items():
+        aead = suite(key)
+        aead.encrypt(nonce, segment, None)  # warm up
+        start = time.perf_counter()
+        for _ in range(max(1, size // segment_size)):
+            aead.encrypt(nonce, segment, None)
+        speeds[name] = max(1, size // segment_size) * segment_size / (time.perf_counter() - start) / 1e6
+    return speeds
+
+def select_cipher_suite(setting: str = CIPHER_SUITE) -> str:
+    """Resolve CIPHER_SUITE: a suite name, or 'auto' to benchmark this host"""
+    if setting != 'auto':
+        if setting not in CIPHER_SUITES:
+            raise ValueError(f"Unknown CIPHER_SUITE {setting!r}, expected 'auto' or one of: {', '.join(CIPHER_SUITES)}")
+        return setting
+    speeds = benchmark_cipher_suites()
+    fastest = max(speeds, key=speeds.get)
+    # Files sealed with AES-GCM stay readable by older versions, so only switch for a clear win
+    suite = fastest if speeds[fastest] > speeds[LEGACY_CIPHER] * CIPHER_BENCHMARK_MARGIN else LEGACY_CIPHER
+    print(f"Cipher benchmark: {', '.join(f'{n} {v:.0f} MB/s' for n, v in speeds.items())} - using {suite}")
+    return suite
+
+def host_calibration() -> dict:
+    """Settings resolved by benchmarking this host, as environment variables.
+
+    gunicorn.conf.py runs this once in the master so that every worker (and every worker
+    recycled later) starts with the same result instead of benchmarking for itself.
+    """
+    return {'CIPHER_SUITE': select_cipher_suite()}
+
+class FileEncryptor:
+    def __init__(self, segment_size: int = SEGMENT_SIZE, workers: int = PARALLEL_WORKERS,
+                 parallel_threshold: int = PARALLEL_THRESHOLD, cipher: str = LEGACY_CIPHER,
+                 envelope: bool = False, log=print):
+        self.segment_size = segment_size
+        self.cipher = cipher
+        self.envelope = envelope
+        self.workers = workers
+        self.parallel_threshold = parallel_threshold
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.log = log  # per-file diagnostics (server log lines)
+    
+    def generate_key(self) -> tuple:
+        """Generate a random 256-bit AES key"""
+        key = secrets.token_bytes(32)  # 256 bits
+        key_hex = key.hex()
+        key_b64 = base64.b64encode(key).decode('utf-8')
+        return key, key_hex, key_b64
+    
+    def parse_key(self, key_input: str) -> bytes:
+        """Parse key from hex or base64 format"""
+        try:
+            # Try hex first
+            if len(key_input) == 64 and all(c in '0123456789abcdefABCDEF' for c in key_input):
+                key = bytes.fromhex(key_input)
+            else:
+                # Try base64
+                key = base64.b64decode(key_input)
+        except Exception as e:
+            raise KeyFormatError(f"Invalid key format. Please provide a valid hex or base64 key: {str(e)}")
+        
+        if len(key) != 32:
+            raise KeyFormatError("Key must be 256 bits (32 bytes)")
+        
+        return key
+    
+    def new_header(self, key: bytes) -> dict:
+        """Create container header fields for a new encryption under `key`"""
+        header = {
+            'cipher': self.cipher,
+            'segment_size': self.segment_size,
+            'nonce': base64.b64encode(secrets.token_bytes(NONCE_PREFIX_SIZE)).decode('utf-8')
+        }
+        if self.envelope:
+            header['wrapped_key'] = base64.b64encode(aes_key_wrap(key, secrets.token_bytes(32))).decode('utf-8')
+        return header
+    
+    def data_key(self, key: bytes, header: dict) -> bytes:
+        """Key that seals the segments: the unwrapped data key of an envelope container, else `key` itself.
+        
+        A key that does not unwrap raises InvalidTag, like a segment that does not authenticate.
+        """
+        if 'wrapped_key' not in header:
+            return key
+        try:
+            return aes_key_unwrap(key, base64.b64decode(header['wrapped_key']))
+        except InvalidUnwrap:
+            raise InvalidTag() from None
+    
+    def aead(self, key: bytes, header: dict):
+        """AEAD for a container's cipher suite (AES-GCM for containers that predate suites)"""
+        suite = header.get('cipher', LEGACY_CIPHER)
+        if suite not in CIPHER_SUITES:
+            raise ValueError(f"Unsupported cipher suite: {suite}")
+        return CIPHER_SUITES[suite](self.data_key(key, header))
+    
+    def rewrap(self, f, old_key: bytes, new_key: bytes):
+        """Re-wrap an envelope container's data key under new_key, rewriting only its header in place.
+        
+        f must be opened 'r+b', on a copy that replaces the original afterwards (the write is not
+        atomic). The wrapped key has a fixed length, so the header keeps its size and the
+        segments are not touched. Raises InvalidTag if old_key is wrong.
+        """
+        header = self.read_header(f)
+        if header is None or 'wrapped_key' not in header:
+            raise ValueError("Only envelope-encrypted files can be rewrapped; decrypt and re-encrypt this file")
+        data_key = self.data_key(old_key, header)
+        header_size = header.pop('header_size')
+        header['wrapped_key'] = base64.b64encode(aes_key_wrap(new_key, data_key)).decode('utf-8')
+        packed = self.pack_header(header)
+        if len(packed) != header_size:
+            raise ValueError("Rewrapped header does not fit in place")
+        f.seek(0)
+        f.write(packed)
+        f.flush()
+        os.fsync(f.fileno())
+    
+    def pack_header(self, header: dict) -> bytes:
+        """Serialize header as magic + version + length-prefixed JSON"""
+        body = json.dumps(header, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        return FORMAT_MAGIC + bytes([FORMAT_VERSION]) + struct.pack('>I', len(body)) + body
+    
+    def read_header(self, f) -> dict:
+        """Read the container header, or return None for a legacy nonce||ciphertext file.
+        
+        A file that starts with the container magic but has a version this code cannot
+        read raises ValueError instead of being misread as a legacy file.
+        """
+        prefix = f.read(len(FORMAT_MAGIC) + 5)
+        if not prefix.startswith(FORMAT_MAGIC):
+            f.seek(0)
+            return None
+        if len(prefix) < len(FORMAT_MAGIC) + 5:
+            raise ValueError("Truncated container header")
+        if prefix[len(FORMAT_MAGIC)] not in READABLE_VERSIONS:
+            raise ValueError(f"Unsupported container version {prefix[len(FORMAT_MAGIC)]}")
+        (length,) = struct.unpack('>I', prefix[len(FORMAT_MAGIC) + 1:])
+        if length > MAX_HEADER_SIZE:
+            raise ValueError("Container header too large")
+        body = f.read(length)
+        if len(body) != length:
+            raise ValueError("Truncated container header")
+        header = json.loads(body.decode('utf-8'))
+        if not isinstance(header, dict) or header.keys() - HEADER_FIELDS:
+            raise ValueError("Container header has fields this version cannot read; decrypt it with a newer release")
+        header['header_size'] = len(prefix) + length
+        return header
+    
+    def check_client_header(self, header: dict) -> dict:
+        """Validate a container header built outside the server (browser-side encryption); returns it.
+        
+        Only the fields new_header writes (plus compression) are accepted, with this
+        server's segment size, so the container opens with the usual readers.
+        """
+        if not isinstance(header, dict):
+            raise ValueError("The container header must be a JSON object")
+        fields = header.keys() - {'header_size'}
+        if not {'cipher', 'segment_size', 'nonce'} <= fields \
+                or fields - {'cipher', 'segment_size', 'nonce', 'wrapped_key', 'compression'}:
+            raise ValueError("The container header needs cipher, segment_size and nonce "
+                             "(and optionally wrapped_key and compression)")
+        if header['cipher'] not in CIPHER_SUITES:
+            raise ValueError(f"Unsupported cipher suite: {header['cipher']}")
+        if header['segment_size'] != self.segment_size or isinstance(header['segment_size'], bool):
+            raise ValueError(f"The segment size must be {self.segment_size}")
+        for field, size in (('nonce', NONCE_PREFIX_SIZE), ('wrapped_key', 40)):
+            if field not in header:
+                continue
+            try:
+                valid = len(base64.b64decode(header[field], validate=True)) == size
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                raise ValueError(f"The {field} must be {size} bytes in base64")
+        if 'compression' in header and header['compression'] not in COMPRESSION_ALGORITHMS:
+            raise ValueError(f"Unsupported compression: {header['compression']}")
+        return header
+    
+    def check_client_container(self, f) -> dict:
+        """Check a container encrypted elsewhere without its key: a valid header and a plausible segment layout.
+        
+        Segments cannot be authenticated here, so a damaged body is only detected on decryption.
+        """
+        header = self.read_header(f)
+        if header is None:
+            raise ValueError("Not an encrypted container")
+        f.seek(len(FORMAT_MAGIC))
+        if f.read(1)[0] != FORMAT_VERSION:
+            raise ValueError(f"The container must be format version {FORMAT_VERSION}")
+        self.check_client_header(header)
+        body = f.seek(0, os.SEEK_END) - header['header_size']
+        last = body % (header['segment_size'] + TAG_SIZE)
+        if body < TAG_SIZE or 0 < last < TAG_SIZE:
+            raise ValueError("Truncated container")
+        return header
+    
+    @staticmethod
+    def segment_nonce(prefix: bytes, counter: int, final: bool) -> bytes:
+        """Derive a per-segment nonce: prefix(7) || counter(4) || final flag(1)"""
+        if counter > MAX_SEGMENTS:
+            raise ValueError("File has too many segments")
+        return prefix + struct.pack('>I', counter) + (b'\x01' if final else b'\x00')
+    
+    @staticmethod
+    def read_chunks(f, size: int) -> Iterator[bytes]:
+        """Yield fixed-size chunks from a binary file object"""
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+    
+    @staticmethod
+    def rechunk(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+        """Regroup arbitrarily sized chunks into chunks of exactly `size` bytes (last may be short)"""
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk
+            while len(buf) >= size:
+                yield bytes(buf[:size])
+                del buf[:size]
+        if buf:
+            yield bytes(buf)
+    
+    @staticmethod
+    def mark_final(segments: Iterable[bytes]) -> Iterator[tuple]:
+        """Yield (counter, segment, final) using one segment of lookahead; empty input yields one empty final segment"""
+        segments = iter(segments)
+        current = next(segments, b'')
+        counter = 0
+        for following in segments:
+            yield counter, current, False
+            current = following
+            counter += 1
+        yield counter, current, True
+    
+    def use_parallel(self, size: int) -> bool:
+        """Whether a file of `size` bytes should go through the thread pool"""
+        return self.workers > 1 and size is not None and size >= self.parallel_threshold
+    
+    def get_executor(self) -> ThreadPoolExecutor:
+        # Created on first use, once: concurrent requests must not each start a pool
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='segment')
+            return self.executor
+    
+    def ordered_map(self, fn, items: Iterable[tuple]) -> Iterator[bytes]:
+        """Run fn over batches of items on the thread pool, yielding results in input order.
+        
+        At most 2 * workers batches are in flight, which bounds memory regardless of file size.
+        """
+        executor = self.get_executor()
+        
+        def run_batch(batch):
+            return b''.join(fn(*item) for item in batch)
+        
+        window = deque()
+        try:
+            items = iter(items)
+            while True:
+                batch = list(itertools.islice(items, PARALLEL_BATCH_SEGMENTS))
+                if not batch:
+                    break
+                window.append(executor.submit(run_batch, batch))
+                if len(window) >= 2 * self.workers:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+    
+    @staticmethod
+    def metered(blocks: Iterable[bytes], operation: str) -> Iterator[bytes]:
+        """Pass blocks through, adding their size to the bytes-processed counter"""
+        total = 0
+        try:
+            for block in blocks:
+                total += len(block)
+                yield block
+        finally:
+            BYTES_PROCESSED.inc(total, operation=operation)
+    
+    @staticmethod
+    def hashed(blocks: Iterable[bytes], hasher) -> Iterator[bytes]:
+        """Pass blocks through, feeding them to hasher"""
+        for block in blocks:
+            hasher.update(block)
+            yield block
+    
+    @staticmethod
+    def reported(blocks: Iterable[bytes], progress) -> Iterator[bytes]:
+        """Pass blocks through, calling progress with the number of bytes passed so far"""
+        done = 0
+        for block in blocks:
+            done += len(block)
+            progress(done)
+            yield block
+    
+    @staticmethod
+    def compressor(algorithm: str):
+        """Streaming compressor for a header 'compression' value"""
+        if algorithm == 'zlib':
+            return zlib.compressobj(COMPRESSION_LEVELS['zlib'])
+        if algorithm == 'zstd' and zstandard is not None:
+            return zstandard.ZstdCompressor(level=COMPRESSION_LEVELS['zstd']).compressobj()
+        raise ValueError(f"Unsupported compression: {algorithm}")
+    
+    @staticmethod
+    def decompressor(algorithm: str):
+        """Streaming decompressor for a header 'compression' value"""
+        if algorithm == 'zlib':
+            return zlib.decompressobj()
+        if algorithm == 'zstd' and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise ValueError(f"Unsupported compression: {algorithm}")
+    
+    def iter_compress(self, blocks: Iterable[bytes], algorithm: str) -> Iterator[bytes]:
+        """Yield the compressed form of a plaintext stream"""
+        compressor = self.compressor(algorithm)
+        compress_time = StageTimer()
+        try:
+            for block in blocks:
+                data = compress_time.call(compressor.compress, block)
+                if data:
+                    yield data
+            yield compress_time.call(compressor.flush)
+        finally:
+            STAGE_SECONDS.observe(compress_time.total, stage='compress')
+    
+    def iter_decompress(self, blocks: Iterable[bytes], algorithm: str) -> Iterator[bytes]:
+        """Yield the decompressed form of authenticated segments"""
+        decompressor = self.decompressor(algorithm)
+        compress_time = StageTimer()
+        try:
+            for block in blocks:
+                data = compress_time.call(decompressor.decompress, block)
+                if data:
+                    yield data
+            yield compress_time.call(decompressor.flush)
+        finally:
+            STAGE_SECONDS.observe(compress_time.total, stage='compress')
+    
+    def probe_compression(self, blocks: Iterable[bytes], header: dict) -> Iterator[bytes]:
+        """Compress blocks as header['compression'] asks, unless the first block looks incompressible.
+        
+        Drops 'compression' from the header when skipping, so call this before packing it.
+        """
+        if header['compression'] not in COMPRESSION_ALGORITHMS:
+            raise ValueError(f"Unsupported compression: {header['compression']}")
+        blocks = iter(blocks)
+        first = next(blocks, b'')
+        sample = first[:COMPRESSION_PROBE_SIZE]
+        blocks = itertools.chain([first], blocks)
+        if len(zlib.compress(sample, 1)) > len(sample) * COMPRESSION_PROBE_RATIO:
+            del header['compression']
+            return blocks
+        return self.iter_compress(blocks, header['compression'])
+    
+    def iter_encrypt(self, chunks: Iterable[bytes], key: bytes, header: dict, parallel: bool = False) -> Iterator[bytes]:
+        """Yield the container header followed by the encrypted segments"""
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        cipher_time = StageTimer()
+        plaintext = self.metered(chunks, 'encrypt')
+        if header.get('compression'):
+            plaintext = self.probe_compression(self.rechunk(plaintext, header['segment_size']), header)
+        yield self.pack_header(header)
+        
+        def seal(counter, segment, final):
+            return cipher_time.call(aead.encrypt, self.segment_nonce(prefix, counter, final), segment, None)
+        
+        # Lookahead marks the last segment final so truncation is detectable
+        segments = self.mark_final(self.rechunk(plaintext, header['segment_size']))
+        try:
+            if parallel:
+                yield from self.ordered_map(seal, segments)
+            else:
+                for segment in segments:
+                    yield seal(*segment)
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+    
+    def iter_decrypt(self, f, key: bytes, header: dict, parallel: bool = False) -> Iterator[bytes]:
+        """Yield authenticated plaintext from a container positioned after its header"""
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        cipher_time = StageTimer()
+        
+        def open_segment(counter, segment, final):
+            return cipher_time.call(aead.decrypt, self.segment_nonce(prefix, counter, final), segment, None)
+        
+        # A truncated file fails on its last segment, which was not sealed as final
+        segments = self.mark_final(self.read_chunks(f, header['segment_size'] + TAG_SIZE))
+        try:
+            if parallel:
+                plaintext = self.ordered_map(open_segment, segments)
+            else:
+                plaintext = (open_segment(*segment) for segment in segments)
+            if header.get('compression'):
+                plaintext = self.iter_decompress(plaintext, header['compression'])
+            yield from self.metered(plaintext, 'decrypt')
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+    
+    def segment_count(self, header: dict, container_size: int) -> int:
+        """Number of segments in a container of container_size bytes (always at least one)"""
+        body = container_size - header['header_size']
+        return max(1, -(-body // (header['segment_size'] + TAG_SIZE)))
+    
+    def check_final_segment(self, f, key: bytes, header: dict):
+        """Authenticate only the last segment, catching a wrong key or truncation before any output.
+        
+        Raises InvalidTag on failure and leaves f where it was.
+        """
+        start = f.tell()
+        f.seek(0, os.SEEK_END)
+        count = self.segment_count(header, f.tell())
+        f.seek(header['header_size'] + (count - 1) * (header['segment_size'] + TAG_SIZE))
+        last = f.read()
+        f.seek(start)
+        prefix = base64.b64decode(header['nonce'])
+        self.aead(key, header).decrypt(self.segment_nonce(prefix, count - 1, True), last, None)
+    
+    def plaintext_size(self, header: dict, container_size: int) -> int:
+        """Plaintext length of a container, computed from its size without decrypting"""
+        return container_size - header['header_size'] - self.segment_count(header, container_size) * TAG_SIZE
+    
+    def iter_decrypt_range(self, f, key: bytes, header: dict, start: int, stop: int) -> Iterator[bytes]:
+        """Yield plaintext bytes [start, stop), decrypting and authenticating only the covering segments"""
+        if header.get('compression'):
+            raise ValueError("Range access is not available for compressed containers")
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        f.seek(0, os.SEEK_END)
+        count = self.segment_count(header, f.tell())
+        size = header['segment_size']
+        stride = size + TAG_SIZE
+        cipher_time = StageTimer()
+        try:
+            for index in range(start // size, (stop - 1) // size + 1):
+                f.seek(header['header_size'] + index * stride)
+                segment = cipher_time.call(aead.decrypt, self.segment_nonce(prefix, index, index == count - 1),
+                                           f.read(stride), None)
+                offset = index * size
+                block = segment[max(0, start - offset):stop - offset]
+                BYTES_PROCESSED.inc(len(block), operation='decrypt_range')
+                yield block
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+    
+    def iter_decrypt_legacy(self, f, key: bytes, nonce: bytes = None) -> Iterator[bytes]:
+        """Yield plaintext from a legacy nonce||ciphertext file without loading it into memory.
+        
+        The single GCM tag only covers the whole file, so callers must discard the
+        output if the final chunk raises InvalidTag.
+        """
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < 12 + TAG_SIZE:
+            raise ValueError("File too short to contain nonce")
+        f.seek(size - TAG_SIZE)
+        tag = f.read(TAG_SIZE)
+        f.seek(0)
+        file_nonce = f.read(12)
+        decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce or file_nonce, tag)).decryptor()
+        remaining = size - 12 - TAG_SIZE
+        cipher_time = StageTimer()
+        try:
+            while remaining > 0:
+                chunk = f.read(min(self.segment_size, remaining))
+                remaining -= len(chunk)
+                BYTES_PROCESSED.inc(len(chunk), operation='decrypt')
+                yield cipher_time.call(decryptor.update, chunk)
+            yield cipher_time.call(decryptor.finalize)
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+    
+    def verify_segments(self, f, key: bytes, header: dict) -> dict:
+        """Authenticate every segment of a container positioned after its header, discarding the plaintext"""
+        report = {'format': 'segmented', 'segments': 0, 'failed_segments': 0, 'failures': []}
+        try:
+            aead = self.aead(key, header)
+        except InvalidTag:
+            # Envelope container: the key is checked against the wrapped data key before any segment
+            report.update(status='failed', error='Wrong key: it does not unwrap the data key in the header')
+            return report
+        prefix = base64.b64decode(header['nonce'])
+        stride = header['segment_size'] + TAG_SIZE
+        cipher_time = StageTimer()
+        try:
+            for counter, segment, final in self.mark_final(self.read_chunks(f, stride)):
+                report['segments'] += 1
+                BYTES_PROCESSED.inc(len(segment), operation='verify')
+                try:
+                    cipher_time.call(aead.decrypt, self.segment_nonce(prefix, counter, final), segment, None)
+                    continue
+                except InvalidTag:
+                    report['failed_segments'] += 1
+                if len(report['failures']) >= MAX_REPORTED_FAILURES:
+                    continue
+                failure = {'segment': counter, 'offset': header['header_size'] + counter * stride,
+                           'length': len(segment), 'reason': 'corrupt'}
+                if final:
+                    # A last segment that only authenticates as non-final means data was cut off after it
+                    try:
+                        aead.decrypt(self.segment_nonce(prefix, counter, False), segment, None)
+                        failure['reason'] = 'truncated'
+                    except InvalidTag:
+                        pass
+                report['failures'].append(failure)
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+        
+        report['status'] = 'failed' if report['failed_segments'] else 'ok'
+        if report['failed_segments'] == report['segments']:
+            report['error'] = 'No segment authenticates: wrong key, or the whole file is damaged'
+        return report
+    
+    def verify(self, f, key: bytes, nonce_b64: str = None) -> dict:
+        """Authenticate every tag of an encrypted file in one streaming pass, without producing plaintext.
+        
+        Memory stays flat whatever the file size. Returns a report instead of raising:
+        'status' is 'ok' or 'failed', and for segmented containers 'failures' gives the
+        index, byte offset and length of each bad segment (up to MAX_REPORTED_FAILURES).
+        """
+        f.seek(0, os.SEEK_END)
+        report = {'ciphertext_bytes': f.tell()}
+        f.seek(0)
+        try:
+            header = self.read_header(f)
+            if header is not None:
+                report.update(self.verify_segments(f, key, header))
+            else:
+                report.update(format='legacy', segments=1)
+                # Legacy file: metadata nonce overrides the one stored in the file
+                nonce = base64.b64decode(nonce_b64) if nonce_b64 else None
+                for _ in self.iter_decrypt_legacy(f, key, nonce):
+                    pass
+                report['status'] = 'ok'
+        except InvalidTag:
+            # One tag covers the whole legacy file, so the damage cannot be located
+            report.update(status='failed', error='Authentication failed (wrong key or damaged file)')
+            ERRORS.inc(type='auth_tag')
+        except ValueError as e:
+            report.update(status='failed', error=str(e))
+            ERRORS.inc(type='invalid_input')
+        else:
+            if report['status'] != 'ok':
+                ERRORS.inc(type='auth_tag')
+        return report
+    
+    def encrypt_file(self, input_path: str, output_path: str, key_input: str = None, compression: str = None,
+                     progress=None) -> dict:
+        """Encrypt file using segmented AES-GCM with provided or randomly generated key.
+        
+        progress, if given, is called with the number of input bytes read so far.
+        """
+        with open(input_path, 'rb') as src:
+            chunks = self.read_chunks(src, self.segment_size)
+            if progress is not None:
+                chunks = self.reported(chunks, progress)
+            return self.encrypt_stream(chunks, output_path, key_input,
+                                       os.path.basename(input_path), os.path.getsize(input_path), compression)
+    
+    def encrypt_stream(self, chunks: Iterable[bytes], output_path: str, key_input: str = None,
+                       input_name: str = None, size_hint: int = None, compression: str = None) -> dict:
+        """Encrypt plaintext chunks (e.g. straight from a request body) into output_path.
+        
+        size_hint is the expected plaintext size, used to pick the parallel engine.
+        compression ('zlib' or 'zstd') is applied unless the data turns out to be incompressible.
+        """
+        try:
+            # Use provided key or generate new one
+            key = self.parse_key(key_input) if key_input else self.generate_key()[0]
+            
+            header = self.new_header(key)
+            if compression:
+                header['compression'] = compression
+            
+            # Stream segments to output
+            write_time = StageTimer()
+            with open(output_path, 'wb') as dst:
+                for block in self.iter_encrypt(chunks, key, header, self.use_parallel(size_hint)):
+                    write_time.call(dst.write, block)
+            STAGE_SECONDS.observe(write_time.total, stage='write')
+            
+            # Return metadata
+            return self.describe(header, key, input_name, os.path.basename(output_path))
+        except Exception as e:
+            self.log(f"Encryption error: {e}")
+            ERRORS.inc(type=error_type(e))
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise e
+    
+    def content_hasher(self, key: bytes):
+        """Keyed hash of plaintext for deduplication (see DEDUP_CONTEXT); update() it, then hexdigest()"""
+        return hmac.new(hmac.new(key, DEDUP_CONTEXT, hashlib.sha256).digest(), digestmod=hashlib.sha256)
+    
+    def content_id(self, input_path: str, key: bytes) -> str:
+        """Content id of a file (a read-only pass, much cheaper than encrypting it again)"""
+        hasher = self.content_hasher(key)
+        with open(input_path, 'rb') as src:
+            for chunk in self.read_chunks(src, STREAM_CHUNK_SIZE):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+    
+    def describe(self, header: dict, key: bytes, input_name: str, output_name: str) -> dict:
+        """Metadata for a container (served as <output>.meta); without a key for one encrypted in the browser"""
+        metadata = {
+            'input_file': input_name,
+            'output_file': output_name,
+            'nonce': header['nonce'],
+            'cipher': header['cipher'],
+            'format_version': FORMAT_VERSION,
+            'segment_size': header['segment_size']
+        }
+        if key is None:
+            metadata['client_encrypted'] = True
+        else:
+            metadata['key_hex'] = key.hex()
+            metadata['key_base64'] = base64.b64encode(key).decode('utf-8')
+        if 'compression' in header:
+            metadata['compression'] = header['compression']
+        return metadata
+    
+    def sealed_size(self, header: dict, size: int) -> int:
+        """Ciphertext length of `size` plaintext bytes sealed from a segment boundary (always at least one segment)"""
+        return size + max(1, -(-size // header['segment_size'])) * TAG_SIZE
+    
+    def opened_size(self, header: dict, size: int) -> int:
+        """Plaintext length of `size` sealed bytes from a segment boundary, or None if no segments seal to that length"""
+        plain = size - max(1, -(-size // (header['segment_size'] + TAG_SIZE))) * TAG_SIZE
+        return plain if plain >= 0 and self.sealed_size(header, plain) == size else None
+    
+    def chunk_offset(self, header: dict, chunk_size: int, index: int) -> int:
+        """Container offset of upload chunk `index` (chunk_size is a multiple of the segment size)"""
+        return header['header_size'] + self.sealed_size(header, chunk_size) * index
+    
+    def encrypt_chunk(self, chunks: Iterable[bytes], key: bytes, header: dict, first_segment: int, last: bool) -> bytes:
+        """Seal one chunk of a resumable upload as its data arrives.
+        
+        Segments are numbered from first_segment and, for the last chunk, the final one
+        is sealed final. The result is returned rather than written, so an interrupted
+        chunk leaves nothing behind that a retry would seal again under the same nonces.
+        """
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        segments = self.rechunk(self.metered(chunks, 'encrypt'), header['segment_size'])
+        if last:
+            segments = self.mark_final(segments)
+        else:
+            segments = ((counter, segment, False) for counter, segment in enumerate(segments))
+        sealed = bytearray()
+        cipher_time = StageTimer()
+        try:
+            for counter, segment, final in segments:
+                sealed += cipher_time.call(aead.encrypt, self.segment_nonce(prefix, first_segment + counter, final),
+                                           segment, None)
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+        return bytes(sealed)
+    
+    def open_plaintext(self, src, key: bytes, nonce_b64: str = None, preflight: bool = False) -> tuple:
+        """Return (plaintext blocks, plaintext size or None if compressed) for a segmented container or legacy file.
+        
+        With preflight, a wrong key or damaged file raises here rather than part-way through
+        the output: a container's last segment is authenticated up front, and a legacy file
+        (one tag over the whole file) gets a full authentication pass first.
+        """
+        src.seek(0, os.SEEK_END)
+        container_size = src.tell()
+        src.seek(0)
+        header = self.read_header(src)
+        if header is not None:
+            self.log(f"Container v{FORMAT_VERSION} - Segment size: {header['segment_size']} bytes")
+            if preflight:
+                self.check_final_segment(src, key, header)
+            size = None if header.get('compression') else self.plaintext_size(header, container_size)
+            return self.iter_decrypt(src, key, header, self.use_parallel(container_size)), size
+        
+        # Legacy file: metadata nonce overrides the one stored in the file
+        nonce = base64.b64decode(nonce_b64) if nonce_b64 else None
+        self.log(f"Legacy format - Nonce from {'metadata' if nonce else 'file'}")
+        if preflight:
+            for _ in self.iter_decrypt_legacy(src, key, nonce):
+                pass
+        return self.iter_decrypt_legacy(src, key, nonce), max(0, container_size - 12 - TAG_SIZE)
+    
+    def decrypt_file(self, input_path: str, output_path: str, key_input: str, nonce_b64: str = None,
+                     progress=None) -> bool:
+        """Decrypt a segmented container, or a legacy nonce||ciphertext file.
+        
+        progress, if given, is called with the number of input bytes read so far.
+        """
+        try:
+            # Parse key
+            key = self.parse_key(key_input)
+            
+            with open(input_path, 'rb') as src:
+                plaintext, _ = self.open_plaintext(src, key, nonce_b64)
+                
+                # Write decrypted file
+                write_time = StageTimer()
+                with open(output_path, 'wb') as dst:
+                    for block in plaintext:
+                        write_time.call(dst.write, block)
+                        if progress is not None:
+                            progress(src.tell())
+                STAGE_SECONDS.observe(write_time.total, stage='write')
+            
+            return True
+        except Exception as e:
+            self.log(f"Decryption error: {e!r}")
+            ERRORS.inc(type=error_type(e))
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return False
@@ -0,0 +1,75 @@
+# Production server settings: gunicorn -c gunicorn.conf.py app:app
+#
+# Pre-fork workers spread requests across cores; each worker runs a pool of
+# threads (gthread) so a slow upload or download holds a thread, not a whole
+# worker process. Crypto already runs off the request thread where it matters
+# (segment thread pool for large files, process pool for PBKDF2).
+import json
+import multiprocessing
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+
+# One worker process per core; threads absorb slow clients and I/O waits
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+# The app sizes its pools per process, and every worker imports it and builds its own.
+# The settings below are server-wide totals, so each worker gets its share (workers
+# inherit this environment): one pool thread or process per core in every worker would
+# otherwise add up to cores squared.
+def split_between_workers(name: str, total: int, minimum: int = 1):
+    """Replace a server-wide setting with one worker's share (0 keeps its meaning of 'off')"""
+    total = int(os.environ.get(name, total))
+    os.environ[name] = str(max(minimum, total // workers) if total else 0)
+
+split_between_workers('PARALLEL_WORKERS', multiprocessing.cpu_count())
+
+# Upload session keys (and queued jobs' credentials) are stored sealed under this secret,
+# which every worker needs to share. Generated per start unless set, so in-progress uploads
+# and queued jobs survive a restart only with CREDENTIAL_SECRET set explicitly.
+os.environ.setdefault('CREDENTIAL_SECRET', secrets.token_hex(32))
+
+# Each worker keeps its own metrics and a scrape reaches one worker at random, so workers
+# publish theirs to a shared directory and /metrics reports server-wide totals
+# (removed again when the server stops)
+metrics_dir = os.environ.setdefault(
+    'METRICS_DIR', os.path.join(tempfile.gettempdir(), f'fileenc-metrics-{os.getpid()}'))
+
+def on_exit(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+# Host benchmarks (encryptor.host_calibration) run once here, before any worker starts, and
+# reach the workers as environment settings: otherwise every worker would run them at boot and
+# on every recycle, contending for the CPU they are timing and possibly settling on different
+# results. A separate process keeps the app's modules out of the master, which workers fork from.
+def on_starting(server):
+    result = subprocess.run(
+        [sys.executable, '-c', 'import json, encryptor; print(json.dumps(encryptor.host_calibration()))'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ, METRICS_DIR=''),
+        stdout=subprocess.PIPE, text=True, check=True)
+    *messages, settings = result.stdout.splitlines()
+    for message in messages:
+        server.log.info(message)
+    os.environ.update(json.loads(settings))
+
+# Seconds a keep-alive connection may idle, and a request may run, before being dropped
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+# Do not preload: thread and process pools are created lazily inside each worker
+preload_app = False
+
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-')
+errorlog = '-'
@@ -0,0 +1,321 @@
+"""Minimal thread-safe Prometheus metrics (text exposition format 0.0.4).
+
+Kept dependency-free so the apps stay installable from requirements.txt alone.
+Each update is a dict lookup plus a short lock, cheap enough to leave on in production.
+
+Values live in the process that records them. Under a pre-fork server a scrape reaches one
+worker at random, so a Registry given a shared directory (METRICS_DIR) aggregates: each
+process writes its values there every few seconds and at exit, and a scrape adds up every
+worker's. Counters and histograms of workers that have exited are kept in an archive, so
+totals do not drop when workers are recycled.
+"""
+import atexit
+import bisect
+import fcntl
+import json
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def header(self) -> list:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def local(self) -> dict:
+        """This process's series (a copy)"""
+        with self.lock:
+            return dict(self.values)
+
+    def snapshot(self) -> list:
+        """This process's series as JSON-ready [label values, value] pairs, for other processes to add"""
+        return [[list(key), value] for key, value in self.local().items()]
+
+    def add(self, values: dict, key: tuple, value):
+        """Add another process's series into values"""
+        values[key] = values.get(key, 0) + value
+
+    def render(self, values: dict = None) -> list:
+        items = sorted((self.local() if values is None else values).items())
+        return self.header() + [f'{self.name}{format_labels(self.labelnames, k)} {format_value(v)}' for k, v in items]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down. Across processes values are summed ('sum'), the largest
+    is kept ('max', e.g. an info gauge every process sets), or for a function reading state
+    the processes share, only the scraped process's value is used ('local')."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), function=None, aggregate: str = 'sum'):
+        super().__init__(name, documentation, labelnames)
+        self.function = function  # computed at scrape time when set
+        self.aggregate = aggregate
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the enclosed block as in flight"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def local(self) -> dict:
+        if self.function is not None:
+            return {(): self.function()}
+        return super().local()
+
+    def snapshot(self) -> list:
+        return [] if self.aggregate == 'local' else super().snapshot()
+
+    def add(self, values: dict, key: tuple, value):
+        if self.aggregate == 'max':
+            values[key] = max(values.get(key, value), value)
+        else:
+            super().add(values, key, value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # per-bucket (non-cumulative) counts, then sum and count
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def local(self) -> dict:
+        with self.lock:
+            return {k: [[*v[0]], v[1], v[2]] for k, v in self.values.items()}
+
+    def add(self, values: dict, key: tuple, value):
+        series = values.get(key)
+        if series is None or len(series[0]) != len(value[0]):
+            values[key] = [[*value[0]], value[1], value[2]]
+            return
+        series[0] = [a + b for a, b in zip(series[0], value[0])]
+        series[1] += value[1]
+        series[2] += value[2]
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self, values: dict = None) -> list:
+        items = sorted((self.local() if values is None else values).items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = format_labels(self.labelnames, key, f'le="{format_value(float(bound))}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class StageTimer:
+    """Accumulates time spent in one stage over many calls (from any thread), to observe once per request"""
+
+    def __init__(self):
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def call(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.total += elapsed
+
+
+class Registry:
+    """The metrics of an app; with a directory, aggregated over all the processes sharing it"""
+
+    def __init__(self, directory: str = None, interval: float = 5):
+        self.metrics = []
+        self.directory = directory
+        self.interval = interval
+        if multiprocessing.parent_process() is not None:
+            self.directory = None  # a pool process importing the app's modules; it records nothing worth publishing
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            threading.Thread(target=self.flush_periodically, name='metrics-flush', daemon=True).start()
+            atexit.register(self.flush)
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = (), function=None,
+              aggregate: str = 'sum') -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function, aggregate))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        values = {metric.name: metric.local() for metric in self.metrics}
+        if self.directory:
+            for snapshot, live in self.others():
+                self.combine(values, snapshot, live)
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(values[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+    def combine(self, values: dict, snapshot: dict, live: bool = True):
+        """Add a snapshot into values; gauges only count for processes that are still running"""
+        for metric in self.metrics:
+            if metric.name in values and (live or metric.kind != 'gauge'):
+                for key, value in snapshot.get(metric.name, ()):
+                    metric.add(values[metric.name], tuple(key), value)
+
+    def flush(self):
+        """Publish this process's values for the others' scrapes"""
+        snapshot = {metric.name: metric.snapshot() for metric in self.metrics}
+        self.write(os.path.join(self.directory, f'{os.getpid()}.json'), snapshot)
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Metrics flush failed: {e}")
+
+    @staticmethod
+    def write(path: str, snapshot: dict):
+        partial = f'{path}.{threading.get_ident()}.tmp'
+        with open(partial, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(partial, path)
+
+    def others(self) -> list:
+        """(snapshot, live) for the other processes, with exited ones folded into the archive first"""
+        archive_path = os.path.join(self.directory, 'archive.json')
+        result = []
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = None
+            for name in os.listdir(self.directory):
+                stem, _, suffix = name.partition('.')
+                if suffix != 'json' or not stem.isdigit() or int(stem) == os.getpid():
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path) as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if process_alive(int(stem)):
+                    result.append((snapshot, True))
+                    continue
+                if archive is None:
+                    archive = self.read_archive(archive_path)
+                self.combine(archive, snapshot, live=False)
+                os.remove(path)
+            if archive is not None:
+                self.write(archive_path, {name: [[list(k), v] for k, v in series.items()]
+                                          for name, series in archive.items()})
+            result.append((self.snapshot_file(archive_path), False))
+        return result
+
+    def read_archive(self, path: str) -> dict:
+        """The archive as {metric name: {labels: value}}, ready to add to"""
+        archive = {metric.name: {} for metric in self.metrics if metric.kind != 'gauge'}
+        self.combine(archive, self.snapshot_file(path), live=False)
+        return archive
+
+    @staticmethod
+    def snapshot_file(path: str) -> dict:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,198 @@
+"""SQLite-backed state for resumable uploads, kept in the artifact catalog's database.
+
+A session fixes the upload's size and chunk size up front, so every chunk has a known
+place in the output container: chunks can arrive in any order, in parallel and on any
+server process, and each one is encrypted and written at its offset as it arrives.
+An upload compressed in the browser has no size until its final chunk arrives; all of
+its other chunks are whole, so their places are known all the same.
+Sessions left idle for longer than the TTL are expired together with their partial output.
+A server-side key is stored sealed (credentials.py) and goes away with the session.
+"""
+import json
+import os
+import secrets
+import time
+
+from cryptography.exceptions import InvalidTag
+
+from catalog import Catalog
+from credentials import CredentialBox
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        chunk_size INTEGER NOT NULL,
+        chunks INTEGER NOT NULL,
+        header TEXT NOT NULL,
+        key BLOB NOT NULL,  -- sealed under the server secret; empty when the browser encrypts
+        metadata TEXT,
+        owner TEXT,
+        created REAL NOT NULL,
+        updated REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS upload_sessions_updated ON upload_sessions (updated)',
+    '''CREATE TABLE IF NOT EXISTS upload_chunks (
+        session TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        claimed REAL NOT NULL,
+        PRIMARY KEY (session, idx)
+    )''',
+)
+
+PART_PREFIX = '.upload-'
+
+
+class UploadSessions:
+    def __init__(self, catalog: Catalog, credentials: CredentialBox, ttl: float = 24 * 3600,
+                 claim_timeout: float = 300, expire_interval: float = 60):
+        self.catalog = catalog
+        self.credentials = credentials
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        self.expire_interval = expire_interval
+        self.last_expired = 0.0
+        conn = self.catalog.connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def path(self, session_id: str) -> str:
+        """Partial output of a session (hidden, so the catalog backfill skips it)"""
+        return self.catalog.path(f'{PART_PREFIX}{session_id}.part')
+
+    def create(self, filename: str, size: int, chunk_size: int, header: dict, key: bytes, head: bytes,
+               metadata: dict = None, owner: str = None) -> dict:
+        """Start a session whose partial output begins with `head` (the packed container header).
+        
+        With size None the session is open-ended (0 chunks) until set_size() is called.
+        """
+        session_id = secrets.token_hex(16)
+        path = self.path(session_id)
+        with open(path, 'wb') as f:
+            f.write(head)
+        now = time.time()
+        try:
+            with self.catalog.connect() as conn:
+                conn.execute('INSERT INTO upload_sessions (id, filename, size, chunk_size, chunks, header, key, '
+                             'metadata, owner, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (session_id, filename, -1 if size is None else size, chunk_size,
+                              0 if size is None else max(1, -(-size // chunk_size)),
+                              json.dumps(header), self.credentials.seal(key, self.context(session_id)) if key else b'',
+                              json.dumps(metadata) if metadata else None, owner, now, now))
+        except Exception:
+            os.remove(path)
+            raise
+        self.maybe_expire()
+        return self.get(session_id)
+
+    @staticmethod
+    def context(session_id: str) -> str:
+        return f'upload-session:{session_id}'
+
+    def get(self, session_id: str) -> dict:
+        """Look up a session with the sorted indexes of its received chunks, or None.
+
+        A session whose key was sealed under another server secret (CREDENTIAL_SECRET changed,
+        or was generated by an earlier server start) cannot continue and is deleted.
+        """
+        conn = self.catalog.connect()
+        row = conn.execute('SELECT * FROM upload_sessions WHERE id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        if record['key']:
+            try:
+                record['key'] = self.credentials.open(record['key'], self.context(session_id))
+            except InvalidTag:
+                print(f"Dropped upload session {session_id}: its key was sealed under another server secret")
+                self.delete(session_id)
+                return None
+        if record['size'] < 0:
+            record['size'] = None
+        record['header'] = json.loads(record['header'])
+        record['metadata'] = json.loads(record['metadata']) if record['metadata'] else {}
+        record['received'] = [r['idx'] for r in conn.execute(
+            'SELECT idx FROM upload_chunks WHERE session = ? AND done = 1 ORDER BY idx', (session_id,))]
+        return record
+
+    def set_size(self, session_id: str, size: int) -> bool:
+        """Fix the size of an open-ended session once its final chunk is known.
+        
+        False if the session already has a different size or holds chunks past the new end.
+        """
+        with self.catalog.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT size, chunk_size FROM upload_sessions WHERE id = ?', (session_id,)).fetchone()
+            if row is None or row['size'] >= 0:
+                return row is not None and row['size'] == size
+            chunks = max(1, -(-size // row['chunk_size']))
+            if conn.execute('SELECT 1 FROM upload_chunks WHERE session = ? AND idx >= ?',
+                            (session_id, chunks)).fetchone() is not None:
+                return False
+            conn.execute('UPDATE upload_sessions SET size = ?, chunks = ?, updated = ? WHERE id = ?',
+                         (size, chunks, time.time(), session_id))
+        return True
+
+    def claim(self, session_id: str, index: int) -> str:
+        """Reserve a chunk for writing: 'claimed', 'done' (already received) or 'busy' (being written).
+
+        A claim left by a process that died mid-chunk can be taken over after claim_timeout seconds.
+        """
+        now = time.time()
+        with self.catalog.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT done, claimed FROM upload_chunks WHERE session = ? AND idx = ?',
+                               (session_id, index)).fetchone()
+            if row is not None and row['done']:
+                return 'done'
+            if row is not None and row['claimed'] > now - self.claim_timeout:
+                return 'busy'
+            conn.execute('INSERT OR REPLACE INTO upload_chunks (session, idx, done, claimed) VALUES (?, ?, 0, ?)',
+                         (session_id, index, now))
+            conn.execute('UPDATE upload_sessions SET updated = ? WHERE id = ?', (now, session_id))
+        return 'claimed'
+
+    def complete(self, session_id: str, index: int):
+        """Mark a claimed chunk as written"""
+        with self.catalog.connect() as conn:
+            conn.execute('UPDATE upload_chunks SET done = 1 WHERE session = ? AND idx = ?', (session_id, index))
+            conn.execute('UPDATE upload_sessions SET updated = ? WHERE id = ?', (time.time(), session_id))
+
+    def release(self, session_id: str, index: int):
+        """Drop the claim on a chunk that failed, so it can be sent again"""
+        with self.catalog.connect() as conn:
+            conn.execute('DELETE FROM upload_chunks WHERE session = ? AND idx = ? AND done = 0', (session_id, index))
+
+    def close(self, session_id: str) -> bool:
+        """Forget a session, leaving its partial output to the caller. False if it was already gone."""
+        with self.catalog.connect() as conn:
+            conn.execute('DELETE FROM upload_chunks WHERE session = ?', (session_id,))
+            return conn.execute('DELETE FROM upload_sessions WHERE id = ?', (session_id,)).rowcount == 1
+
+    def delete(self, session_id: str) -> bool:
+        """Abandon a session and remove its partial output"""
+        closed = self.close(session_id)
+        try:
+            os.remove(self.path(session_id))
+        except FileNotFoundError:
+            pass
+        return closed
+
+    def expire(self, ttl: float) -> list:
+        """Delete sessions idle for more than ttl seconds. Returns their ids."""
+        rows = self.catalog.connect().execute('SELECT id FROM upload_sessions WHERE updated < ?',
+                                              (time.time() - ttl,)).fetchall()
+        return [row['id'] for row in rows if self.delete(row['id'])]
+
+    def maybe_expire(self):
+        """Apply the TTL, at most once per expire_interval seconds"""
+        if not self.ttl or time.time() - self.last_expired < self.expire_interval:
+            return
+        self.last_expired = time.time()
+        expired = self.expire(self.ttl)
+        if expired:
+            print(f"Expired {len(expired)} abandoned upload session(s)")
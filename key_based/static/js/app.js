@@ -158,6 +158,372 @@ document.getElementById('generateKeyBtn').addEventListener('click', async functi
     }
 });
 
+// Files of at least RESUMABLE_THRESHOLD bytes (and all files encrypted in the browser) go through
+// the resumable upload API: each chunk is encrypted as it arrives, several chunks are sent at once,
+// failed chunks are retried, and submitting the same file again resumes the upload
+const RESUMABLE_THRESHOLD = 16 * 1024 * 1024;
+const UPLOAD_PARALLELISM = 4;
+const UPLOAD_ATTEMPTS = 5;
+const resumableUploads = new Map();  // file identity -> {id, credential, client}
+
+function fileIdentity(file) {
+    return [file.name, file.size, file.lastModified].join(':');
+}
+
+// Resume this page's earlier session for the file, or create one.
+// A browser-encrypted upload (`client`) resumes with the header and key it started with;
+// one that is not `resumable` (compressed in the browser) always starts a new session.
+async function startUpload(file, formData, client, resumable = true) {
+    const credential = formData.get('key') || formData.get('password') || '';
+    const previous = resumable && resumableUploads.get(fileIdentity(file));
+    if (previous && previous.credential === credential && Boolean(previous.client) === Boolean(client)) {
+        const response = await fetch(`/uploads/${previous.id}`);
+        if (response.ok) {
+            return { ...await response.json(), client: previous.client };
+        }
+    }
+    
+    const fields = new FormData();
+    if (client) {
+        // Only the container header is sent; the key stays in the page
+        fields.set('header', canonicalJson(client.header));
+    } else {
+        for (const [name, value] of formData) {
+            if (name !== 'file' && name !== 'output_name') {
+                fields.append(name, value);
+            }
+        }
+    }
+    fields.set('filename', file.name);
+    fields.set('size', file.size);
+    const response = await fetch('/uploads', { method: 'POST', body: fields });
+    const session = await response.json();
+    if (response.ok && resumable) {
+        resumableUploads.set(fileIdentity(file), { id: session.id, credential, client });
+    }
+    return { ...session, client };
+}
+
+// The body of one chunk: the plaintext slice, or for a browser-encrypted upload, the chunk sealed here
+async function chunkBody(session, file, index) {
+    const start = index * session.chunk_size;
+    const chunk = file.slice(start, start + session.chunk_size);
+    if (!session.client) {
+        return chunk;
+    }
+    const { key, prefix } = session.client;
+    const firstSegment = index * (session.chunk_size / session.client.header.segment_size);
+    const last = index === session.chunks - 1;
+    const sealed = [];
+    for await (const block of sealSegments(segments(readBlocks(chunk), session.client.header.segment_size),
+                                           key, prefix, firstSegment, last)) {
+        sealed.push(block);
+    }
+    return new Blob(sealed);
+}
+
+// PUT one chunk, retrying network errors, server errors and 409 (an earlier attempt still in progress);
+// `final` marks the chunk with the last segment of an upload compressed in the browser
+async function putChunk(session, index, chunk, final = false) {
+    const url = `/uploads/${session.id}/chunks/${index}` + (final ? '?final=true' : '');
+    for (let attempt = 1; ; attempt++) {
+        let error;
+        let retryable = true;
+        try {
+            const response = await fetch(url, { method: 'PUT', body: chunk });
+            if (response.ok) {
+                return;
+            }
+            error = new Error((await response.json()).error);
+            retryable = response.status >= 500 || response.status === 409;
+        } catch (networkError) {
+            error = networkError;
+        }
+        if (!retryable || attempt === UPLOAD_ATTEMPTS) {
+            throw error;
+        }
+        await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+    }
+}
+
+// Upload a file in parallel chunks and finalize it; resolves to the same JSON as /encrypt
+async function uploadResumable(file, formData, onProgress, client = null) {
+    const session = await startUpload(file, formData, client);
+    if (session.error) {
+        return session;
+    }
+    
+    const received = new Set(session.received);
+    const pending = [];
+    for (let index = 0; index < session.chunks; index++) {
+        if (!received.has(index)) {
+            pending.push(index);
+        }
+    }
+    let done = received.size;
+    onProgress(done / session.chunks);
+    
+    async function worker() {
+        while (pending.length) {
+            const index = pending.shift();
+            try {
+                await putChunk(session, index, await chunkBody(session, file, index));
+            } catch (error) {
+                pending.length = 0;
+                throw error;
+            }
+            onProgress(++done / session.chunks);
+        }
+    }
+    try {
+        await Promise.all(Array.from({ length: UPLOAD_PARALLELISM }, worker));
+    } catch (error) {
+        return { error: `${error.message} (submit again to resume the upload)` };
+    }
+    return finalizeUpload(session, file, formData);
+}
+
+// Publish a completely sent upload; resolves to the same JSON as /encrypt
+async function finalizeUpload(session, file, formData) {
+    const finalize = new FormData();
+    if (formData.get('output_name')) {
+        finalize.set('output_name', formData.get('output_name'));
+    }
+    const response = await fetch(`/uploads/${session.id}/finalize`, { method: 'POST', body: finalize });
+    const data = await response.json();
+    if (response.ok) {
+        resumableUploads.delete(fileIdentity(file));
+        if (session.client) {
+            data.metadata = { ...data.metadata, ...session.client.secrets };
+        }
+    }
+    return data;
+}
+
+// Browser-side encryption: the file is sealed here with WebCrypto in the server's container
+// format (see encryptor.py), segment by segment as it is read, and only ciphertext is
+// uploaded. The key never leaves the page, so the metadata with the key is saved locally.
+const FORMAT_MAGIC = [0x46, 0x45, 0x4e, 0x43];  // 'FENC'
+const NONCE_PREFIX_SIZE = 7;
+const READ_SIZE = 1024 * 1024;
+const COMPRESSION_PROBE_SIZE = 16 * 1024;
+const COMPRESSION_PROBE_RATIO = 0.9;  // same rule as the server: compress only if the probe shrinks below this
+
+function toBase64(bytes) {
+    let binary = '';
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        binary += String.fromCharCode(...bytes.subarray(i, i + 0x8000));
+    }
+    return btoa(binary);
+}
+
+function toHex(bytes) {
+    return Array.from(bytes, byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
+// Parse a 256-bit key from hex or base64, like FileEncryptor.parse_key
+function parseKey(keyInput) {
+    let bytes;
+    if (/^[0-9a-fA-F]{64}$/.test(keyInput)) {
+        bytes = Uint8Array.from(keyInput.match(/../g), pair => parseInt(pair, 16));
+    } else {
+        try {
+            bytes = Uint8Array.from(atob(keyInput), c => c.charCodeAt(0));
+        } catch (error) {
+            throw new Error('Invalid key format. Please provide a valid hex or base64 key');
+        }
+    }
+    if (bytes.length !== 32) {
+        throw new Error('Key must be 256 bits (32 bytes)');
+    }
+    return bytes;
+}
+
+// Sorted, compact JSON: the same bytes as the server's pack_header
+function canonicalJson(value) {
+    if (value && typeof value === 'object') {
+        return '{' + Object.keys(value).sort().map(name => `${JSON.stringify(name)}:${canonicalJson(value[name])}`).join(',') + '}';
+    }
+    return JSON.stringify(value);
+}
+
+function packHeader(header, formatVersion) {
+    const body = new TextEncoder().encode(canonicalJson(header));
+    const head = new Uint8Array(9 + body.length);
+    head.set(FORMAT_MAGIC);
+    head[4] = formatVersion;
+    new DataView(head.buffer).setUint32(5, body.length);
+    head.set(body, 9);
+    return head;
+}
+
+// prefix(7) || counter(4, big-endian) || final flag(1)
+function segmentNonce(prefix, counter, final) {
+    const nonce = new Uint8Array(12);
+    nonce.set(prefix);
+    new DataView(nonce.buffer).setUint32(NONCE_PREFIX_SIZE, counter);
+    nonce[11] = final ? 1 : 0;
+    return nonce;
+}
+
+// Read a Blob in slices, so a large file is never in memory at once
+async function* readBlocks(blob) {
+    for (let offset = 0; offset < blob.size; offset += READ_SIZE) {
+        yield new Uint8Array(await blob.slice(offset, offset + READ_SIZE).arrayBuffer());
+    }
+}
+
+// Read a stream's chunks, e.g. the output of a CompressionStream
+async function* readStream(stream) {
+    const reader = stream.getReader();
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+            return;
+        }
+        yield value;
+    }
+}
+
+// Regroup blocks into [segment, final] pairs; as on the server, the last segment is final
+// and empty input still gives one (empty) final segment
+async function* segments(blocks, segmentSize) {
+    let held = null;
+    let buffer = new Uint8Array(segmentSize);
+    let filled = 0;
+    for await (const block of blocks) {
+        for (let offset = 0; offset < block.length; ) {
+            const n = Math.min(segmentSize - filled, block.length - offset);
+            buffer.set(block.subarray(offset, offset + n), filled);
+            filled += n;
+            offset += n;
+            if (filled === segmentSize) {
+                if (held) {
+                    yield [held, false];
+                }
+                held = buffer;
+                buffer = new Uint8Array(segmentSize);
+                filled = 0;
+            }
+        }
+    }
+    if (held && filled === 0) {
+        yield [held, true];
+        return;
+    }
+    if (held) {
+        yield [held, false];
+    }
+    yield [buffer.subarray(0, filled), true];
+}
+
+// AES-GCM each segment (ciphertext || 16-byte tag) under its counter nonce, numbering from firstSegment;
+// with last = false (a chunk before the end of the file) no segment is sealed final
+async function* sealSegments(pairs, key, prefix, firstSegment = 0, last = true) {
+    let counter = firstSegment;
+    for await (const [segment, final] of pairs) {
+        const iv = segmentNonce(prefix, counter++, final && last);
+        yield new Uint8Array(await crypto.subtle.encrypt({ name: 'AES-GCM', iv }, key, segment));
+    }
+}
+
+// Whether the file's first bytes shrink enough under deflate to be worth compressing
+async function worthCompressing(file) {
+    const sample = file.slice(0, COMPRESSION_PROBE_SIZE);
+    const compressed = await new Response(sample.stream().pipeThrough(new CompressionStream('deflate'))).arrayBuffer();
+    return compressed.byteLength <= sample.size * COMPRESSION_PROBE_RATIO;
+}
+
+// Container parameters and a key for a browser-encrypted upload:
+// {header, key (the CryptoKey sealing segments), prefix, secrets (metadata fields kept in the page)}
+async function clientEncryption(keyInput) {
+    const response = await fetch('/client_encryption');
+    const config = await response.json();
+    const userKey = keyInput ? parseKey(keyInput) : crypto.getRandomValues(new Uint8Array(32));
+    const prefix = crypto.getRandomValues(new Uint8Array(NONCE_PREFIX_SIZE));
+    const header = { cipher: config.cipher, segment_size: config.segment_size, nonce: toBase64(prefix) };
+    let key;
+    if (config.envelope) {
+        // A random data key seals the segments; the header carries it wrapped (AES-KW) under the user's key
+        key = await crypto.subtle.generateKey({ name: 'AES-GCM', length: 256 }, true, ['encrypt']);
+        const wrappingKey = await crypto.subtle.importKey('raw', userKey, 'AES-KW', false, ['wrapKey']);
+        header.wrapped_key = toBase64(new Uint8Array(await crypto.subtle.wrapKey('raw', key, wrappingKey, 'AES-KW')));
+    } else {
+        key = await crypto.subtle.importKey('raw', userKey, 'AES-GCM', false, ['encrypt']);
+    }
+    return {
+        config, header, key, prefix,
+        secrets: { key_hex: toHex(userKey), key_base64: toBase64(userKey) }
+    };
+}
+
+// Compress and encrypt a file into an upload session as it is read. The sealed size is only
+// known once the compressor is done, so chunks are cut in order from one compressed stream,
+// at most UPLOAD_PARALLELISM of them are in flight, and the one with the final segment says so.
+async function uploadCompressed(file, formData, onProgress, client) {
+    const session = await startUpload(file, formData, client, false);
+    if (session.error) {
+        return session;
+    }
+    
+    let read = 0;
+    const counter = new TransformStream({
+        transform(block, controller) {
+            read += block.length;
+            controller.enqueue(block);
+        }
+    });
+    const blocks = readStream(file.stream().pipeThrough(counter).pipeThrough(new CompressionStream('deflate')));
+    const segmentsPerChunk = session.chunk_size / client.header.segment_size;
+    const inFlight = new Set();
+    let failure = null;
+    
+    async function send(index, parts, final) {
+        while (inFlight.size >= UPLOAD_PARALLELISM) {
+            await Promise.race(inFlight);
+        }
+        if (failure) {
+            throw failure;
+        }
+        const upload = putChunk(session, index, new Blob(parts), final)
+            .then(() => onProgress(file.size ? read / file.size : 1), error => { failure = failure || error; })
+            .finally(() => inFlight.delete(upload));
+        inFlight.add(upload);
+    }
+    try {
+        let index = 0;
+        let parts = [];
+        for await (const sealed of sealSegments(segments(blocks, client.header.segment_size), client.key, client.prefix)) {
+            if (parts.length === segmentsPerChunk) {
+                await send(index++, parts, false);
+                parts = [];
+            }
+            parts.push(sealed);
+        }
+        await send(index, parts, true);
+        await Promise.all(inFlight);
+        if (failure) {
+            throw failure;
+        }
+    } catch (error) {
+        fetch(`/uploads/${session.id}`, { method: 'DELETE' }).catch(() => {});
+        return { error: `${error.message} (submit again to start the upload over)` };
+    }
+    return finalizeUpload(session, file, formData);
+}
+
+// Encrypt in the browser and upload only the ciphertext, chunk by chunk through an upload session
+// (compressed with deflate/zlib if asked and worthwhile); resolves to the same JSON as /encrypt,
+// with the key added to the metadata
+async function encryptInBrowser(file, formData, onProgress) {
+    const client = await clientEncryption(formData.get('key'));
+    if (formData.get('compress') && await worthCompressing(file)) {
+        client.header.compression = client.config.compression;
+        return uploadCompressed(file, formData, onProgress, client);
+    }
+    return uploadResumable(file, formData, onProgress, client);
+}
+
 // Encryption form handler
 document.getElementById('encryptForm').addEventListener('submit', async function(e) {
     e.preventDefault();
@@ -179,18 +545,38 @@ document.getElementById('encryptForm').addEventListener('submit', async function
         formData.delete('key');
     }
     
+    // The server encrypts the upload as it streams in, so the file must come last
+    const file = formData.get('file');
+    formData.delete('file');
+    formData.append('file', file);
+    
     setLoading(submitButton, true);
     resultDiv.style.display = 'none';
     
     try {
-        const response = await fetch('/encrypt', {
-            method: 'POST',
-            body: formData
-        });
-        
-        const data = await response.json();
+        let data;
+        if (document.getElementById('clientSide').checked) {
+            data = await encryptInBrowser(file, formData, progress => {
+                submitButton.textContent = `Uploading... ${Math.floor(progress * 100)}%`;
+            });
+        } else if (file.size >= RESUMABLE_THRESHOLD && !formData.get('compress')) {
+            data = await uploadResumable(file, formData, progress => {
+                submitButton.textContent = `Uploading... ${Math.floor(progress * 100)}%`;
+            });
+        } else {
+            const response = await fetch('/encrypt', {
+                method: 'POST',
+                body: formData
+            });
+            data = await response.json();
+        }
         
         if (data.success) {
+            // The server's copy of a browser-encrypted file's metadata has no key: offer the one built here
+            const clientEncrypted = data.metadata.client_encrypted;
+            const metadataUrl = clientEncrypted ?
+                URL.createObjectURL(new Blob([JSON.stringify(data.metadata, null, 2)], { type: 'application/json' })) :
+                `/download/${data.metadata_file}`;
             resultDiv.className = 'result success';
             resultDiv.innerHTML = `
                 <h3>✅ Encryption Successful!</h3>
@@ -217,12 +603,14 @@ document.getElementById('encryptForm').addEventListener('submit', async function
                 
                 <div class="warning">
                     <strong>⚠️ SAVE THIS KEY!</strong><br>
-                    You need this key to decrypt your file. It's also in the metadata file.
+                    You need this key to decrypt your file. ${clientEncrypted ?
+                        'It was never sent to the server: only the metadata file downloaded from this page contains it.' :
+                        "It's also in the metadata file."}
                 </div>
                 
                 <div class="download-buttons">
                     <a href="/download/${data.encrypted_file}" class="download-link">📥 Download Encrypted File</a>
-                    <a href="/download/${data.metadata_file}" class="download-link">📥 Download Metadata</a>
+                    <a href="${metadataUrl}" download="${data.metadata_file}" class="download-link">📥 Download Metadata</a>
                 </div>
             `;
         } else {
@@ -255,6 +643,26 @@ function copyToClipboard(text, button) {
     });
 }
 
+function isJsonResponse(response) {
+    return (response.headers.get('Content-Type') || '').includes('application/json');
+}
+
+// Save a streamed response as a file, named from its Content-Disposition header
+async function saveDownload(response) {
+    const disposition = response.headers.get('Content-Disposition') || '';
+    const match = disposition.match(/filename="?([^";]+)"?/);
+    const filename = match ? match[1] : 'decrypted_file';
+    const url = URL.createObjectURL(await response.blob());
+    const link = document.createElement('a');
+    link.href = url;
+    link.download = filename;
+    document.body.appendChild(link);
+    link.click();
+    link.remove();
+    setTimeout(() => URL.revokeObjectURL(url), 1000);
+    return filename;
+}
+
 // Manual decryption form handler
 document.getElementById('decryptManualForm').addEventListener('submit', async function(e) {
     e.preventDefault();
@@ -271,6 +679,18 @@ document.getElementById('decryptManualForm').addEventListener('submit', async fu
             body: formData
         });
         
+        // With "stream" ticked, the response body is the decrypted file itself
+        if (response.ok && !isJsonResponse(response)) {
+            const filename = await saveDownload(response);
+            resultDiv.className = 'result success';
+            resultDiv.innerHTML = `
+                <h3>✅ Decryption Successful!</h3>
+                <p><strong>Decrypted file:</strong> ${filename} (sent straight to your browser, nothing was stored on the server)</p>
+            `;
+            resultDiv.style.display = 'block';
+            return;
+        }
+        
         const data = await response.json();
         
         if (data.success) {
@@ -310,6 +730,18 @@ document.getElementById('decryptMetaForm').addEventListener('submit', async func
             body: formData
         });
         
+        // With "stream" ticked, the response body is the decrypted file itself
+        if (response.ok && !isJsonResponse(response)) {
+            const filename = await saveDownload(response);
+            resultDiv.className = 'result success';
+            resultDiv.innerHTML = `
+                <h3>✅ Decryption Successful!</h3>
+                <p><strong>Decrypted file:</strong> ${filename} (sent straight to your browser, nothing was stored on the server)</p>
+            `;
+            resultDiv.style.display = 'block';
+            return;
+        }
+        
         const data = await response.json();
         
         if (data.success) {
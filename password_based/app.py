@@ -1,124 +1,513 @@
-from flask import Flask, render_template, request, send_file, jsonify
+from flask import Flask, Response, g, render_template, request, send_file, jsonify, url_for
+from werkzeug.datastructures import Range
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, Data, Epilogue, Field, File
+import io
 import os
+import mimetypes
 import json
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.backends import default_backend
-import base64
+import zipfile
+import time
+from typing import Iterable
+from cryptography.exceptions import InvalidTag
 import secrets
+from contextlib import nullcontext
+from encryptor import (CLIENT_CIPHER, CLIENT_COMPRESSION, COMPRESSION, ERRORS, FORMAT_VERSION, KDF_DERIVATION_MEMORY, KDF_MEMORY_BUDGET,
+                       KDF_POOL_WORKERS, KEY_CACHE_SIZE, STAGE_SECONDS, STREAM_CHUNK_SIZE, DerivedKeyCache, FileEncryptor, KDFBusy, KDFMemoryLimiter,
+                       KDFPool, error_type, metrics, select_cipher_suite, select_kdf, select_kdf_limits)
+from catalog import ArtifactNameError, Catalog, SIDECAR_SUFFIX
+from credentials import CredentialBox, server_secret
+from sessions import UploadSessions
+from jobs import JobQueue, JobQueueFull
+from profiling import Profiler
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Stream /encrypt uploads straight from the request body into the cipher
+app.config['STREAM_UPLOADS'] = os.environ.get('STREAM_UPLOADS', '1') != '0'
+app.config['MAX_FORM_MEMORY_SIZE'] = 500 * 1024  # limit for non-file form fields
+# Files are processed in fixed-size segments, so memory no longer scales with upload size
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 4 * 1024 * 1024 * 1024))  # 4GB default
 
 # Create upload directory if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-class FileEncryptor:
+# Outputs are recorded in a SQLite catalog; the oldest are evicted beyond
+# CATALOG_MAX_AGE seconds or CATALOG_MAX_BYTES in total (0 keeps everything)
+app.config['CATALOG_DATABASE'] = os.environ.get('CATALOG_DATABASE',
+                                                os.path.join(app.config['UPLOAD_FOLDER'], 'catalog.db'))
+app.config['CATALOG_MAX_AGE'] = float(os.environ.get('CATALOG_MAX_AGE', 0))
+app.config['CATALOG_MAX_BYTES'] = int(os.environ.get('CATALOG_MAX_BYTES', 0))
+app.config['CATALOG_PAGE_SIZE'] = 50
+
+# Resumable uploads (/uploads): chunks are encrypted into place as they arrive, and
+# sessions idle for UPLOAD_SESSION_TTL seconds are expired with their partial output
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))  # rounded to whole segments
+app.config['UPLOAD_SESSION_TTL'] = float(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+app.config['RESUMABLE_MAX_SIZE'] = int(os.environ.get('RESUMABLE_MAX_SIZE', 64 * 1024 * 1024 * 1024))  # 64GB default
+
+# Background jobs (/encrypt and /decrypt with ?async=true): the upload is stored and answered
+# with 202, then one of JOB_WORKERS threads per server process does the work (0 leaves the
+# queue to other processes). Finished jobs are kept for JOB_TTL seconds; a running job not
+# heard from for JOB_STALE_AFTER seconds was interrupted and is run again.
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('JOB_QUEUE_SIZE', 100))
+app.config['JOB_TTL'] = float(os.environ.get('JOB_TTL', 24 * 3600))
+app.config['JOB_STALE_AFTER'] = float(os.environ.get('JOB_STALE_AFTER', 300))
+
+# Opt-in profiling of PROFILE_ENDPOINTS (and the background jobs they start): requests sending
+# X-Profile-Token: <PROFILE_TOKEN>, plus a PROFILE_SAMPLE_RATE fraction of all of them, are
+# dumped to PROFILE_DIR as pstats or collapsed stacks, keeping at most PROFILE_MAX_BYTES
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+app.config['PROFILE_MAX_BYTES'] = int(os.environ.get('PROFILE_MAX_BYTES', 100 * 1024 * 1024))
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+app.config['PROFILE_FORMAT'] = os.environ.get('PROFILE_FORMAT', 'pstats')  # or 'collapsed'
+app.config['PROFILE_ENDPOINTS'] = os.environ.get('PROFILE_ENDPOINTS',
+                                                 'encrypt_file,decrypt_file,download_file').split(',')
+
+# Prometheus metrics, served at /metrics
+REQUEST_SECONDS = metrics.histogram('fileenc_request_seconds', 'Request handling time by endpoint', ('endpoint', 'status'))
+IN_FLIGHT = metrics.gauge('fileenc_in_flight_requests', 'Requests currently being handled', ('endpoint',))
+CIPHER_INFO = metrics.gauge('fileenc_cipher_suite', 'Cipher suite used for new encryptions (value 1)', ('suite',),
+                            aggregate='max')
+metrics.gauge('fileenc_upload_folder_bytes', 'Bytes of cataloged outputs in UPLOAD_FOLDER',
+              function=lambda: catalog.usage()[0], aggregate='local')
+metrics.gauge('fileenc_upload_folder_files', 'Cataloged outputs in UPLOAD_FOLDER',
+              function=lambda: catalog.usage()[1], aggregate='local')
+metrics.gauge('fileenc_jobs_queued', 'Background jobs waiting for a worker',
+              function=lambda: job_queue.counts().get('queued', 0), aggregate='local')
+metrics.gauge('fileenc_jobs_running', 'Background jobs being processed',
+              function=lambda: job_queue.counts().get('running', 0), aggregate='local')
+
+# Initialize encryptor and artifact catalog
+key_cache = DerivedKeyCache() if KEY_CACHE_SIZE > 0 else None
+kdf_pool = KDFPool() if KDF_POOL_WORKERS > 0 else None
+kdf_limiter = KDFMemoryLimiter() if KDF_MEMORY_BUDGET > 0 else None
+kdf = select_kdf(max_memory=KDF_DERIVATION_MEMORY)
+encryptor = FileEncryptor(key_cache=key_cache, kdf_pool=kdf_pool, cipher=select_cipher_suite(), kdf=kdf,
+                          kdf_limiter=kdf_limiter, kdf_limits=select_kdf_limits(kdf, max_memory=KDF_DERIVATION_MEMORY))
+CIPHER_INFO.set(1, suite=encryptor.cipher)
+
+if kdf_pool is not None:
+    metrics.gauge('fileenc_kdf_pool_pending', 'Key derivations running or queued on the KDF pool',
+                  function=lambda: kdf_pool.stats()['pending'])
+if kdf_limiter is not None:
+    metrics.gauge('fileenc_kdf_memory_bytes', 'Memory reserved by memory-hard key derivations in flight',
+                  function=lambda: kdf_limiter.stats()['in_use_bytes'])
+if key_cache is not None:
+    metrics.gauge('fileenc_key_cache_entries', 'Derived keys held in the key cache',
+                  function=lambda: key_cache.stats()['entries'])
+
+catalog = Catalog(app.config['CATALOG_DATABASE'], app.config['UPLOAD_FOLDER'],
+                  app.config['CATALOG_MAX_AGE'], app.config['CATALOG_MAX_BYTES'])
+credentials = CredentialBox(server_secret())
+upload_sessions = UploadSessions(catalog, credentials, app.config['UPLOAD_SESSION_TTL'])
+job_queue = JobQueue(catalog, credentials, app.config['JOB_WORKERS'], app.config['JOB_QUEUE_SIZE'],
+                     app.config['JOB_TTL'], app.config['JOB_STALE_AFTER'])
+profiler = Profiler(app.config['PROFILE_DIR'], app.config['PROFILE_MAX_BYTES'], app.config['PROFILE_SAMPLE_RATE'],
+                    app.config['PROFILE_TOKEN'], app.config['PROFILE_FORMAT'])
+
+def upload_status(session: dict) -> dict:
+    """Client view of a resumable upload (no key material)"""
+    received = set(session['received'])
+    resume_from = next((index for index in range(session['chunks']) if index not in received), session['chunks'])
+    return {
+        'id': session['id'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'chunks': session['chunks'],
+        'received': session['received'],
+        'offset': resume_from * session['chunk_size'] if session['size'] is None else
+                  min(resume_from * session['chunk_size'], session['size']),
+        'expires': session['updated'] + app.config['UPLOAD_SESSION_TTL'] if app.config['UPLOAD_SESSION_TTL'] else None
+    }
+
+def partial_path() -> str:
+    """Fresh hidden path in UPLOAD_FOLDER for a temporary or not yet published file"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], f'.{secrets.token_hex(8)}.part')
+
+def read_limited(stream, limit: int, size: int) -> Iterable[bytes]:
+    """Blocks of up to size bytes from stream, stopping after limit + 1 bytes.
+    
+    One byte past the limit is enough to tell a body is too long, so a request without
+    a Content-Length (chunked transfer encoding) cannot make the server read all of it.
+    """
+    remaining = limit + 1
+    while remaining > 0:
+        block = stream.read(min(size, remaining))
+        if not block:
+            return
+        remaining -= len(block)
+        yield block
+
+def request_owner() -> str:
+    """Owner recorded in the catalog: the authenticated user if a proxy sets one, else the client address"""
+    return request.remote_user or request.remote_addr
+
+def requested_compression(form) -> str:
+    """Compression algorithm for an upload that opted in with compress=true, else None"""
+    return COMPRESSION if form.get('compress') == 'true' else None
+
+def encrypted_name(form, filename: str) -> str:
+    """Output name for an encrypted upload: output_name if given, else the upload's name, ending in .enc"""
+    output_name = form.get('output_name')
+    if not output_name:
+        return catalog.check_name(filename + '.enc')
+    return catalog.check_name(output_name if output_name.endswith('.enc') else output_name + '.enc')
+
+def async_requested() -> bool:
+    """Whether the client asked for a background job (?async=true, known before the body is read)"""
+    return request.args.get('async') == 'true'
+
+def job_status(job: dict) -> dict:
+    """Client view of a background job (its parameters hold the password and are never shown)"""
+    status = {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'size': job['size'],
+        'progress': job['progress'],
+        'percent': round(100 * job['progress'] / job['size'], 1) if job['size'] else 100.0 * (job['status'] == 'done'),
+        'attempts': job['attempts'],
+        'created': job['created'],
+        'updated': job['updated']
+    }
+    if job['error']:
+        status['error'] = job['error']
+    if job['result']:
+        status['result'] = job['result']
+        output_name = job['result'].get('encrypted_file') or job['result'].get('decrypted_file')
+        status['download_url'] = url_for('download_file', filename=output_name)
+    return status
+
+def kdf_busy_response(error: KDFBusy):
+    """503 with Retry-After when the KDF queue or memory budget is full"""
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def job_queue_full(message: str = 'The job queue is full, please retry later'):
+    return jsonify({'error': message}), 503, {'Retry-After': '30'}
+
+def submit_job(kind: str, params: dict, input_path: str):
+    """Queue a job for an upload stored at input_path and answer 202 with its status URL"""
+    # A profiled request has its job profiled too
+    params['profile'] = g.get('profile') is not None
+    try:
+        job = job_queue.submit(kind, params, input_path, request_owner())
+    except JobQueueFull as e:
+        os.remove(input_path)
+        return job_queue_full(str(e))
+    status_url = url_for('job_progress', job_id=job['id'])
+    return jsonify({'success': True, 'job_id': job['id'], 'status_url': status_url, **job_status(job)}), 202, \
+        {'Location': status_url}
+
+def process_job(job: dict, progress) -> dict:
+    params = job['params']
+    input_path = job_queue.path(job['id'], 'in')
+    output_path = job_queue.path(job['id'], 'out')
+    output_name = params['output_name']
+    if job['kind'] == 'encrypt':
+        metadata = encryptor.encrypt_file(input_path, output_path, params['password'], params['compression'],
+                                          progress=progress)
+        metadata['input_file'] = params['filename']
+        metadata['output_file'] = output_name
+        with STAGE_SECONDS.time(stage='metadata'):
+            catalog.publish(output_path, output_name, 'encrypted', metadata, job['owner'])
+        return {'encrypted_file': output_name, 'metadata_file': output_name + SIDECAR_SUFFIX, 'metadata': metadata}
+    if not encryptor.decrypt_file(input_path, output_path, params['password'], params['salt'], params['nonce'],
+                                  progress):
+        raise ValueError('Decryption failed. Please check your files and try again.')
+    catalog.publish(output_path, output_name, 'decrypted', owner=job['owner'])
+    return {'decrypted_file': output_name}
+
+def run_job(job: dict, progress) -> dict:
+    """Job worker: encrypt or decrypt a stored upload and publish the output to the catalog.
+    
+    A job finding the KDF busy waits and tries again rather than failing like a request would.
+    """
+    with profiler.profiling(f"job_{job['kind']}") if job['params'].get('profile') else nullcontext():
+        while True:
+            try:
+                return process_job(job, progress)
+            except KDFBusy as e:
+                job_queue.report(job['id'], 0)
+                time.sleep(e.retry_after)
+
+if app.config['JOB_WORKERS']:
+    job_queue.start(run_job)
+
+def stream_multipart_upload(file_field: str = 'file'):
+    """Incrementally parse a multipart/form-data body from request.stream.
+    
+    Returns (fields, filename, chunks). `fields` holds the form fields sent before
+    the file part; `chunks` yields the file data as it arrives and, once exhausted,
+    adds any fields sent after the file to `fields`.
+    """
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise ValueError("Expected a multipart/form-data upload")
+    
+    decoder = MultipartDecoder(boundary.encode('latin-1'), app.config['MAX_FORM_MEMORY_SIZE'])
+    
+    def events():
+        while True:
+            event = decoder.next_event()
+            if event is NEED_DATA:
+                decoder.receive_data(request.stream.read(STREAM_CHUNK_SIZE) or None)
+            elif isinstance(event, Epilogue):
+                return
+            else:
+                yield event
+    
+    def collect_fields(parts, fields):
+        # Accumulate small form fields until the next file part (or the end)
+        name, value = None, bytearray()
+        for event in parts:
+            if isinstance(event, File):
+                return event
+            if isinstance(event, Field):
+                name, value = event.name, bytearray()
+            elif isinstance(event, Data) and name is not None:
+                value += event.data
+                if not event.more_data:
+                    fields[name] = value.decode('utf-8')
+                    name = None
+        return None
+    
+    parts = events()
+    fields = {}
+    while True:
+        part = collect_fields(parts, fields)
+        if part is None:
+            return fields, None, iter(())
+        if part.name == file_field:
+            break
+    
+    def file_chunks():
+        for event in parts:
+            if isinstance(event, Data):
+                if event.data:
+                    yield event.data
+                if not event.more_data:
+                    break
+        collect_fields(parts, fields)
+    
+    return fields, part.filename, file_chunks()
+
+
+class ZipStream(io.RawIOBase):
+    """Unseekable sink that zipfile writes into and a response generator drains.
+    
+    zipfile falls back to data descriptors on unseekable output, so archives are
+    produced on the fly without holding them in memory or on disk.
+    """
     def __init__(self):
-        self.backend = default_backend()
-    
-    def derive_key(self, password: str, salt: bytes) -> bytes:
-        """Derive AES key from password using PBKDF2"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-            backend=self.backend
-        )
-        key = kdf.derive(password.encode())
-        return key
-    
-    def encrypt_file(self, input_path: str, output_path: str, password: str) -> dict:
-        """Encrypt file using AES-GCM"""
-        try:
-            # Generate salt and nonce
-            salt = secrets.token_bytes(16)
-            nonce = secrets.token_bytes(12)
-            
-            # Derive key
-            key = self.derive_key(password, salt)
-            
-            # Initialize AES-GCM
-            aesgcm = AESGCM(key)
-            
-            # Read file content
-            with open(input_path, 'rb') as f:
-                plaintext = f.read()
-            
-            # Encrypt data
-            ciphertext = aesgcm.encrypt(nonce, plaintext, None)
-            
-            # Write encrypted file (salt + nonce + ciphertext)
-            with open(output_path, 'wb') as f:
-                f.write(salt)
-                f.write(nonce)
-                f.write(ciphertext)
-            
-            # Return metadata
-            return {
-                'input_file': os.path.basename(input_path),
-                'output_file': os.path.basename(output_path),
-                'salt': base64.b64encode(salt).decode('utf-8'),
-                'nonce': base64.b64encode(nonce).decode('utf-8'),
-                'password': password  # Store password in metadata
-            }
-        except Exception as e:
-            print(f"Encryption error: {e}")
-            raise e
+        super().__init__()
+        self.buffer = bytearray()
+        self.offset = 0
+    
+    def writable(self) -> bool:
+        return True
     
-    def decrypt_file(self, input_path: str, output_path: str, password: str, salt_b64: str = None, nonce_b64: str = None) -> bool:
-        """Decrypt file using AES-GCM"""
+    def write(self, data) -> int:
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        return self.offset
+    
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def unique_name(name: str, used: set) -> str:
+    """Make an archive member name unique by adding a counter before the extension"""
+    base, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in used:
+        candidate = f"{base} ({n}){ext}"
+        n += 1
+    used.add(candidate)
+    return candidate
+
+def take_uploads(field: str) -> list:
+    """Detach uploaded files from the request as (filename, stream) pairs.
+    
+    The request closes its files when the view returns, but streamed responses read
+    them afterwards; archive_response closes the detached streams instead.
+    """
+    uploads = []
+    for file in request.files.getlist(field):
+        if file.filename:
+            uploads.append((file.filename, file.stream))
+            file.stream = io.BytesIO()
+    return uploads
+
+def archive_response(entries: Iterable[tuple], manifest: dict, archive_name: str, uploads: list) -> Response:
+    """Stream a zip of (name, blocks) entries followed by manifest.json.
+    
+    `manifest['files']` is filled in while streaming, by the entry generators.
+    """
+    def generate():
+        sink = ZipStream()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+            for name, blocks in entries:
+                with zf.open(name, 'w', force_zip64=True) as dst:
+                    for block in blocks:
+                        dst.write(block)
+                        yield sink.drain()
+                yield sink.drain()
+            zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+        yield sink.drain()
+    
+    response = Response(generate(), mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename="{archive_name}"'})
+    response.call_on_close(lambda: [stream.close() for _, stream in uploads])
+    return response
+
+def decrypt_response(password: str, salt_b64: str, nonce_b64: str, output_name: str) -> Response:
+    """Stream the uploaded encrypted_file back decrypted, so no plaintext touches the disk.
+    
+    Segments are authenticated as they are sent. If one fails mid-stream the body ends
+    short of Content-Length, which clients report as an incomplete download.
+    """
+    _, src = take_uploads('encrypted_file')[0]
+    try:
+        plaintext, size = encryptor.open_plaintext(src, password, salt_b64, nonce_b64, preflight=True)
+    except Exception as e:
+        src.close()
+        ERRORS.inc(type=error_type(e))
+        if isinstance(e, KDFBusy):
+            raise
+        print(f"Decryption error: {e!r}")
+        return jsonify({'error': 'Decryption failed. Please check your files and try again.'}), 400
+    
+    def generate():
         try:
-            # Read encrypted file
-            with open(input_path, 'rb') as f:
-                data = f.read()
-            
-            if salt_b64 and nonce_b64:
-                # Use provided salt and nonce from metadata
-                salt = base64.b64decode(salt_b64)
-                nonce = base64.b64decode(nonce_b64)
-                # The file still contains salt+nonce+ciphertext, so skip first 28 bytes
-                if len(data) < 28:
-                    raise ValueError("File too short to contain salt and nonce")
-                ciphertext = data[28:]  # Skip salt (16 bytes) + nonce (12 bytes)
-                print(f"Metadata method - Salt from metadata: {len(salt)} bytes, Nonce from metadata: {len(nonce)} bytes, Ciphertext: {len(ciphertext)} bytes")
-            else:
-                # Extract salt and nonce from file (manual method)
-                if len(data) < 28:  # 16 bytes salt + 12 bytes nonce
-                    raise ValueError("File too short to contain salt and nonce")
-                salt = data[:16]
-                nonce = data[16:28]
-                ciphertext = data[28:]
-                print(f"Manual method - Salt from file: {len(salt)} bytes, Nonce from file: {len(nonce)} bytes, Ciphertext: {len(ciphertext)} bytes")
-            
-            # Derive key
-            key = self.derive_key(password, salt)
-            
-            # Initialize AES-GCM and decrypt
-            aesgcm = AESGCM(key)
-            plaintext = aesgcm.decrypt(nonce, ciphertext, None)
-            
-            # Write decrypted file
-            with open(output_path, 'wb') as f:
-                f.write(plaintext)
-            
-            return True
+            yield from plaintext
         except Exception as e:
-            print(f"Decryption error: {e}")
-            return False
+            print(f"Decryption error: {e!r}")
+            ERRORS.inc(type=error_type(e))
+            raise
+    
+    response = Response(generate(), mimetype=mimetypes.guess_type(output_name)[0] or 'application/octet-stream')
+    response.headers.set('Content-Disposition', 'attachment', filename=output_name)
+    response.headers['Cache-Control'] = 'no-store'
+    if size is not None:
+        response.content_length = size
+    response.call_on_close(src.close)
+    return response
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.metrics_endpoint = request.endpoint or 'unmatched'
+    IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are timed up to the first byte
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_started,
+                            endpoint=g.metrics_endpoint, status=str(response.status_code))
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if 'metrics_endpoint' in g:
+        IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
+
+def finish_profile(profile, endpoint: str, owner: str):
+    name = profiler.finish(profile, endpoint)
+    print(f"Profile written: {name} (owner {owner})")
+
+@app.before_request
+def start_request_profile():
+    # All that profiling costs when it is off
+    if not profiler.enabled or request.endpoint not in app.config['PROFILE_ENDPOINTS']:
+        return
+    if profiler.wanted(request.headers.get('X-Profile-Token')):
+        profile = profiler.start()
+        if profile is not None:
+            g.profile = profile
+            profile.enable()
+
+@app.after_request
+def hand_off_request_profile(response):
+    """Finish the request's profile, or for a streamed response, carry it on while the body is produced"""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.disable()
+    endpoint, owner = request.endpoint, request_owner()
+    if not response.is_streamed:
+        finish_profile(profile, endpoint, owner)
+        return response
+    
+    body = response.response
+    
+    def profiled():
+        blocks = iter(body)
+        while True:
+            profile.enable()
+            try:
+                block = next(blocks, None)
+            finally:
+                profile.disable()
+            if block is None:
+                return
+            yield block
+    
+    def close():
+        if hasattr(body, 'close'):
+            body.close()
+        finish_profile(profile, endpoint, owner)
+    
+    response.response = profiled()
+    # send_file's passthrough would hand the body to the server without Response.close
+    response.direct_passthrough = False
+    response.call_on_close(close)
+    return response
+
+@app.teardown_request
+def finish_request_profile(error=None):
+    # A request that failed before its response was made
+    profile = g.pop('profile', None)
+    if profile is not None:
+        finish_profile(profile, request.endpoint, request_owner())
 
-# Initialize encryptor
-encryptor = FileEncryptor()
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/kdf_stats', methods=['GET'])
+def kdf_stats():
+    """Report the KDF in use, key-derivation cache counters, KDF pool queue depth / wait times and memory use"""
+    return jsonify({
+        'kdf': encryptor.kdf,
+        'key_cache': key_cache.stats() if key_cache is not None else None,
+        'pool': kdf_pool.stats() if kdf_pool is not None else None,
+        'memory': kdf_limiter.stats() if kdf_limiter is not None else None
+    })
+
 @app.route('/encrypt', methods=['POST'])
 def encrypt_file():
+    if async_requested() and job_queue.full():
+        return job_queue_full()
+    if app.config['STREAM_UPLOADS'] and request.mimetype == 'multipart/form-data':
+        return encrypt_upload_stream()
+    
     try:
         # Get uploaded file
         if 'file' not in request.files:
@@ -134,43 +523,355 @@ def encrypt_file():
             return jsonify({'error': 'Password is required'}), 400
         
         # Get output filename
-        output_name = request.form.get('output_name')
-        if not output_name:
-            output_name = file.filename + '.enc'
-        elif not output_name.endswith('.enc'):
-            output_name += '.enc'
+        output_name = encrypted_name(request.form, file.filename)
         
         # Save uploaded file temporarily
-        input_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(input_path)
-        
-        # Encrypt file
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_name)
-        metadata = encryptor.encrypt_file(input_path, output_path, password)
+        input_path = partial_path()
+        with STAGE_SECONDS.time(stage='save'):
+            file.save(input_path)
         
-        # Create metadata file
-        meta_filename = output_name + '.meta'
-        meta_path = os.path.join(app.config['UPLOAD_FOLDER'], meta_filename)
+        if async_requested():
+            return submit_job('encrypt', {'filename': file.filename, 'output_name': output_name, 'password': password,
+                                          'compression': requested_compression(request.form)}, input_path)
         
-        with open(meta_path, 'w') as f:
-            json.dump(metadata, f, indent=2)
+        # Encrypt file
+        output_path = partial_path()
+        metadata = encryptor.encrypt_file(input_path, output_path, password, requested_compression(request.form))
+        metadata['input_file'] = file.filename
+        metadata['output_file'] = output_name
         
         # Clean up input file
         if os.path.exists(input_path):
             os.remove(input_path)
         
+        # Publish the output with its metadata (served as <output>.meta)
+        meta_filename = output_name + SIDECAR_SUFFIX
+        with STAGE_SECONDS.time(stage='metadata'):
+            catalog.publish(output_path, output_name, 'encrypted', metadata, request_owner())
+        
+        return jsonify({
+            'success': True,
+            'encrypted_file': output_name,
+            'metadata_file': meta_filename,
+            'metadata': metadata
+        })
+    
+    except KDFBusy as e:
+        return kdf_busy_response(e)
+    except ArtifactNameError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def encrypt_upload_stream():
+    """Encrypt the upload as it arrives, so no plaintext is written to UPLOAD_FOLDER"""
+    output_path = None
+    try:
+        fields, filename, chunks = stream_multipart_upload('file')
+        if not filename:
+            return jsonify({'error': 'No file selected'}), 400
+        
+        if async_requested():
+            return submit_upload_job(fields, filename, chunks)
+        
+        # The password and compress fields must arrive before the file
+        password = fields.get('password')
+        if not password:
+            return jsonify({'error': 'Password is required (send it before the file)'}), 400
+        compression = requested_compression(fields)
+        
+        # Encrypt into a partial file; the output name may follow the file part
+        output_path = partial_path()
+        metadata = encryptor.encrypt_stream(chunks, output_path, password, filename, request.content_length,
+                                            compression=compression)
+        
+        if compression is None and requested_compression(fields):
+            return jsonify({'error': 'The compress field must be sent before the file'}), 400
+        
+        # Get output filename
+        output_name = encrypted_name(fields, filename)
+        
+        metadata['output_file'] = output_name
+        
+        # Publish the output with its metadata (served as <output>.meta)
+        meta_filename = output_name + SIDECAR_SUFFIX
+        with STAGE_SECONDS.time(stage='metadata'):
+            catalog.publish(output_path, output_name, 'encrypted', metadata, request_owner())
+        
+        return jsonify({
+            'success': True,
+            'encrypted_file': output_name,
+            'metadata_file': meta_filename,
+            'metadata': metadata
+        })
+    
+    except KDFBusy as e:
+        return kdf_busy_response(e)
+    except ArtifactNameError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if output_path and os.path.exists(output_path):
+            os.remove(output_path)
+
+def submit_upload_job(fields: dict, filename: str, chunks: Iterable[bytes]):
+    """Store a streamed upload for a background encrypt job (fields may come before or after the file)"""
+    input_path = partial_path()
+    try:
+        with STAGE_SECONDS.time(stage='save'), open(input_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        output_name = encrypted_name(fields, filename)
+    except Exception:
+        os.remove(input_path)
+        raise
+    if not fields.get('password'):
+        os.remove(input_path)
+        return jsonify({'error': 'Password is required'}), 400
+    return submit_job('encrypt', {'filename': filename, 'output_name': output_name,
+                                  'password': fields['password'], 'compression': requested_compression(fields)},
+                      input_path)
+
+@app.route('/client_encryption')
+def client_encryption():
+    """Container parameters for encrypting in the browser, for /upload_encrypted or /uploads with a header"""
+    return jsonify({
+        'format_version': FORMAT_VERSION,
+        'cipher': CLIENT_CIPHER,
+        'segment_size': encryptor.segment_size,
+        'kdf': encryptor.client_kdf(),
+        'compression': CLIENT_COMPRESSION
+    })
+
+@app.route('/upload_encrypted', methods=['POST'])
+def upload_encrypted():
+    """Store a container encrypted in the browser; the password never reaches the server.
+    
+    The file part is the whole container. Its header and layout are checked (segments
+    cannot be authenticated without the password) and it is published like an /encrypt
+    output, with metadata that holds no password.
+    """
+    output_path = partial_path()
+    try:
+        fields, filename, chunks = stream_multipart_upload('file')
+        if not filename:
+            return jsonify({'error': 'No file selected'}), 400
+        
+        with STAGE_SECONDS.time(stage='save'), open(output_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        with open(output_path, 'rb') as f:
+            header = encryptor.check_client_container(f)
+        
+        # Get output filename
+        output_name = encrypted_name(fields, filename)
+        
+        metadata = encryptor.describe(header, None, filename, output_name)
+        
+        # Publish the output with its metadata (served as <output>.meta)
+        meta_filename = output_name + SIDECAR_SUFFIX
+        with STAGE_SECONDS.time(stage='metadata'):
+            catalog.publish(output_path, output_name, 'encrypted', metadata, request_owner())
+        
         return jsonify({
             'success': True,
             'encrypted_file': output_name,
             'metadata_file': meta_filename,
             'metadata': metadata
         })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload of `size` bytes; the response gives the chunk size and count.
+    
+    Send the chunks with PUT /uploads/<id>/chunks/<index>, in any order and in parallel,
+    then POST /uploads/<id>/finalize. With a `header` field (a container header built by
+    /client_encryption's rules), the chunks arrive already encrypted in the browser and
+    the server never holds the password or key. A header with a compression
+    needs no `size` (see upload_chunk).
+    """
+    try:
+        filename = request.form.get('filename', '').strip()
+        if not filename:
+            return jsonify({'error': 'No file selected'}), 400
+        header = encryptor.check_client_header(json.loads(request.form['header'])) if request.form.get('header') else None
+        size = request.form.get('size', type=int)
+        if header is not None and 'compression' in header:
+            # Compressed in the browser: the size is only known when the final chunk arrives
+            size = None
+        elif size is None or size < 0:
+            return jsonify({'error': 'The file size is required'}), 400
+        elif size > app.config['RESUMABLE_MAX_SIZE']:
+            return jsonify({'error': f"File exceeds the {app.config['RESUMABLE_MAX_SIZE']} byte limit"}), 413
+        if requested_compression(request.form):
+            # Chunks are sealed at fixed offsets, which compressed data does not have
+            return jsonify({'error': 'Compression is not available for resumable uploads'}), 400
+        
+        password = request.form.get('password')
+        if header is not None:
+            # No key is stored: each chunk body is already sealed
+            password, key = None, b''
+        elif not password:
+            return jsonify({'error': 'Password is required'}), 400
+        else:
+            # The KDF runs once here; the session keeps the derived key for its chunks
+            header = encryptor.new_header()
+            key = encryptor.header_key(password, header)
+        head = encryptor.pack_header(header)
+        header['header_size'] = len(head)
+        chunk_size = max(1, app.config['UPLOAD_CHUNK_SIZE'] // header['segment_size']) * header['segment_size']
+        session = upload_sessions.create(filename, size, chunk_size, header, key, head,
+                                         encryptor.describe(header, password, filename, None), request_owner())
+        return jsonify(upload_status(session)), 201
+    except KDFBusy as e:
+        return kdf_busy_response(e)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<session_id>', methods=['GET'])
+def upload_progress(session_id):
+    """Received chunks of a resumable upload; `offset` is where a sequential client resumes"""
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found or expired'}), 404
+    return jsonify(upload_status(session))
+
+@app.route('/uploads/<session_id>', methods=['DELETE'])
+def abort_upload(session_id):
+    if not upload_sessions.delete(session_id):
+        return jsonify({'error': 'Upload session not found or expired'}), 404
+    return jsonify({'success': True})
+
+@app.route('/uploads/<session_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(session_id, index):
+    """Encrypt one chunk (the raw request body) into its place in the output as it arrives.
+    
+    For an upload encrypted in the browser, the body is the sealed chunk and is stored as sent.
+    One compressed in the browser has no size up front: every chunk is whole except the one
+    holding the final segment, which is sent with ?final=true and fixes the upload's size.
+    """
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found or expired'}), 404
+    header = session['header']
+    final = session['size'] is None and request.args.get('final') == 'true'
+    if session['size'] is None:
+        if index * session['chunk_size'] >= app.config['RESUMABLE_MAX_SIZE']:
+            return jsonify({'error': f"File exceeds the {app.config['RESUMABLE_MAX_SIZE']} byte limit"}), 413
+        expected = session['chunk_size']
+    elif index >= session['chunks']:
+        return jsonify({'error': f"Chunk index must be below {session['chunks']}"}), 400
+    else:
+        expected = min(session['chunk_size'], session['size'] - index * session['chunk_size'])
+    length = expected if session['key'] else encryptor.sealed_size(header, expected)
+    if request.content_length is not None and (request.content_length > length if final
+                                               else request.content_length != length):
+        return jsonify({'error': f"Chunk {index} must be {'at most ' if final else ''}{length} bytes"}), 400
+    
+    # A retried chunk that already arrived is acknowledged without being sealed again
+    claim = upload_sessions.claim(session_id, index)
+    if claim == 'done':
+        return jsonify({'success': True, 'chunk': index, 'duplicate': True})
+    if claim == 'busy':
+        return jsonify({'error': f'Chunk {index} is already being uploaded'}), 409
     
+    try:
+        if session['key']:
+            sealed = encryptor.encrypt_chunk(read_limited(request.stream, length, header['segment_size']),
+                                             session['key'], header,
+                                             index * (session['chunk_size'] // header['segment_size']),
+                                             index == session['chunks'] - 1)
+        else:
+            sealed = b''.join(read_limited(request.stream, length, STREAM_CHUNK_SIZE))
+        if final:
+            # The final chunk may be short, but must still be whole sealed segments
+            opened = encryptor.opened_size(header, len(sealed)) if len(sealed) <= length else None
+            if opened is None:
+                upload_sessions.release(session_id, index)
+                return jsonify({'error': f'Chunk {index} is not a sequence of sealed segments'}), 400
+            if not upload_sessions.set_size(session_id, index * session['chunk_size'] + opened):
+                upload_sessions.release(session_id, index)
+                return jsonify({'error': f'Chunk {index} does not match the end of the upload'}), 409
+        elif len(sealed) != encryptor.sealed_size(header, expected):
+            upload_sessions.release(session_id, index)
+            return jsonify({'error': f'Chunk {index} must be {length} bytes'}), 400
+        
+        with STAGE_SECONDS.time(stage='write'):
+            fd = os.open(upload_sessions.path(session_id), os.O_WRONLY)
+            try:
+                os.pwrite(fd, sealed, encryptor.chunk_offset(header, session['chunk_size'], index))
+            finally:
+                os.close(fd)
+        upload_sessions.complete(session_id, index)
+        return jsonify({'success': True, 'chunk': index})
+    except FileNotFoundError:
+        upload_sessions.release(session_id, index)
+        return jsonify({'error': 'Upload session not found or expired'}), 404
     except Exception as e:
+        # Nothing was written, so the chunk can simply be sent again
+        upload_sessions.release(session_id, index)
+        ERRORS.inc(type=error_type(e))
         return jsonify({'error': str(e)}), 500
 
+@app.route('/uploads/<session_id>/finalize', methods=['POST'])
+def finalize_upload(session_id):
+    """Publish a completely received upload; returns the same response as /encrypt"""
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found or expired'}), 404
+    if session['size'] is None:
+        return jsonify({'error': 'The final chunk has not been received yet'}), 409
+    received = set(session['received'])
+    missing = [index for index in range(session['chunks']) if index not in received]
+    if missing:
+        return jsonify({'error': f'{len(missing)} chunk(s) not received yet', 'missing': missing}), 409
+    if max(received) >= session['chunks']:
+        return jsonify({'error': 'Chunks were received past the final chunk'}), 400
+    
+    # Get output filename (checked before the session is closed, so a bad name can be corrected)
+    try:
+        output_name = encrypted_name(request.form, session['filename'])
+    except ArtifactNameError as e:
+        return jsonify({'error': str(e)}), 400
+    if not upload_sessions.close(session_id):
+        return jsonify({'error': 'Upload session not found or expired'}), 404
+    
+    output_path = upload_sessions.path(session_id)
+    try:
+        metadata = session['metadata']
+        metadata['output_file'] = output_name
+        
+        # Publish the output with its metadata (served as <output>.meta)
+        meta_filename = output_name + SIDECAR_SUFFIX
+        with STAGE_SECONDS.time(stage='metadata'):
+            catalog.publish(output_path, output_name, 'encrypted', metadata, session['owner'])
+        
+        return jsonify({
+            'success': True,
+            'encrypted_file': output_name,
+            'metadata_file': meta_filename,
+            'metadata': metadata
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
 @app.route('/decrypt', methods=['POST'])
 def decrypt_file():
+    if async_requested() and job_queue.full():
+        return job_queue_full()
     try:
         # Check if using metadata file or manual input
         use_metadata = request.form.get('use_metadata') == 'true'
@@ -193,12 +894,9 @@ def decrypt_file():
                 return jsonify({'error': 'No encrypted file selected'}), 400
             
             # Save metadata file
-            meta_path = os.path.join(app.config['UPLOAD_FOLDER'], meta_file.filename)
-            meta_file.save(meta_path)
-            
-            # Save encrypted file
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], encrypted_file.filename)
-            encrypted_file.save(input_path)
+            meta_path = partial_path()
+            with STAGE_SECONDS.time(stage='save'):
+                meta_file.save(meta_path)
             
             # Read metadata
             with open(meta_path, 'r') as f:
@@ -229,10 +927,6 @@ def decrypt_file():
             
             if not password:
                 return jsonify({'error': 'Password is required'}), 400
-            
-            # Save encrypted file
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], input_filename)
-            encrypted_file.save(input_path)
         
         # Get output filename
         output_name = request.form.get('output_name')
@@ -247,7 +941,22 @@ def decrypt_file():
                 else:
                     output_name = 'decrypted_file'
         
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_name)
+        # Stream the plaintext back as the response instead of storing it
+        if request.form.get('stream') == 'true':
+            return decrypt_response(password, salt_b64, nonce_b64, output_name)
+        
+        catalog.check_name(output_name)
+        
+        # Save encrypted file
+        input_path = partial_path()
+        with STAGE_SECONDS.time(stage='save'):
+            encrypted_file.save(input_path)
+        
+        if async_requested():
+            return submit_job('decrypt', {'output_name': output_name, 'password': password, 'salt': salt_b64,
+                                          'nonce': nonce_b64}, input_path)
+        
+        output_path = partial_path()
         
         # Decrypt file
         success = encryptor.decrypt_file(input_path, output_path, password, salt_b64, nonce_b64)
@@ -257,6 +966,7 @@ def decrypt_file():
             os.remove(input_path)
         
         if success:
+            catalog.publish(output_path, output_name, 'decrypted', owner=request_owner())
             return jsonify({
                 'success': True,
                 'decrypted_file': output_name
@@ -264,20 +974,331 @@ def decrypt_file():
         else:
             return jsonify({'error': 'Decryption failed. Please check your files and try again.'}), 400
     
+    except KDFBusy as e:
+        return kdf_busy_response(e)
+    except ArtifactNameError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Decryption error: {str(e)}'}), 500
+
+@app.route('/encrypt_batch', methods=['POST'])
+def encrypt_batch():
+    """Encrypt many files with one password and stream back a zip of .enc files plus manifest.json"""
+    try:
+        files = take_uploads('files')
+        if not files:
+            return jsonify({'error': 'No files selected'}), 400
+        
+        password = request.form.get('password')
+        if not password:
+            return jsonify({'error': 'Password is required'}), 400
+        
+        # One KDF run for the whole batch; each file gets an HKDF subkey
+        batch = encryptor.new_batch(password)
+        compression = requested_compression(request.form)
+        manifest = {
+            'salt': batch['salt'],
+            'kdf': batch['kdf'],
+            'password': password,  # Store password in manifest, like .meta files
+            'format_version': FORMAT_VERSION,
+            'files': []
+        }
+        
+        def entries():
+            used = set()
+            for filename, stream in files:
+                header, key = encryptor.new_batch_header(batch)
+                if compression:
+                    header['compression'] = compression
+                output_name = unique_name(filename, used) + '.enc'
+                entry = {
+                    'input_file': filename,
+                    'output_file': output_name,
+                    'nonce': header['nonce'],
+                    'cipher': header['cipher'],
+                    'subkey_salt': header['subkey_salt'],
+                    'segment_size': header['segment_size']
+                }
+                manifest['files'].append(entry)
+                yield output_name, encryptor.iter_encrypt(
+                    encryptor.read_chunks(stream, header['segment_size']), key, header)
+                # The entry has been written, so the compression probe has run
+                if 'compression' in header:
+                    entry['compression'] = header['compression']
+        
+        return archive_response(entries(), manifest, 'encrypted.zip', files)
+    
+    except KDFBusy as e:
+        return kdf_busy_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/decrypt_batch', methods=['POST'])
+def decrypt_batch():
+    """Decrypt many files with one password and stream back a zip of plaintexts plus manifest.json"""
+    try:
+        files = take_uploads('files')
+        if not files:
+            return jsonify({'error': 'No files selected'}), 400
+        
+        password = request.form.get('password')
+        if not password:
+            return jsonify({'error': 'Password is required'}), 400
+        
+        manifest = {'files': []}
+        
+        def decrypted_blocks(stream, header, key, nonce, entry):
+            try:
+                if header is not None:
+                    yield from encryptor.iter_decrypt(stream, key, header)
+                else:
+                    yield from encryptor.iter_decrypt_legacy(stream, key, nonce)
+                entry['status'] = 'ok'
+            except Exception as e:
+                # Segments already written were authenticated; the entry is incomplete
+                entry['status'] = 'incomplete'
+                entry['error'] = repr(e)
+                ERRORS.inc(type=error_type(e))
+        
+        def entries():
+            used = set()
+            for filename, stream in files:
+                name = filename[:-4] if filename.endswith('.enc') else filename + '.dec'
+                entry = {'input_file': filename}
+                manifest['files'].append(entry)
+                nonce = None
+                try:
+                    header = encryptor.read_header(stream)
+                    if header is not None:
+                        # Files from one batch share a salt, so the key cache derives once
+                        key = encryptor.header_key(password, header)
+                        encryptor.check_final_segment(stream, key, header)
+                    else:
+                        # Legacy files have one tag for the whole file: authenticate before streaming
+                        salt, nonce = stream.read(16), stream.read(12)
+                        key = encryptor.derive_key(password, salt)
+                        for _ in encryptor.iter_decrypt_legacy(stream, key, nonce):
+                            pass
+                except Exception as e:
+                    entry['status'] = 'failed'
+                    entry['error'] = repr(e)
+                    ERRORS.inc(type=error_type(e))
+                    continue
+                entry['output_file'] = unique_name(name, used)
+                yield entry['output_file'], decrypted_blocks(stream, header, key, nonce, entry)
+        
+        return archive_response(entries(), manifest, 'decrypted.zip', files)
+    
     except Exception as e:
         return jsonify({'error': f'Decryption error: {str(e)}'}), 500
 
+@app.route('/verify', methods=['POST'])
+def verify_files():
+    """Check encrypted files for corruption without producing plaintext.
+    
+    Verifies uploaded `files` and stored outputs (`names`, or `all=true` for every
+    stored .enc file), streaming one JSON report per line as each file finishes and
+    a summary line at the end. Stored files default to the password in their metadata.
+    """
+    try:
+        names = request.form.getlist('names')
+        sweep = request.form.get('all') == 'true'
+        has_uploads = any(file.filename for file in request.files.getlist('files'))
+        if not has_uploads and not names and not sweep:
+            return jsonify({'error': 'No files selected'}), 400
+        
+        password = request.form.get('password')
+        if has_uploads and not password:
+            return jsonify({'error': 'Password is required for uploaded files'}), 400
+        uploads = take_uploads('files')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    def stored():
+        for name in names:
+            yield name, catalog.get(name)
+        cursor = None
+        while sweep:
+            records, cursor = catalog.list(app.config['CATALOG_PAGE_SIZE'], cursor)
+            for record in records:
+                if record['kind'] == 'encrypted':
+                    yield record['name'], record
+            if cursor is None:
+                break
+    
+    def verify(report, f, password, salt_b64=None, nonce_b64=None):
+        try:
+            return dict(report, **encryptor.verify(f, password, salt_b64, nonce_b64))
+        except KDFBusy:
+            return dict(report, status='failed', error='Key derivation is busy, retry later')
+    
+    def reports():
+        for filename, stream in uploads:
+            yield verify({'name': filename, 'source': 'upload'}, stream, password)
+        for name, artifact in stored():
+            report = {'name': name, 'source': 'stored'}
+            if artifact is None:
+                yield dict(report, status='missing')
+                continue
+            metadata = artifact['metadata'] or {}
+            try:
+                # Stored files default to the password recorded in their metadata
+                with open(catalog.path(name), 'rb') as f:
+                    yield verify(report, f, password or metadata.get('password') or '',
+                                 metadata.get('salt'), metadata.get('nonce'))
+            except FileNotFoundError:
+                yield dict(report, status='missing')
+    
+    def generate():
+        summary = {'ok': 0, 'failed': 0, 'missing': 0}
+        for report in reports():
+            summary[report['status']] += 1
+            yield json.dumps(report) + '\n'
+        yield json.dumps({'summary': summary}) + '\n'
+    
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.call_on_close(lambda: [stream.close() for _, stream in uploads])
+    return response
+
+@app.route('/jobs/<job_id>')
+def job_progress(job_id):
+    """Status and progress of a background job; when done, its result names the output for /download"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(job))
+
+@app.route('/profiles')
+def list_profiles():
+    """Profile dumps, newest first (requires X-Profile-Token)"""
+    if not profiler.authorized(request.headers.get('X-Profile-Token')):
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({'format': profiler.output_format, 'profiles': profiler.list()})
+
+@app.route('/profiles/<name>')
+def fetch_profile(name):
+    """Download one profile dump (requires X-Profile-Token)"""
+    path = profiler.path(name) if profiler.authorized(request.headers.get('X-Profile-Token')) else None
+    if path is None:
+        return jsonify({'error': 'Not found'}), 404
+    return send_file(path, as_attachment=True, download_name=name)
+
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
-        else:
+        artifact = catalog.get(filename)
+        if artifact is not None:
+            return send_file(catalog.path(filename), as_attachment=True, download_name=filename)
+        
+        # <name>.meta is generated from the catalog entry of <name>
+        if filename.endswith(SIDECAR_SUFFIX):
+            artifact = catalog.get(filename[:-len(SIDECAR_SUFFIX)])
+            if artifact is not None and artifact['metadata']:
+                return Response(json.dumps(artifact['metadata'], indent=2), mimetype='application/json',
+                                headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+        
+        return jsonify({'error': 'File not found'}), 404
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/artifacts')
+def list_artifacts():
+    """Newest-first page of cataloged outputs; pass next_cursor back as ?cursor= for the next page"""
+    try:
+        limit = min(request.args.get('limit', app.config['CATALOG_PAGE_SIZE'], type=int), 1000)
+        records, next_cursor = catalog.list(max(limit, 1), request.args.get('cursor', type=int),
+                                            request.args.get('owner'))
+        artifacts = []
+        for record in records:
+            # Metadata holds key material, so only the catalog columns are listed
+            record.pop('metadata')
+            record['created'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(record['created']))
+            artifacts.append(record)
+        return jsonify({'artifacts': artifacts, 'next_cursor': next_cursor})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/stream/<filename>')
+def stream_file(filename):
+    """Serve decrypted bytes of a stored container, honoring Range requests.
+    
+    Only the segments covering the requested range are read and authenticated,
+    so seeking into a large file costs the same as reading a small one.
+    """
+    try:
+        if catalog.get(filename) is None:
             return jsonify({'error': 'File not found'}), 404
+        file_path = catalog.path(filename)
+        
+        # Headers keep the password out of logs; the query parameter exists for <video> and <audio> tags
+        password = request.headers.get('X-Password') or request.args.get('password')
+        if not password:
+            return jsonify({'error': 'Password is required'}), 400
+        
+        f = open(file_path, 'rb')
+        try:
+            header = encryptor.read_header(f)
+            if header is None:
+                f.close()
+                return jsonify({'error': 'Range access needs a segmented container; use /decrypt for legacy files'}), 400
+            if header.get('compression'):
+                f.close()
+                return jsonify({'error': 'Range access is not available for compressed files; use /decrypt'}), 400
+            key = encryptor.header_key(password, header)
+            # Authenticate the last segment before any headers go out: it checks the key even when
+            # the range is empty (or the file is), and a truncated container fails here as well
+            encryptor.check_final_segment(f, key, header)
+            size = encryptor.plaintext_size(header, os.path.getsize(file_path))
+            
+            # Work out the requested range; a multi-range request is answered with its first
+            # satisfiable range only (no multipart/byteranges), which RFC 9110 allows
+            status = 200
+            start, stop = 0, size
+            if request.range is not None:
+                byte_range = next(filter(None, (Range(request.range.units, [r]).range_for_length(size)
+                                                for r in request.range.ranges)), None)
+                if byte_range is None:
+                    f.close()
+                    return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+                start, stop = byte_range
+                status = 206
+            
+            # Decrypt the first covered segment now so a tampered one is an error response, not a broken stream
+            blocks = encryptor.iter_decrypt_range(f, key, header, start, stop) if stop > start else iter(())
+            first = next(blocks, b'')
+        except Exception:
+            f.close()
+            raise
+        
+        def generate():
+            try:
+                yield first
+                yield from blocks
+            finally:
+                f.close()
+        
+        name = filename[:-4] if filename.endswith('.enc') else filename
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Length': str(stop - start),
+            'Content-Disposition': f'inline; filename="{name}"'
+        }
+        if status == 206:
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        return Response(generate(), status=status, headers=headers,
+                        mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+    
+    except KDFBusy as e:
+        return kdf_busy_response(e)
+    except InvalidTag:
+        ERRORS.inc(type='auth_tag')
+        return jsonify({'error': 'Decryption failed. Please check your password and try again.'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
+    # Development server only; run `make serve` (gunicorn, see gunicorn.conf.py) in production
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True, threaded=True)
\ No newline at end of file
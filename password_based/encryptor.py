@@ -0,0 +1,1129 @@
+"""FileEncryptor, the segmented container format and password key derivation, independent of Flask.
+
+Shared by the web app (app.py) and the bulk command-line tool (cli.py). Importing this
+module has no side effects beyond reading its settings from the environment.
+"""
+import os
+import json
+import struct
+import zlib
+import hmac
+import hashlib
+import itertools
+import math
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.backends import default_backend
+import base64
+import secrets
+try:
+    import zstandard
+except ImportError:  # optional: zlib is always available
+    zstandard = None
+from metrics import Registry, StageTimer
+from kdf import KDFS, LEGACY_KDF, calibrate_kdf, check_kdf_params, kdf_limits, kdf_memory, kdf_worker, run_kdf
+
+
+# Segmented container format:
+#   magic(4) | version(1) | header length(4) | JSON header | segment*
+# Each segment is AES-GCM(plaintext[segment_size]) + 16-byte tag, sealed with
+# nonce = prefix(7) || counter(4) || final flag(1) so reordering and truncation fail.
+FORMAT_MAGIC = b'FENC'
+# Version 3 added the cipher, kdf, subkey_salt and compression header fields, which change how
+# the body is read: a version 2 reader refuses the file instead of misreading it. Version 2
+# files are still read, and a header field this code does not know is refused, not ignored.
+# "iterations" is the PBKDF2 cost of files written before the "kdf" field existed.
+FORMAT_VERSION = 3
+READABLE_VERSIONS = (2, 3)
+HEADER_FIELDS = frozenset({'cipher', 'segment_size', 'salt', 'nonce', 'kdf', 'iterations', 'subkey_salt', 'compression'})
+SEGMENT_SIZE = 64 * 1024
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+MAX_HEADER_SIZE = 64 * 1024
+MAX_SEGMENTS = 2 ** 32 - 1
+STREAM_CHUNK_SIZE = 256 * 1024
+MAX_REPORTED_FAILURES = 100  # failed segments listed per file by verify
+
+# AEAD cipher suites for segments. All take a 256-bit key and a 96-bit nonce and add a
+# 16-byte tag, so the container layout is shared; the suite is named in the header.
+CIPHER_SUITES = {'aes-256-gcm': AESGCM, 'chacha20-poly1305': ChaCha20Poly1305}
+LEGACY_CIPHER = 'aes-256-gcm'  # containers without a "cipher" header field
+# 'auto' benchmarks the suites at startup and encrypts new files with the fastest on this host
+# (under gunicorn, once in the master: see host_calibration)
+CIPHER_SUITE = os.environ.get('CIPHER_SUITE', 'auto')
+CIPHER_BENCHMARK_BYTES = 4 * 1024 * 1024
+CIPHER_BENCHMARK_MARGIN = 1.2  # another suite must be this much faster to replace AES-GCM
+
+# Files at least PARALLEL_THRESHOLD bytes are sealed on a thread pool (the AEADs release the GIL)
+PARALLEL_WORKERS = int(os.environ.get('PARALLEL_WORKERS', os.cpu_count() or 1))
+PARALLEL_THRESHOLD = int(os.environ.get('PARALLEL_THRESHOLD', 8 * 1024 * 1024))
+PARALLEL_BATCH_SEGMENTS = 16  # segments per pool task, to amortize scheduling overhead
+
+# Optional compression before encryption, requested per upload with compress=true.
+# The first segment is probed with fast zlib and compression is skipped when it
+# does not shrink (media, archives, already encrypted data).
+COMPRESSION_ALGORITHMS = ('zstd', 'zlib') if zstandard else ('zlib',)
+COMPRESSION = os.environ.get('COMPRESSION', COMPRESSION_ALGORITHMS[0])
+COMPRESSION_LEVELS = {'zlib': 6, 'zstd': 3}
+COMPRESSION_PROBE_SIZE = 16 * 1024
+COMPRESSION_PROBE_RATIO = 0.9  # compress only if the probe shrinks below this fraction
+SUBKEY_INFO = b'file-encryption subkey'
+
+# Browser-side encryption (static/js/app.js) uses WebCrypto, which has AES-GCM but not
+# ChaCha20-Poly1305, PBKDF2 but no memory-hard KDF, and CompressionStream('deflate'), whose
+# output is zlib. Browsers use the server's KDF parameters when it runs PBKDF2, else
+# CLIENT_KDF_ITERATIONS.
+CLIENT_CIPHER = 'aes-256-gcm'
+CLIENT_COMPRESSION = 'zlib'
+CLIENT_KDF_ITERATIONS = int(os.environ.get('CLIENT_KDF_ITERATIONS', 600000))
+
+# Password KDF for new files ('auto' picks the strongest available; see kdf.py). Its parameters
+# are calibrated at startup so one derivation takes about KDF_TARGET_MS on this host
+# (0 uses the minimum parameters), and are stored in each file's header.
+KDF = os.environ.get('KDF', 'auto')
+KDF_TARGET_MS = float(os.environ.get('KDF_TARGET_MS', 250))
+KDF_MAX_MEMORY = int(os.environ.get('KDF_MAX_MEMORY', 64 * 1024 * 1024))  # per derivation
+# KDF parameters read from a file's header may cost at most KDF_MAX_MEMORY and KDF_MAX_COST_FACTOR
+# times the KDF_TARGET_MS time; files asking for more are rejected before anything is derived
+KDF_MAX_COST_FACTOR = float(os.environ.get('KDF_MAX_COST_FACTOR', 8))
+# Memory-hard derivations in flight may hold at most KDF_MEMORY_BUDGET bytes in total; others
+# wait up to KDF_MEMORY_WAIT seconds for room before failing with 503
+KDF_MEMORY_BUDGET = int(os.environ.get('KDF_MEMORY_BUDGET', 256 * 1024 * 1024))
+KDF_MEMORY_WAIT = float(os.environ.get('KDF_MEMORY_WAIT', 10))
+# One derivation has to fit in the memory budget, whether it is ours or read from a header
+KDF_DERIVATION_MEMORY = min(KDF_MAX_MEMORY, KDF_MEMORY_BUDGET) if KDF_MEMORY_BUDGET > 0 else KDF_MAX_MEMORY
+# The calibrated KDF parameters and header limits as JSON, which gunicorn.conf.py sets from a
+# single calibration in the master (see host_calibration); unset, each process calibrates itself
+KDF_CALIBRATION = os.environ.get('KDF_CALIBRATION')
+
+# Derived keys are cached in memory so repeated decryptions skip the KDF (KEY_CACHE_SIZE=0 disables)
+KEY_CACHE_SIZE = int(os.environ.get('KEY_CACHE_SIZE', 256))
+KEY_CACHE_TTL = float(os.environ.get('KEY_CACHE_TTL', 300))
+
+# The KDF runs on a dedicated process pool with a bounded queue (KDF_POOL_WORKERS=0 runs it inline)
+KDF_POOL_WORKERS = int(os.environ.get('KDF_POOL_WORKERS', os.cpu_count() or 1))
+KDF_QUEUE_SIZE = int(os.environ.get('KDF_QUEUE_SIZE', 16))
+KDF_TIMEOUT = float(os.environ.get('KDF_TIMEOUT', 60))
+
+# Pipeline metrics (app.py adds its request metrics to the same registry, served at /metrics).
+# METRICS_DIR, set by gunicorn.conf.py, makes every scrape report totals over all workers.
+metrics = Registry(os.environ.get('METRICS_DIR') or None)
+STAGE_SECONDS = metrics.histogram('fileenc_stage_seconds', 'Time per request spent in each pipeline stage', ('stage',))
+BYTES_PROCESSED = metrics.counter('fileenc_bytes_processed_total', 'Plaintext bytes encrypted or decrypted', ('operation',))
+ERRORS = metrics.counter('fileenc_errors_total', 'Failures by type', ('type',))
+
+class DerivedKeyCache:
+    """Bounded LRU cache of derived keys with a TTL.
+    
+    Entries are keyed by an HMAC of (password, salt, KDF parameters) under a per-process
+    secret, so passwords are never stored.
+    """
+    def __init__(self, max_entries: int = KEY_CACHE_SIZE, ttl: float = KEY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.secret = secrets.token_bytes(32)
+        self.entries = OrderedDict()  # cache key -> (expires at, derived key)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def cache_key(self, password: str, salt: bytes, params: dict) -> bytes:
+        """Keyed hash of the derivation inputs (length-prefixed so fields cannot run together)"""
+        mac = hmac.new(self.secret, digestmod=hashlib.sha256)
+        for part in (password.encode(), salt, json.dumps(params, sort_keys=True).encode()):
+            mac.update(struct.pack('>I', len(part)) + part)
+        return mac.digest()
+    
+    def get(self, cache_key: bytes) -> bytes:
+        """Return the cached key, or None on a miss or expired entry"""
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[cache_key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, cache_key: bytes, key: bytes):
+        """Store a derived key, evicting the least recently used entries beyond max_entries"""
+        with self.lock:
+            self.entries[cache_key] = (time.monotonic() + self.ttl, key)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+class KDFBusy(Exception):
+    """Raised when the KDF queue or memory budget is full; retry_after is a hint in seconds"""
+    def __init__(self, retry_after: int, message: str = "Key derivation queue is full, please retry later"):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def error_type(error: Exception) -> str:
+    """Classify a failure for fileenc_errors_total"""
+    if isinstance(error, InvalidTag):
+        return 'auth_tag'
+    if isinstance(error, KDFBusy):
+        return 'kdf_busy'
+    if isinstance(error, ValueError):
+        return 'invalid_input'
+    if isinstance(error, OSError):
+        return 'io'
+    return 'other'
+
+class KDFPool:
+    """Size-limited process pool for key derivation with a bounded queue.
+    
+    Keeps KDF work off the request threads. When `workers + max_queue` derivations are
+    already pending, derive() fails fast with KDFBusy instead of queueing indefinitely.
+    """
+    def __init__(self, workers: int = KDF_POOL_WORKERS, max_queue: int = KDF_QUEUE_SIZE,
+                 timeout: float = KDF_TIMEOUT):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+    
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                # spawn avoids forking a multi-threaded server process
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+    
+    def retry_after(self) -> int:
+        """Estimate seconds until a slot frees up, from the average derivation time"""
+        with self.lock:
+            average = self.run_total / self.completed if self.completed else 1.0
+            return max(1, math.ceil(average * self.pending / self.workers))
+    
+    def derive(self, password: str, salt: bytes, params: dict, done=None) -> bytes:
+        """Derive a key on the pool; `done` is called once the derivation has really ended,
+        which after a timeout is later than this call returns (or right away if nothing ran)"""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            if done is not None:
+                done()
+            raise KDFBusy(self.retry_after())
+        
+        with self.lock:
+            self.pending += 1
+        
+        def finished(future=None):
+            # The slot stays taken while a timed-out derivation is still running in the pool
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+            if done is not None:
+                done()
+        
+        submitted = time.time()
+        try:
+            future = self.get_executor().submit(kdf_worker, password.encode(), salt, params)
+        except BaseException:
+            finished()
+            raise
+        future.add_done_callback(finished)
+        try:
+            key, started = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()  # drops it if it never left the queue
+            raise KDFBusy(self.retry_after(), "Key derivation timed out, please retry later") from None
+        except BrokenProcessPool:
+            with self.lock:
+                self.executor = None
+            raise
+        finished_at = time.time()
+        with self.lock:
+            wait = max(0.0, started - submitted)
+            self.completed += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.run_total += finished_at - started
+        return key
+    
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'pending': self.pending,
+                'queued': max(0, self.pending - self.workers),
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_wait_seconds': self.wait_total / self.completed if self.completed else 0.0,
+                'max_wait_seconds': self.wait_max,
+                'avg_derive_seconds': self.run_total / self.completed if self.completed else 0.0
+            }
+
+class KDFMemoryLimiter:
+    """Caps the memory held by concurrent memory-hard key derivations.
+    
+    scrypt and Argon2id allocate their whole memory cost for each derivation, so a burst
+    of requests could push the server into swap. Each derivation reserves its cost from a
+    shared budget and waits up to `wait` seconds for room, then fails with KDFBusy; one that
+    could never fit is rejected outright. The budget covers this process (one gunicorn worker).
+    """
+    def __init__(self, budget: int = KDF_MEMORY_BUDGET, wait: float = KDF_MEMORY_WAIT):
+        self.budget = budget
+        self.wait = wait
+        self.condition = threading.Condition()
+        self.in_use = 0
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+    
+    def acquire(self, cost: int):
+        """Take `cost` bytes of the budget; every acquire() must be paired with a release()"""
+        if not cost:
+            return
+        with self.condition:
+            if cost > self.budget:
+                self.rejected += 1
+                raise ValueError("Key derivation needs more memory than this server allows")
+            self.waiting += 1
+            try:
+                admitted = self.condition.wait_for(lambda: self.in_use + cost <= self.budget, timeout=self.wait)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.rejected += 1
+                raise KDFBusy(max(1, math.ceil(self.wait)), "Key derivation memory budget is in use, please retry later")
+            self.in_use += cost
+            self.running += 1
+    
+    def release(self, cost: int):
+        if not cost:
+            return
+        with self.condition:
+            self.in_use -= cost
+            self.running -= 1
+            self.condition.notify_all()
+    
+    @contextmanager
+    def reserve(self, cost: int):
+        """Hold `cost` bytes of the budget for the enclosed derivation"""
+        self.acquire(cost)
+        try:
+            yield
+        finally:
+            self.release(cost)
+    
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'budget_bytes': self.budget,
+                'in_use_bytes': self.in_use,
+                'running': self.running,
+                'waiting': self.waiting,
+                'rejected': self.rejected
+            }
+
+def benchmark_cipher_suites(size: int = CIPHER_BENCHMARK_BYTES, segment_size: int = SEGMENT_SIZE) -> dict:
+    """Seal size bytes in segment_size pieces with each suite; returns MB/s per suite"""
+    key = secrets.token_bytes(32)
+    nonce = secrets.token_bytes(12)
+    segment = secrets.token_bytes(segment_size)
+    speeds = {}
+    for name, suite in CIPHER_SUITES.items():
+        aead = suite(key)
+        aead.encrypt(nonce, segment, None)  # warm up
+        start = time.perf_counter()
+        for _ in range(max(1, size // segment_size)):
+            aead.encrypt(nonce, segment, None)
+        speeds[name] = max(1, size // segment_size) * segment_size / (time.perf_counter() - start) / 1e6
+    return speeds
+
+def select_cipher_suite(setting: str = CIPHER_SUITE) -> str:
+    """Resolve CIPHER_SUITE: a suite name, or 'auto' to benchmark this host"""
+    if setting != 'auto':
+        if setting not in CIPHER_SUITES:
+            raise ValueError(f"Unknown CIPHER_SUITE {setting!r}, expected 'auto' or one of: {', '.join(CIPHER_SUITES)}")
+        return setting
+    speeds = benchmark_cipher_suites()
+    fastest = max(speeds, key=speeds.get)
+    # Files sealed with AES-GCM stay readable by older versions, so only switch for a clear win
+    suite = fastest if speeds[fastest] > speeds[LEGACY_CIPHER] * CIPHER_BENCHMARK_MARGIN else LEGACY_CIPHER
+    print(f"Cipher benchmark: {', '.join(f'{n} {v:.0f} MB/s' for n, v in speeds.items())} - using {suite}")
+    return suite
+
+def host_calibration() -> dict:
+    """Settings resolved by benchmarking this host, as environment variables.
+
+    gunicorn.conf.py runs this once in the master so that every worker (and every worker
+    recycled later) starts with the same result instead of benchmarking for itself.
+    """
+    kdf = select_kdf(max_memory=KDF_DERIVATION_MEMORY)
+    limits = select_kdf_limits(kdf, max_memory=KDF_DERIVATION_MEMORY)
+    return {'CIPHER_SUITE': select_cipher_suite(), 'KDF_CALIBRATION': json.dumps({'kdf': kdf, 'limits': limits})}
+
+def select_kdf(setting: str = KDF, target_ms: float = KDF_TARGET_MS, max_memory: int = KDF_MAX_MEMORY,
+               calibration: str = KDF_CALIBRATION) -> dict:
+    """Resolve KDF ('auto' or a KDF name) to parameters calibrated for this host"""
+    if calibration:
+        params = json.loads(calibration)['kdf']
+        check_kdf_params(params)
+        return params
+    name = KDFS[0] if setting == 'auto' else setting
+    if name not in KDFS:
+        raise ValueError(f"Unknown or unavailable KDF {setting!r}, expected 'auto' or one of: {', '.join(KDFS)}")
+    params = calibrate_kdf(name, target_ms / 1000, max_memory)
+    print(f"KDF calibration ({target_ms:.0f} ms target): {', '.join(f'{k}={v}' for k, v in params.items())}")
+    return params
+
+def select_kdf_limits(kdf: dict = LEGACY_KDF, target_ms: float = KDF_TARGET_MS, max_memory: int = KDF_MAX_MEMORY,
+                      factor: float = KDF_MAX_COST_FACTOR, calibration: str = KDF_CALIBRATION) -> dict:
+    """KDF limits for headers read on this host (see kdf.kdf_limits), admitting `kdf` and browser-side PBKDF2"""
+    if calibration:
+        return {name: tuple(limit) for name, limit in json.loads(calibration)['limits'].items()}
+    client = {'name': LEGACY_KDF['name'], 'iterations': max(CLIENT_KDF_ITERATIONS, LEGACY_KDF['iterations'])}
+    return kdf_limits(target_ms / 1000, max_memory, factor, (kdf, client))
+
+class FileEncryptor:
+    def __init__(self, segment_size: int = SEGMENT_SIZE, workers: int = PARALLEL_WORKERS,
+                 parallel_threshold: int = PARALLEL_THRESHOLD, key_cache: DerivedKeyCache = None,
+                 kdf_pool: KDFPool = None, cipher: str = LEGACY_CIPHER, kdf: dict = LEGACY_KDF,
+                 kdf_limiter: KDFMemoryLimiter = None, kdf_limits: dict = None, log=print):
+        self.backend = default_backend()
+        self.cipher = cipher
+        self.kdf = kdf
+        self.key_cache = key_cache
+        self.kdf_pool = kdf_pool
+        self.kdf_limiter = kdf_limiter
+        self.kdf_limits = kdf_limits  # None checks only the absolute bounds in kdf.py
+        self.segment_size = segment_size
+        self.workers = workers
+        self.parallel_threshold = parallel_threshold
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.log = log  # per-file diagnostics (server log lines)
+    
+    def derive_key(self, password: str, salt: bytes, params: dict = LEGACY_KDF) -> bytes:
+        """Derive the file key from a password, reusing cached derivations when enabled"""
+        check_kdf_params(params, self.kdf_limits)
+        if self.key_cache is not None:
+            cache_key = self.key_cache.cache_key(password, salt, params)
+            key = self.key_cache.get(cache_key)
+            if key is None:
+                key = self.run_kdf(password, salt, params)
+                self.key_cache.put(cache_key, key)
+            return key
+        return self.run_kdf(password, salt, params)
+    
+    def run_kdf(self, password: str, salt: bytes, params: dict) -> bytes:
+        """Run the password KDF (the expensive part of every request), on the KDF pool if configured"""
+        cost = kdf_memory(params) if self.kdf_limiter is not None else 0
+        with STAGE_SECONDS.time(stage='kdf'):
+            if self.kdf_pool is None:
+                with self.kdf_limiter.reserve(cost) if cost else nullcontext():
+                    return run_kdf(password.encode(), salt, params)
+            if cost:
+                self.kdf_limiter.acquire(cost)
+            # The pool hands the memory back when the worker process finishes the derivation,
+            # which can be after this request has given up waiting for it
+            return self.kdf_pool.derive(password, salt, params,
+                                        done=partial(self.kdf_limiter.release, cost) if cost else None)
+    
+    def new_batch(self, password: str) -> dict:
+        """Derive one master key for a multi-file job; each file then gets an HKDF subkey"""
+        salt = secrets.token_bytes(16)
+        return {
+            'salt': base64.b64encode(salt).decode('utf-8'),
+            'kdf': self.kdf,
+            'master_key': self.derive_key(password, salt, self.kdf)
+        }
+    
+    def subkey(self, master_key: bytes, subkey_salt: bytes) -> bytes:
+        """Expand a per-file key from a batch master key"""
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=subkey_salt,
+            info=SUBKEY_INFO,
+            backend=self.backend
+        ).derive(master_key)
+    
+    def new_batch_header(self, batch: dict) -> tuple:
+        """Create a header for one file of a batch, returned with that file's subkey"""
+        header = self.new_header()
+        subkey_salt = secrets.token_bytes(16)
+        header['salt'] = batch['salt']
+        header['kdf'] = batch['kdf']
+        header['subkey_salt'] = base64.b64encode(subkey_salt).decode('utf-8')
+        return header, self.subkey(batch['master_key'], subkey_salt)
+    
+    @staticmethod
+    def header_kdf(header: dict) -> dict:
+        """KDF parameters of a container (headers without a "kdf" field used PBKDF2 with "iterations")"""
+        if 'kdf' in header:
+            return header['kdf']
+        return {'name': LEGACY_KDF['name'], 'iterations': header['iterations']}
+    
+    def header_key(self, password: str, header: dict) -> bytes:
+        """Derive the file key described by a container header"""
+        key = self.derive_key(password, base64.b64decode(header['salt']), self.header_kdf(header))
+        if 'subkey_salt' in header:
+            key = self.subkey(key, base64.b64decode(header['subkey_salt']))
+        return key
+    
+    def new_header(self) -> dict:
+        """Create container header fields (salt, nonce prefix, KDF parameters) for a new encryption"""
+        return {
+            'cipher': self.cipher,
+            'segment_size': self.segment_size,
+            'salt': base64.b64encode(secrets.token_bytes(16)).decode('utf-8'),
+            'nonce': base64.b64encode(secrets.token_bytes(NONCE_PREFIX_SIZE)).decode('utf-8'),
+            'kdf': dict(self.kdf)
+        }
+    
+    def client_kdf(self) -> dict:
+        """PBKDF2 parameters for browser-side encryption"""
+        if self.kdf['name'] == LEGACY_KDF['name']:
+            return dict(self.kdf)
+        return {'name': LEGACY_KDF['name'], 'iterations': max(CLIENT_KDF_ITERATIONS, LEGACY_KDF['iterations'])}
+    
+    def aead(self, key: bytes, header: dict):
+        """AEAD for a container's cipher suite (AES-GCM for containers that predate suites)"""
+        suite = header.get('cipher', LEGACY_CIPHER)
+        if suite not in CIPHER_SUITES:
+            raise ValueError(f"Unsupported cipher suite: {suite}")
+        return CIPHER_SUITES[suite](key)
+    
+    def pack_header(self, header: dict) -> bytes:
+        """Serialize header as magic + version + length-prefixed JSON"""
+        body = json.dumps(header, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        return FORMAT_MAGIC + bytes([FORMAT_VERSION]) + struct.pack('>I', len(body)) + body
+    
+    def read_header(self, f) -> dict:
+        """Read the container header, or return None for a legacy salt||nonce||ciphertext file.
+        
+        A file that starts with the container magic but has a version this code cannot
+        read raises ValueError instead of being misread as a legacy file.
+        """
+        prefix = f.read(len(FORMAT_MAGIC) + 5)
+        if not prefix.startswith(FORMAT_MAGIC):
+            f.seek(0)
+            return None
+        if len(prefix) < len(FORMAT_MAGIC) + 5:
+            raise ValueError("Truncated container header")
+        if prefix[len(FORMAT_MAGIC)] not in READABLE_VERSIONS:
+            raise ValueError(f"Unsupported container version {prefix[len(FORMAT_MAGIC)]}")
+        (length,) = struct.unpack('>I', prefix[len(FORMAT_MAGIC) + 1:])
+        if length > MAX_HEADER_SIZE:
+            raise ValueError("Container header too large")
+        body = f.read(length)
+        if len(body) != length:
+            raise ValueError("Truncated container header")
+        header = json.loads(body.decode('utf-8'))
+        if not isinstance(header, dict) or header.keys() - HEADER_FIELDS:
+            raise ValueError("Container header has fields this version cannot read; decrypt it with a newer release")
+        header['header_size'] = len(prefix) + length
+        return header
+    
+    def check_client_header(self, header: dict) -> dict:
+        """Validate a container header built outside the server (browser-side encryption); returns it.
+        
+        Only the fields new_header writes (plus compression) are accepted, with this
+        server's segment size, so the container opens with the usual readers.
+        """
+        if not isinstance(header, dict):
+            raise ValueError("The container header must be a JSON object")
+        fields = header.keys() - {'header_size'}
+        if not {'cipher', 'segment_size', 'salt', 'nonce', 'kdf'} <= fields \
+                or fields - {'cipher', 'segment_size', 'salt', 'nonce', 'kdf', 'compression'}:
+            raise ValueError("The container header needs cipher, segment_size, salt, nonce and kdf "
+                             "(and optionally compression)")
+        if header['cipher'] not in CIPHER_SUITES:
+            raise ValueError(f"Unsupported cipher suite: {header['cipher']}")
+        if header['segment_size'] != self.segment_size or isinstance(header['segment_size'], bool):
+            raise ValueError(f"The segment size must be {self.segment_size}")
+        for field, size in (('salt', 16), ('nonce', NONCE_PREFIX_SIZE)):
+            try:
+                valid = len(base64.b64decode(header[field], validate=True)) == size
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                raise ValueError(f"The {field} must be {size} bytes in base64")
+        check_kdf_params(header['kdf'], self.kdf_limits)
+        if 'compression' in header and header['compression'] not in COMPRESSION_ALGORITHMS:
+            raise ValueError(f"Unsupported compression: {header['compression']}")
+        return header
+    
+    def check_client_container(self, f) -> dict:
+        """Check a container encrypted elsewhere without its password: a valid header and a plausible segment layout.
+        
+        Segments cannot be authenticated here, so a damaged body is only detected on decryption.
+        """
+        header = self.read_header(f)
+        if header is None:
+            raise ValueError("Not an encrypted container")
+        f.seek(len(FORMAT_MAGIC))
+        if f.read(1)[0] != FORMAT_VERSION:
+            raise ValueError(f"The container must be format version {FORMAT_VERSION}")
+        self.check_client_header(header)
+        body = f.seek(0, os.SEEK_END) - header['header_size']
+        last = body % (header['segment_size'] + TAG_SIZE)
+        if body < TAG_SIZE or 0 < last < TAG_SIZE:
+            raise ValueError("Truncated container")
+        return header
+    
+    @staticmethod
+    def segment_nonce(prefix: bytes, counter: int, final: bool) -> bytes:
+        """Derive a per-segment nonce: prefix(7) || counter(4) || final flag(1)"""
+        if counter > MAX_SEGMENTS:
+            raise ValueError("File has too many segments")
+        return prefix + struct.pack('>I', counter) + (b'\x01' if final else b'\x00')
+    
+    @staticmethod
+    def read_chunks(f, size: int) -> Iterator[bytes]:
+        """Yield fixed-size chunks from a binary file object"""
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+    
+    @staticmethod
+    def rechunk(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+        """Regroup arbitrarily sized chunks into chunks of exactly `size` bytes (last may be short)"""
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk
+            while len(buf) >= size:
+                yield bytes(buf[:size])
+                del buf[:size]
+        if buf:
+            yield bytes(buf)
+    
+    @staticmethod
+    def mark_final(segments: Iterable[bytes]) -> Iterator[tuple]:
+        """Yield (counter, segment, final) using one segment of lookahead; empty input yields one empty final segment"""
+        segments = iter(segments)
+        current = next(segments, b'')
+        counter = 0
+        for following in segments:
+            yield counter, current, False
+            current = following
+            counter += 1
+        yield counter, current, True
+    
+    def use_parallel(self, size: int) -> bool:
+        """Whether a file of `size` bytes should go through the thread pool"""
+        return self.workers > 1 and size is not None and size >= self.parallel_threshold
+    
+    def get_executor(self) -> ThreadPoolExecutor:
+        # Created on first use, once: concurrent requests must not each start a pool
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='segment')
+            return self.executor
+    
+    def ordered_map(self, fn, items: Iterable[tuple]) -> Iterator[bytes]:
+        """Run fn over batches of items on the thread pool, yielding results in input order.
+        
+        At most 2 * workers batches are in flight, which bounds memory regardless of file size.
+        """
+        executor = self.get_executor()
+        
+        def run_batch(batch):
+            return b''.join(fn(*item) for item in batch)
+        
+        window = deque()
+        try:
+            items = iter(items)
+            while True:
+                batch = list(itertools.islice(items, PARALLEL_BATCH_SEGMENTS))
+                if not batch:
+                    break
+                window.append(executor.submit(run_batch, batch))
+                if len(window) >= 2 * self.workers:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+    
+    @staticmethod
+    def metered(blocks: Iterable[bytes], operation: str) -> Iterator[bytes]:
+        """Pass blocks through, adding their size to the bytes-processed counter"""
+        total = 0
+        try:
+            for block in blocks:
+                total += len(block)
+                yield block
+        finally:
+            BYTES_PROCESSED.inc(total, operation=operation)
+    
+    @staticmethod
+    def reported(blocks: Iterable[bytes], progress) -> Iterator[bytes]:
+        """Pass blocks through, calling progress with the number of bytes passed so far"""
+        done = 0
+        for block in blocks:
+            done += len(block)
+            progress(done)
+            yield block
+    
+    @staticmethod
+    def compressor(algorithm: str):
+        """Streaming compressor for a header 'compression' value"""
+        if algorithm == 'zlib':
+            return zlib.compressobj(COMPRESSION_LEVELS['zlib'])
+        if algorithm == 'zstd' and zstandard is not None:
+            return zstandard.ZstdCompressor(level=COMPRESSION_LEVELS['zstd']).compressobj()
+        raise ValueError(f"Unsupported compression: {algorithm}")
+    
+    @staticmethod
+    def decompressor(algorithm: str):
+        """Streaming decompressor for a header 'compression' value"""
+        if algorithm == 'zlib':
+            return zlib.decompressobj()
+        if algorithm == 'zstd' and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise ValueError(f"Unsupported compression: {algorithm}")
+    
+    def iter_compress(self, blocks: Iterable[bytes], algorithm: str) -> Iterator[bytes]:
+        """Yield the compressed form of a plaintext stream"""
+        compressor = self.compressor(algorithm)
+        compress_time = StageTimer()
+        try:
+            for block in blocks:
+                data = compress_time.call(compressor.compress, block)
+                if data:
+                    yield data
+            yield compress_time.call(compressor.flush)
+        finally:
+            STAGE_SECONDS.observe(compress_time.total, stage='compress')
+    
+    def iter_decompress(self, blocks: Iterable[bytes], algorithm: str) -> Iterator[bytes]:
+        """Yield the decompressed form of authenticated segments"""
+        decompressor = self.decompressor(algorithm)
+        compress_time = StageTimer()
+        try:
+            for block in blocks:
+                data = compress_time.call(decompressor.decompress, block)
+                if data:
+                    yield data
+            yield compress_time.call(decompressor.flush)
+        finally:
+            STAGE_SECONDS.observe(compress_time.total, stage='compress')
+    
+    def probe_compression(self, blocks: Iterable[bytes], header: dict) -> Iterator[bytes]:
+        """Compress blocks as header['compression'] asks, unless the first block looks incompressible.
+        
+        Drops 'compression' from the header when skipping, so call this before packing it.
+        """
+        if header['compression'] not in COMPRESSION_ALGORITHMS:
+            raise ValueError(f"Unsupported compression: {header['compression']}")
+        blocks = iter(blocks)
+        first = next(blocks, b'')
+        sample = first[:COMPRESSION_PROBE_SIZE]
+        blocks = itertools.chain([first], blocks)
+        if len(zlib.compress(sample, 1)) > len(sample) * COMPRESSION_PROBE_RATIO:
+            del header['compression']
+            return blocks
+        return self.iter_compress(blocks, header['compression'])
+    
+    def iter_encrypt(self, chunks: Iterable[bytes], key: bytes, header: dict, parallel: bool = False) -> Iterator[bytes]:
+        """Yield the container header followed by the encrypted segments"""
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        cipher_time = StageTimer()
+        plaintext = self.metered(chunks, 'encrypt')
+        if header.get('compression'):
+            plaintext = self.probe_compression(self.rechunk(plaintext, header['segment_size']), header)
+        yield self.pack_header(header)
+        
+        def seal(counter, segment, final):
+            return cipher_time.call(aead.encrypt, self.segment_nonce(prefix, counter, final), segment, None)
+        
+        # Lookahead marks the last segment final so truncation is detectable
+        segments = self.mark_final(self.rechunk(plaintext, header['segment_size']))
+        try:
+            if parallel:
+                yield from self.ordered_map(seal, segments)
+            else:
+                for segment in segments:
+                    yield seal(*segment)
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+    
+    def iter_decrypt(self, f, key: bytes, header: dict, parallel: bool = False) -> Iterator[bytes]:
+        """Yield authenticated plaintext from a container positioned after its header"""
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        cipher_time = StageTimer()
+        
+        def open_segment(counter, segment, final):
+            return cipher_time.call(aead.decrypt, self.segment_nonce(prefix, counter, final), segment, None)
+        
+        # A truncated file fails on its last segment, which was not sealed as final
+        segments = self.mark_final(self.read_chunks(f, header['segment_size'] + TAG_SIZE))
+        try:
+            if parallel:
+                plaintext = self.ordered_map(open_segment, segments)
+            else:
+                plaintext = (open_segment(*segment) for segment in segments)
+            if header.get('compression'):
+                plaintext = self.iter_decompress(plaintext, header['compression'])
+            yield from self.metered(plaintext, 'decrypt')
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+    
+    def segment_count(self, header: dict, container_size: int) -> int:
+        """Number of segments in a container of container_size bytes (always at least one)"""
+        body = container_size - header['header_size']
+        return max(1, -(-body // (header['segment_size'] + TAG_SIZE)))
+    
+    def check_final_segment(self, f, key: bytes, header: dict):
+        """Authenticate only the last segment, catching a wrong key or truncation before any output.
+        
+        Raises InvalidTag on failure and leaves f where it was.
+        """
+        start = f.tell()
+        f.seek(0, os.SEEK_END)
+        count = self.segment_count(header, f.tell())
+        f.seek(header['header_size'] + (count - 1) * (header['segment_size'] + TAG_SIZE))
+        last = f.read()
+        f.seek(start)
+        prefix = base64.b64decode(header['nonce'])
+        self.aead(key, header).decrypt(self.segment_nonce(prefix, count - 1, True), last, None)
+    
+    def plaintext_size(self, header: dict, container_size: int) -> int:
+        """Plaintext length of a container, computed from its size without decrypting"""
+        return container_size - header['header_size'] - self.segment_count(header, container_size) * TAG_SIZE
+    
+    def iter_decrypt_range(self, f, key: bytes, header: dict, start: int, stop: int) -> Iterator[bytes]:
+        """Yield plaintext bytes [start, stop), decrypting and authenticating only the covering segments"""
+        if header.get('compression'):
+            raise ValueError("Range access is not available for compressed containers")
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        f.seek(0, os.SEEK_END)
+        count = self.segment_count(header, f.tell())
+        size = header['segment_size']
+        stride = size + TAG_SIZE
+        cipher_time = StageTimer()
+        try:
+            for index in range(start // size, (stop - 1) // size + 1):
+                f.seek(header['header_size'] + index * stride)
+                segment = cipher_time.call(aead.decrypt, self.segment_nonce(prefix, index, index == count - 1),
+                                           f.read(stride), None)
+                offset = index * size
+                block = segment[max(0, start - offset):stop - offset]
+                BYTES_PROCESSED.inc(len(block), operation='decrypt_range')
+                yield block
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+    
+    def iter_decrypt_legacy(self, f, key: bytes, nonce: bytes) -> Iterator[bytes]:
+        """Yield plaintext from a legacy salt||nonce||ciphertext file without loading it into memory.
+        
+        The single GCM tag only covers the whole file, so callers must discard the
+        output if the final chunk raises InvalidTag.
+        """
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < 28 + TAG_SIZE:  # 16 bytes salt + 12 bytes nonce + tag
+            raise ValueError("File too short to contain salt and nonce")
+        f.seek(size - TAG_SIZE)
+        tag = f.read(TAG_SIZE)
+        f.seek(28)
+        decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce, tag), backend=self.backend).decryptor()
+        remaining = size - 28 - TAG_SIZE
+        cipher_time = StageTimer()
+        try:
+            while remaining > 0:
+                chunk = f.read(min(self.segment_size, remaining))
+                remaining -= len(chunk)
+                BYTES_PROCESSED.inc(len(chunk), operation='decrypt')
+                yield cipher_time.call(decryptor.update, chunk)
+            yield cipher_time.call(decryptor.finalize)
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+    
+    def verify_segments(self, f, key: bytes, header: dict) -> dict:
+        """Authenticate every segment of a container positioned after its header, discarding the plaintext"""
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        stride = header['segment_size'] + TAG_SIZE
+        report = {'format': 'segmented', 'segments': 0, 'failed_segments': 0, 'failures': []}
+        cipher_time = StageTimer()
+        try:
+            for counter, segment, final in self.mark_final(self.read_chunks(f, stride)):
+                report['segments'] += 1
+                BYTES_PROCESSED.inc(len(segment), operation='verify')
+                try:
+                    cipher_time.call(aead.decrypt, self.segment_nonce(prefix, counter, final), segment, None)
+                    continue
+                except InvalidTag:
+                    report['failed_segments'] += 1
+                if len(report['failures']) >= MAX_REPORTED_FAILURES:
+                    continue
+                failure = {'segment': counter, 'offset': header['header_size'] + counter * stride,
+                           'length': len(segment), 'reason': 'corrupt'}
+                if final:
+                    # A last segment that only authenticates as non-final means data was cut off after it
+                    try:
+                        aead.decrypt(self.segment_nonce(prefix, counter, False), segment, None)
+                        failure['reason'] = 'truncated'
+                    except InvalidTag:
+                        pass
+                report['failures'].append(failure)
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+        
+        report['status'] = 'failed' if report['failed_segments'] else 'ok'
+        if report['failed_segments'] == report['segments']:
+            report['error'] = 'No segment authenticates: wrong password, or the whole file is damaged'
+        return report
+    
+    def verify(self, f, password: str, salt_b64: str = None, nonce_b64: str = None) -> dict:
+        """Authenticate every tag of an encrypted file in one streaming pass, without producing plaintext.
+        
+        Memory stays flat whatever the file size. Returns a report instead of raising:
+        'status' is 'ok' or 'failed', and for segmented containers 'failures' gives the
+        index, byte offset and length of each bad segment (up to MAX_REPORTED_FAILURES).
+        """
+        f.seek(0, os.SEEK_END)
+        report = {'ciphertext_bytes': f.tell()}
+        f.seek(0)
+        try:
+            header = self.read_header(f)
+            if header is not None:
+                report.update(self.verify_segments(f, self.header_key(password, header), header))
+            else:
+                report.update(format='legacy', segments=1)
+                if salt_b64 and nonce_b64:
+                    salt, nonce = base64.b64decode(salt_b64), base64.b64decode(nonce_b64)
+                else:
+                    f.seek(0)
+                    salt, nonce = f.read(16), f.read(12)
+                key = self.derive_key(password, salt)
+                for _ in self.iter_decrypt_legacy(f, key, nonce):
+                    pass
+                report['status'] = 'ok'
+        except InvalidTag:
+            # One tag covers the whole legacy file, so the damage cannot be located
+            report.update(status='failed', error='Authentication failed (wrong password or damaged file)')
+            ERRORS.inc(type='auth_tag')
+        except ValueError as e:
+            report.update(status='failed', error=str(e))
+            ERRORS.inc(type='invalid_input')
+        else:
+            if report['status'] != 'ok':
+                ERRORS.inc(type='auth_tag')
+        return report
+    
+    def encrypt_file(self, input_path: str, output_path: str, password: str, compression: str = None,
+                     batch: dict = None, progress=None) -> dict:
+        """Encrypt file using segmented AES-GCM (with a `new_batch()` result, under a batch subkey).
+        
+        progress, if given, is called with the number of input bytes read so far.
+        """
+        with open(input_path, 'rb') as src:
+            chunks = self.read_chunks(src, self.segment_size)
+            if progress is not None:
+                chunks = self.reported(chunks, progress)
+            return self.encrypt_stream(chunks, output_path, password,
+                                       os.path.basename(input_path), os.path.getsize(input_path),
+                                       batch=batch, compression=compression)
+    
+    def encrypt_stream(self, chunks: Iterable[bytes], output_path: str, password: str,
+                       input_name: str = None, size_hint: int = None, batch: dict = None,
+                       compression: str = None) -> dict:
+        """Encrypt plaintext chunks (e.g. straight from a request body) into output_path.
+        
+        size_hint is the expected plaintext size, used to pick the parallel engine.
+        Pass a `new_batch()` result to reuse its master key instead of running the KDF.
+        compression ('zlib' or 'zstd') is applied unless the data turns out to be incompressible.
+        """
+        try:
+            # Generate salt and nonce prefix
+            header = self.new_header()
+            
+            if batch is not None:
+                # Per-file subkey from the batch master key (no KDF run per file)
+                header, key = self.new_batch_header(batch)
+            else:
+                # Derive key
+                key = self.header_key(password, header)
+            if compression:
+                header['compression'] = compression
+            
+            # Stream segments to output
+            write_time = StageTimer()
+            with open(output_path, 'wb') as dst:
+                for block in self.iter_encrypt(chunks, key, header, self.use_parallel(size_hint)):
+                    write_time.call(dst.write, block)
+            STAGE_SECONDS.observe(write_time.total, stage='write')
+            
+            # Return metadata
+            return self.describe(header, password, input_name, os.path.basename(output_path))
+        except Exception as e:
+            self.log(f"Encryption error: {e}")
+            ERRORS.inc(type=error_type(e))
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise e
+    
+    def describe(self, header: dict, password: str, input_name: str, output_name: str) -> dict:
+        """Metadata for a container (served as <output>.meta); without a password for one encrypted in the browser"""
+        metadata = {
+            'input_file': input_name,
+            'output_file': output_name,
+            'salt': header['salt'],
+            'nonce': header['nonce'],
+            'cipher': header['cipher'],
+            'kdf': self.header_kdf(header),
+            'format_version': FORMAT_VERSION,
+            'segment_size': header['segment_size']
+        }
+        if password is None:
+            metadata['client_encrypted'] = True
+        else:
+            metadata['password'] = password  # Store password in metadata
+        if 'subkey_salt' in header:
+            metadata['subkey_salt'] = header['subkey_salt']
+        if 'compression' in header:
+            metadata['compression'] = header['compression']
+        return metadata
+    
+    def sealed_size(self, header: dict, size: int) -> int:
+        """Ciphertext length of `size` plaintext bytes sealed from a segment boundary (always at least one segment)"""
+        return size + max(1, -(-size // header['segment_size'])) * TAG_SIZE
+    
+    def opened_size(self, header: dict, size: int) -> int:
+        """Plaintext length of `size` sealed bytes from a segment boundary, or None if no segments seal to that length"""
+        plain = size - max(1, -(-size // (header['segment_size'] + TAG_SIZE))) * TAG_SIZE
+        return plain if plain >= 0 and self.sealed_size(header, plain) == size else None
+    
+    def chunk_offset(self, header: dict, chunk_size: int, index: int) -> int:
+        """Container offset of upload chunk `index` (chunk_size is a multiple of the segment size)"""
+        return header['header_size'] + self.sealed_size(header, chunk_size) * index
+    
+    def encrypt_chunk(self, chunks: Iterable[bytes], key: bytes, header: dict, first_segment: int, last: bool) -> bytes:
+        """Seal one chunk of a resumable upload as its data arrives.
+        
+        Segments are numbered from first_segment and, for the last chunk, the final one
+        is sealed final. The result is returned rather than written, so an interrupted
+        chunk leaves nothing behind that a retry would seal again under the same nonces.
+        """
+        aead = self.aead(key, header)
+        prefix = base64.b64decode(header['nonce'])
+        segments = self.rechunk(self.metered(chunks, 'encrypt'), header['segment_size'])
+        if last:
+            segments = self.mark_final(segments)
+        else:
+            segments = ((counter, segment, False) for counter, segment in enumerate(segments))
+        sealed = bytearray()
+        cipher_time = StageTimer()
+        try:
+            for counter, segment, final in segments:
+                sealed += cipher_time.call(aead.encrypt, self.segment_nonce(prefix, first_segment + counter, final),
+                                           segment, None)
+        finally:
+            STAGE_SECONDS.observe(cipher_time.total, stage='cipher')
+        return bytes(sealed)
+    
+    def open_plaintext(self, src, password: str, salt_b64: str = None, nonce_b64: str = None,
+                       preflight: bool = False) -> tuple:
+        """Return (plaintext blocks, plaintext size or None if compressed) for a segmented container or legacy file.
+        
+        With preflight, a wrong password or damaged file raises here rather than part-way
+        through the output: a container's last segment is authenticated up front, and a legacy
+        file (one tag over the whole file) gets a full authentication pass first.
+        """
+        src.seek(0, os.SEEK_END)
+        container_size = src.tell()
+        src.seek(0)
+        header = self.read_header(src)
+        if header is not None:
+            # Salt and nonce prefix always come from the container header
+            self.log(f"Container v{FORMAT_VERSION} - Segment size: {header['segment_size']} bytes")
+            key = self.header_key(password, header)
+            if preflight:
+                self.check_final_segment(src, key, header)
+            size = None if header.get('compression') else self.plaintext_size(header, container_size)
+            return self.iter_decrypt(src, key, header, self.use_parallel(container_size)), size
+        
+        if salt_b64 and nonce_b64:
+            # Use provided salt and nonce from metadata
+            salt = base64.b64decode(salt_b64)
+            nonce = base64.b64decode(nonce_b64)
+        else:
+            # Extract salt and nonce from file (manual method)
+            salt = src.read(16)
+            nonce = src.read(12)
+        self.log(f"Legacy format - Salt and nonce from {'metadata' if salt_b64 and nonce_b64 else 'file'}")
+        key = self.derive_key(password, salt)
+        if preflight:
+            for _ in self.iter_decrypt_legacy(src, key, nonce):
+                pass
+        return self.iter_decrypt_legacy(src, key, nonce), max(0, container_size - 28 - TAG_SIZE)
+    
+    def decrypt_file(self, input_path: str, output_path: str, password: str, salt_b64: str = None, nonce_b64: str = None,
+                     progress=None) -> bool:
+        """Decrypt a segmented container, or a legacy salt||nonce||ciphertext file.
+        
+        progress, if given, is called with the number of input bytes read so far.
+        """
+        try:
+            with open(input_path, 'rb') as src:
+                plaintext, _ = self.open_plaintext(src, password, salt_b64, nonce_b64)
+                
+                # Write decrypted file
+                write_time = StageTimer()
+                with open(output_path, 'wb') as dst:
+                    for block in plaintext:
+                        write_time.call(dst.write, block)
+                        if progress is not None:
+                            progress(src.tell())
+                STAGE_SECONDS.observe(write_time.total, stage='write')
+            
+            return True
+        except KDFBusy:
+            ERRORS.inc(type='kdf_busy')
+            raise
+        except Exception as e:
+            self.log(f"Decryption error: {e!r}")
+            ERRORS.inc(type=error_type(e))
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return False
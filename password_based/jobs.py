@@ -0,0 +1,242 @@
+"""SQLite-backed queue of background encryption jobs, kept in the artifact catalog's database.
+
+An /encrypt or /decrypt request with async=true only stores its upload and returns 202;
+a few worker threads in each server process claim queued jobs, do the work and publish
+the output to the catalog.
+
+A job's parameters hold the user's key or password, so they are stored sealed
+(credentials.py) and erased from the row as soon as a worker claims the job. Queued
+jobs survive a restart that keeps CREDENTIAL_SECRET; a running job whose worker stopped
+reporting (its process died) cannot be run again without them and is failed.
+"""
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from cryptography.exceptions import InvalidTag
+
+from catalog import Catalog
+from credentials import CredentialBox
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        params BLOB,  -- sealed JSON, erased once claimed
+        size INTEGER NOT NULL,
+        progress INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        owner TEXT,
+        created REAL NOT NULL,
+        updated REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)',
+)
+
+JOB_PREFIX = '.job-'
+
+
+class JobQueueFull(Exception):
+    """Raised by submit() when max_queued jobs are already waiting"""
+
+
+class JobQueue:
+    def __init__(self, catalog: Catalog, credentials: CredentialBox, workers: int = 2, max_queued: int = 100,
+                 ttl: float = 24 * 3600, stale_after: float = 300, poll_interval: float = 1.0,
+                 progress_interval: float = 1.0, expire_interval: float = 60):
+        self.catalog = catalog
+        self.credentials = credentials
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.expire_interval = expire_interval
+        self.last_expired = 0.0
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        conn = self.catalog.connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def path(self, job_id: str, suffix: str) -> str:
+        """A job's working file: 'in' (the stored upload) or 'out' (output being written); hidden from the backfill"""
+        return self.catalog.path(f'{JOB_PREFIX}{job_id}.{suffix}')
+
+    def counts(self) -> dict:
+        """Jobs per status"""
+        rows = self.catalog.connect().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        return {status: count for status, count in rows}
+
+    def full(self) -> bool:
+        return self.counts().get('queued', 0) >= self.max_queued
+
+    def submit(self, kind: str, params: dict, input_path: str, owner: str = None) -> dict:
+        """Queue a job for the upload stored at input_path (moved into the job's 'in' file)"""
+        job_id = secrets.token_hex(16)
+        now = time.time()
+        with self.catalog.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise JobQueueFull(f"{queued} jobs are already queued, please retry later")
+            conn.execute('INSERT INTO jobs (id, kind, status, params, size, owner, created, updated) '
+                         "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                         (job_id, kind, self.credentials.seal(json.dumps(params).encode('utf-8'), self.context(job_id)),
+                          os.path.getsize(input_path), owner, now, now))
+            os.replace(input_path, self.path(job_id, 'in'))
+        self.wakeup.set()
+        return self.get(job_id)
+
+    @staticmethod
+    def context(job_id: str) -> str:
+        return f'job:{job_id}'
+
+    def get(self, job_id: str) -> dict:
+        """Look up a job, or None. Parameters (which may hold credentials) are not included."""
+        row = self.catalog.connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        del record['params']
+        record['result'] = json.loads(record['result']) if record['result'] else None
+        return record
+
+    def claim(self) -> dict:
+        """Take the oldest queued job (with its parameters) and mark it running, or return None.
+
+        The parameters are erased from the row as they are handed out. Running jobs not
+        updated for stale_after seconds were interrupted; without their parameters they
+        cannot be run again, so they are failed.
+        """
+        now = time.time()
+        with self.catalog.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("UPDATE jobs SET status = 'failed', params = NULL, updated = ?, "
+                         "error = 'Interrupted while running, please submit it again' "
+                         "WHERE status = 'running' AND updated < ?", (now, now - self.stale_after))
+            for row in conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created").fetchall():
+                try:
+                    params = json.loads(self.credentials.open(row['params'], self.context(row['id'])))
+                except InvalidTag:
+                    # Sealed under another server secret (CREDENTIAL_SECRET changed or was regenerated)
+                    conn.execute("UPDATE jobs SET status = 'failed', params = NULL, updated = ?, "
+                                 "error = 'Queued before a server restart, please submit it again' WHERE id = ?",
+                                 (now, row['id']))
+                    continue
+                conn.execute("UPDATE jobs SET status = 'running', params = NULL, attempts = attempts + 1, "
+                             "updated = ? WHERE id = ?", (now, row['id']))
+                return dict(row, params=params)
+        return None
+
+    def report(self, job_id: str, progress: int):
+        """Record bytes processed so far"""
+        with self.catalog.connect() as conn:
+            conn.execute('UPDATE jobs SET progress = ?, updated = ? WHERE id = ?', (progress, time.time(), job_id))
+
+    def touch(self, job_id: str):
+        """Mark a running job as alive, so it is not taken for interrupted"""
+        with self.catalog.connect() as conn:
+            conn.execute("UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    @contextmanager
+    def heartbeat(self, job_id: str):
+        """Touch a claimed job every stale_after / 3 seconds while the block runs.
+
+        Progress reports alone would not do: a job can spend long without any (waiting for
+        a busy KDF pool, a memory-hard derivation, hashing content before sealing it).
+        """
+        done = threading.Event()
+
+        def beat():
+            while not done.wait(self.stale_after / 3):
+                try:
+                    self.touch(job_id)
+                except Exception as e:
+                    print(f"Job {job_id} heartbeat failed: {e!r}")
+
+        thread = threading.Thread(target=beat, name='job-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def finish(self, job_id: str, result: dict = None, error: str = None):
+        """Mark a job done (with its result) or failed, erase its parameters and remove its working files"""
+        with self.catalog.connect() as conn:
+            conn.execute('UPDATE jobs SET status = ?, params = NULL, result = ?, error = ?, '
+                         'progress = CASE WHEN ? THEN size ELSE progress END, updated = ? WHERE id = ?',
+                         ('failed' if error else 'done', json.dumps(result) if result else None, error,
+                          error is None, time.time(), job_id))
+        for suffix in ('in', 'out'):
+            try:
+                os.remove(self.path(job_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def run(self, handler):
+        """Worker loop: claim jobs and run handler(job, progress) until stop() is called.
+
+        handler returns the job's result dict; an exception fails the job with its message.
+        progress(n) records n bytes done, at most once per progress_interval seconds.
+        """
+        while not self.stopping.is_set():
+            self.maybe_expire()
+            job = self.claim()
+            if job is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+            last_reported = [time.monotonic()]
+
+            def progress(done: int, job_id=job['id']):
+                if time.monotonic() - last_reported[0] >= self.progress_interval:
+                    last_reported[0] = time.monotonic()
+                    self.report(job_id, done)
+
+            try:
+                with self.heartbeat(job['id']):
+                    result = handler(job, progress)
+            except Exception as e:
+                print(f"Job {job['id']} failed: {e!r}")
+                self.finish(job['id'], error=str(e) or type(e).__name__)
+            else:
+                self.finish(job['id'], result)
+
+    def start(self, handler):
+        """Start the worker threads (daemons: a job cut short by shutdown is resumed after a restart)"""
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.run, args=(handler,), name='job-worker', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join()
+
+    def expire(self, ttl: float) -> int:
+        """Delete finished jobs last updated more than ttl seconds ago"""
+        with self.catalog.connect() as conn:
+            return conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                                (time.time() - ttl,)).rowcount
+
+    def maybe_expire(self):
+        """Apply the TTL, at most once per expire_interval seconds"""
+        if not self.ttl or time.time() - self.last_expired < self.expire_interval:
+            return
+        self.last_expired = time.time()
+        self.expire(self.ttl)
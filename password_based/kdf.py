@@ -0,0 +1,165 @@
+"""Password key derivation functions, named with their parameters in each container header.
+
+PBKDF2 is always available. scrypt and Argon2id are memory-hard, which makes guessing
+on GPUs and ASICs expensive; Argon2id needs a cryptography release that provides it.
+calibrate_kdf() picks parameters that make one derivation take about a target time on
+the current machine, so the cost follows the hardware instead of a constant in the code.
+This module is all the KDF pool's worker processes import.
+"""
+import time
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+try:
+    from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+except ImportError:  # optional: added in cryptography 44
+    Argon2id = None
+
+KEY_LENGTH = 32
+
+# Strongest first
+KDFS = ('argon2id', 'scrypt', 'pbkdf2-sha256') if Argon2id else ('scrypt', 'pbkdf2-sha256')
+
+# Files written before the KDF was configurable: PBKDF2 at a fixed cost
+LEGACY_KDF = {'name': 'pbkdf2-sha256', 'iterations': 100000}
+
+# Calibration never goes below these
+MINIMUM_KDF_PARAMS = {
+    'pbkdf2-sha256': LEGACY_KDF,
+    'scrypt': {'name': 'scrypt', 'n': 2 ** 14, 'r': 8, 'p': 1},
+    'argon2id': {'name': 'argon2id', 'memory_kib': 19 * 1024, 'iterations': 2, 'lanes': 1},
+}
+
+# Absolute upper bounds for parameters read from headers, per KDF. kdf_limits() sets the
+# tighter, host-specific bounds a server actually enforces.
+MAX_KDF_MEMORY = 1024 * 1024 * 1024
+MAX_KDF_PARAMS = {
+    'pbkdf2-sha256': {'iterations': 10000000},
+    'scrypt': {'n': 2 ** 20, 'r': 32, 'p': 64},
+    'argon2id': {'memory_kib': MAX_KDF_MEMORY // 1024, 'iterations': 64, 'lanes': 16},
+}
+INTEGER_PARAMS = {
+    'pbkdf2-sha256': ('iterations',),
+    'scrypt': ('n', 'r', 'p'),
+    'argon2id': ('memory_kib', 'iterations', 'lanes'),
+}
+
+# What calibration scales: memory first for memory-hard KDFs, then the time cost
+MEMORY_PARAM = {'scrypt': 'n', 'argon2id': 'memory_kib'}
+TIME_PARAM = {'pbkdf2-sha256': 'iterations', 'scrypt': 'p', 'argon2id': 'iterations'}
+
+
+def kdf_memory(params: dict) -> int:
+    """Bytes one derivation allocates (0 for PBKDF2)"""
+    if params['name'] == 'scrypt':
+        return 128 * params['r'] * (params['n'] + params['p'])
+    if params['name'] == 'argon2id':
+        return params['memory_kib'] * 1024
+    return 0
+
+
+def kdf_work(params: dict) -> int:
+    """Relative running time of one derivation: comparable between parameters of the same KDF only"""
+    if params['name'] == 'scrypt':
+        return params['n'] * params['r'] * params['p']
+    if params['name'] == 'argon2id':
+        return params['memory_kib'] * params['iterations']
+    return params['iterations']
+
+
+def check_kdf_params(params: dict, limits: dict = None):
+    """Reject unknown KDFs and out-of-range parameters with ValueError.
+
+    limits (from kdf_limits) also rejects parameters costing more memory or time than
+    this host allows, before anything is derived.
+    """
+    name = params.get('name') if isinstance(params, dict) else None
+    if name not in INTEGER_PARAMS:
+        raise ValueError(f"Unsupported KDF: {name}")
+    if name not in KDFS:
+        raise ValueError(f"{name} is not available (it needs a newer cryptography release)")
+    for field in INTEGER_PARAMS[name]:
+        value = params.get(field)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1 \
+                or value > MAX_KDF_PARAMS[name][field]:
+            raise ValueError(f"Invalid {name} parameter {field}: {value!r}")
+    if kdf_memory(params) > MAX_KDF_MEMORY:
+        raise ValueError(f"{name} memory cost exceeds {MAX_KDF_MEMORY // (1024 * 1024)} MB")
+    if limits is None:
+        return
+    max_memory, max_work = limits[name]
+    if kdf_memory(params) > max_memory:
+        raise ValueError(f"{name} memory cost exceeds this server's {max_memory // (1024 * 1024)} MB limit")
+    if kdf_work(params) > max_work:
+        raise ValueError(f"{name} parameters cost more than this server's key derivation time limit")
+
+
+def run_kdf(password: bytes, salt: bytes, params: dict) -> bytes:
+    """Derive a key with the KDF and parameters in `params`"""
+    name = params['name']
+    if name == 'pbkdf2-sha256':
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=KEY_LENGTH, salt=salt, iterations=params['iterations'])
+    elif name == 'scrypt':
+        kdf = Scrypt(salt=salt, length=KEY_LENGTH, n=params['n'], r=params['r'], p=params['p'])
+    elif name == 'argon2id' and Argon2id is not None:
+        kdf = Argon2id(salt=salt, length=KEY_LENGTH, iterations=params['iterations'], lanes=params['lanes'],
+                       memory_cost=params['memory_kib'])
+    else:
+        raise ValueError(f"Unsupported KDF: {name}")
+    return kdf.derive(password)
+
+
+def kdf_worker(password: bytes, salt: bytes, params: dict) -> tuple:
+    """Run a KDF in a pool process; returns (key, start time) so queue wait can be measured"""
+    started = time.time()
+    return run_kdf(password, salt, params), started
+
+
+def time_kdf(params: dict) -> float:
+    """Seconds one derivation takes here"""
+    start = time.perf_counter()
+    run_kdf(b'calibration', b'\0' * 16, params)
+    return time.perf_counter() - start
+
+
+def calibrate_kdf(name: str, target: float, max_memory: int) -> dict:
+    """Parameters for `name` that take about `target` seconds per derivation on this machine.
+
+    Memory-hard KDFs double their memory cost (up to max_memory bytes) while a derivation
+    takes under half the target, then the time cost is scaled up to fill the rest.
+    A target of 0 returns the minimum parameters.
+    """
+    params = dict(MINIMUM_KDF_PARAMS[name])
+    if target <= 0:
+        return params
+    elapsed = time_kdf(params)
+    field = MEMORY_PARAM.get(name)
+    while field and elapsed < target / 2:
+        larger = dict(params, **{field: params[field] * 2})
+        if kdf_memory(larger) > max_memory:
+            break
+        params, elapsed = larger, time_kdf(larger)
+    field = TIME_PARAM[name]
+    if elapsed < target:
+        params[field] = min(MAX_KDF_PARAMS[name][field], max(params[field], round(params[field] * target / elapsed)))
+    return params
+
+
+def kdf_limits(target: float, max_memory: int, factor: float, required: tuple = ()) -> dict:
+    """Per-KDF (max memory, max work) accepted from headers: name -> tuple.
+
+    Memory is capped at max_memory, the most calibration may use, and work at `factor`
+    times what takes `target` seconds here, timed from each KDF's minimum parameters
+    (a target of 0 allows `factor` times the minimum). Parameters in `required`, such as
+    the server's own, are always within the limits.
+    """
+    limits = {}
+    for name in KDFS:
+        minimum = MINIMUM_KDF_PARAMS[name]
+        scale = max(1.0, target / time_kdf(minimum)) if target > 0 else 1.0
+        limits[name] = (max(max_memory, kdf_memory(minimum)), round(kdf_work(minimum) * scale * factor))
+    for params in required:
+        memory, work = limits[params['name']]
+        limits[params['name']] = (max(memory, kdf_memory(params)), max(work, kdf_work(params)))
+    return limits
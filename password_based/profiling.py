@@ -0,0 +1,159 @@
+"""Opt-in per-request profiling, dumped to a size-capped profiles directory.
+
+A request is profiled when it carries the admin token or is picked by the sampling rate.
+Dumps are cProfile stats (.prof, for pstats or snakeviz) or collapsed stacks from a stack
+sampler (.folded, for flamegraph.pl or speedscope). One profile runs at a time per
+process; other requests are not profiled meanwhile. When disabled, the cost per request
+is a header lookup and a comparison.
+"""
+import cProfile
+import hmac
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+FORMATS = {'pstats': '.prof', 'collapsed': '.folded'}
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    """Counts the stacks of one thread every `interval` seconds (collapsed-stack output)"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            thread_id = self.thread_id
+            frame = sys._current_frames().get(thread_id) if thread_id is not None else None
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        self.thread_id = threading.get_ident()
+
+    def disable(self):
+        self.thread_id = None
+
+    def dump(self, path: str):
+        self.stopped.set()
+        self.thread.join()
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class Profiler:
+    def __init__(self, directory: str, max_bytes: int = 100 * 1024 * 1024, sample_rate: float = 0,
+                 token: str = None, output_format: str = 'pstats', interval: float = 0.005):
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown profile format {output_format!r} (expected one of {', '.join(FORMATS)})")
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+        self.token = token or None
+        self.output_format = output_format
+        self.interval = interval
+        self.enabled = bool(self.token or self.sample_rate > 0)
+        self.busy = threading.Lock()
+
+    def authorized(self, token: str) -> bool:
+        """Whether `token` is the admin token (always False without one)"""
+        return bool(self.token and token and hmac.compare_digest(token.encode(), self.token.encode()))
+
+    def wanted(self, token: str = None) -> bool:
+        """Whether to profile a request sending `token`: an admin request, or one picked by the sampling rate"""
+        return self.authorized(token) or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def start(self, wait: float = 0):
+        """A new, not yet enabled profile, or None if another one is still running here after `wait` seconds"""
+        if not (self.busy.acquire(timeout=wait) if wait else self.busy.acquire(blocking=False)):
+            return None
+        try:
+            profile = cProfile.Profile() if self.output_format == 'pstats' else StackSampler(self.interval)
+        except Exception:
+            self.busy.release()
+            raise
+        profile.started = time.perf_counter()
+        return profile
+
+    def finish(self, profile, label: str) -> str:
+        """Dump a finished profile, apply the size cap and return the dump's name"""
+        try:
+            profile.disable()
+            elapsed_ms = round((time.perf_counter() - profile.started) * 1000)
+            name = (f"{time.strftime('%Y%m%dT%H%M%S')}-{label}-{elapsed_ms}ms-{os.getpid()}-"
+                    f"{secrets.token_hex(3)}{FORMATS[self.output_format]}")
+            os.makedirs(self.directory, exist_ok=True)
+            partial = os.path.join(self.directory, f'.{name}.part')
+            if isinstance(profile, cProfile.Profile):
+                profile.dump_stats(partial)
+            else:
+                profile.dump(partial)
+            os.replace(partial, os.path.join(self.directory, name))
+        finally:
+            self.busy.release()
+        self.rotate()
+        return name
+
+    @contextmanager
+    def profiling(self, label: str, wait: float = 10):
+        """Profile the enclosed block (e.g. a background job), waiting up to `wait` seconds for a running profile"""
+        profile = self.start(wait)
+        if profile is None:
+            yield None
+            return
+        profile.enable()
+        try:
+            yield profile
+        finally:
+            name = self.finish(profile, label)
+            print(f"Profile written: {name}")
+
+    def list(self) -> list:
+        """Dumps, newest first, as {name, size, created}"""
+        try:
+            entries = [entry for entry in os.scandir(self.directory)
+                       if entry.is_file() and not entry.name.startswith('.')]
+        except FileNotFoundError:
+            return []
+        dumps = [{'name': entry.name, 'size': entry.stat().st_size, 'created': entry.stat().st_mtime}
+                 for entry in entries]
+        return sorted(dumps, key=lambda dump: dump['created'], reverse=True)
+
+    def path(self, name: str) -> str:
+        """Path of the dump called `name`, or None if there is none"""
+        if name != os.path.basename(name) or name.startswith('.'):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def rotate(self):
+        """Delete the oldest dumps while the directory holds more than max_bytes (the newest is kept)"""
+        dumps = self.list()
+        total = sum(dump['size'] for dump in dumps)
+        while len(dumps) > 1 and total > self.max_bytes:
+            oldest = dumps.pop()
+            try:
+                os.remove(os.path.join(self.directory, oldest['name']))
+            except FileNotFoundError:
+                pass
+            total -= oldest['size']
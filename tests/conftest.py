@@ -0,0 +1,53 @@
+"""Shared setup: import each app's modules in isolation (both apps use the same module names)."""
+import importlib
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS = ('key_based', 'password_based')
+MODULES = ('encryptor', 'catalog', 'dedup', 'kdf')
+
+# Nothing is benchmarked or calibrated at import, and the KDF runs inline
+os.environ.update(CIPHER_SUITE='aes-256-gcm', KDF_TARGET_MS='0', KDF_POOL_WORKERS='0')
+for name in ('METRICS_DIR', 'KDF_CALIBRATION'):
+    os.environ.pop(name, None)
+
+loaded = {}
+
+
+def load_app(name: str) -> types.SimpleNamespace:
+    """The modules of one app directory, as attributes (only those the app has)"""
+    if name not in loaded:
+        app_dirs = tuple(os.path.join(ROOT, app) + os.sep for app in APPS)
+        for module_name, module in list(sys.modules.items()):
+            if (getattr(module, '__file__', None) or '').startswith(app_dirs):
+                del sys.modules[module_name]
+        sys.path.insert(0, os.path.join(ROOT, name))
+        try:
+            modules = {module: importlib.import_module(module) for module in MODULES
+                       if os.path.exists(os.path.join(ROOT, name, module + '.py'))}
+        finally:
+            sys.path.pop(0)
+        loaded[name] = types.SimpleNamespace(name=name, **modules)
+    return loaded[name]
+
+
+@pytest.fixture(scope='session')
+def key_based():
+    return load_app('key_based')
+
+
+@pytest.fixture(scope='session')
+def password_based():
+    return load_app('password_based')
+
+
+@pytest.fixture(params=APPS)
+def app(request):
+    """Each app in turn, with a secret its encrypt_file/decrypt_file accept (a hex key or a password)"""
+    modules = load_app(request.param)
+    secret = os.urandom(32).hex() if request.param == 'key_based' else 'correct horse battery staple'
+    return types.SimpleNamespace(modules=modules, encryptor=modules.encryptor, secret=secret)
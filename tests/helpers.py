@@ -0,0 +1,43 @@
+"""Encrypting and tampering with containers in tests, for either app (see the `app` fixture)."""
+import io
+
+SEGMENT_SIZE = 1024
+
+
+def new_encryptor(app, **options):
+    if app.modules.name == 'password_based':
+        options.setdefault('key_cache', app.encryptor.DerivedKeyCache())
+    return app.encryptor.FileEncryptor(segment_size=SEGMENT_SIZE, log=lambda message: None, **options)
+
+
+def encrypt(app, tmp_path, data: bytes, **options) -> tuple:
+    """(encryptor, container bytes) for data"""
+    encryptor = new_encryptor(app, **options)
+    (tmp_path / 'plain').write_bytes(data)
+    encryptor.encrypt_file(str(tmp_path / 'plain'), str(tmp_path / 'sealed'), app.secret)
+    return encryptor, (tmp_path / 'sealed').read_bytes()
+
+
+def decrypt(app, encryptor, tmp_path, container: bytes):
+    """The plaintext, or None if decryption failed (which must leave no output behind)"""
+    (tmp_path / 'sealed').write_bytes(container)
+    output = tmp_path / 'opened'
+    if not encryptor.decrypt_file(str(tmp_path / 'sealed'), str(output), app.secret):
+        assert not output.exists()
+        return None
+    return output.read_bytes()
+
+
+def file_key(app, encryptor, header: dict) -> bytes:
+    """The key that seals a container's segments"""
+    if app.modules.name == 'key_based':
+        return encryptor.data_key(encryptor.parse_key(app.secret), header)
+    return encryptor.header_key(app.secret, header)
+
+
+def split(app, encryptor, container: bytes) -> tuple:
+    """(header bytes, [sealed segments]) of a container"""
+    header = encryptor.read_header(io.BytesIO(container))
+    stride = header['segment_size'] + app.encryptor.TAG_SIZE
+    body = container[header['header_size']:]
+    return container[:header['header_size']], [body[i:i + stride] for i in range(0, len(body), stride)]
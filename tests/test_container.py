@@ -0,0 +1,100 @@
+"""Segmented container format: round trips, tampering and the version check, for both apps."""
+import io
+
+import pytest
+
+from helpers import SEGMENT_SIZE, decrypt, encrypt, file_key, new_encryptor, split
+
+
+@pytest.mark.parametrize('size', [0, 1, SEGMENT_SIZE, SEGMENT_SIZE + 1, 3 * SEGMENT_SIZE])
+@pytest.mark.parametrize('parallel', [False, True])
+def test_round_trip(app, tmp_path, size, parallel):
+    data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    options = {'parallel_threshold': 0, 'workers': 2} if parallel else {}
+    encryptor, container = encrypt(app, tmp_path, data, **options)
+    _, segments = split(app, encryptor, container)
+    assert len(segments) == max(1, -(-size // SEGMENT_SIZE))
+    assert decrypt(app, encryptor, tmp_path, container) == data
+
+
+def test_round_trip_compressed(app, tmp_path):
+    data = b'compressible ' * 1000
+    encryptor = new_encryptor(app)
+    (tmp_path / 'plain').write_bytes(data)
+    metadata = encryptor.encrypt_file(str(tmp_path / 'plain'), str(tmp_path / 'sealed'), app.secret,
+                                      compression='zlib')
+    assert metadata['compression'] == 'zlib'
+    assert decrypt(app, encryptor, tmp_path, (tmp_path / 'sealed').read_bytes()) == data
+
+
+def test_wrong_secret_rejected(app, tmp_path):
+    encryptor, container = encrypt(app, tmp_path, b'x' * 3000)
+    app.secret = app.secret[::-1]
+    assert decrypt(app, encryptor, tmp_path, container) is None
+
+
+@pytest.mark.parametrize('tamper', [
+    pytest.param(lambda segments: segments[:-1], id='last segment dropped'),
+    pytest.param(lambda segments: segments[:1] + segments[2:], id='middle segment dropped'),
+    pytest.param(lambda segments: [segments[1], segments[0]] + segments[2:], id='reordered'),
+    pytest.param(lambda segments: segments + segments[-1:], id='segment repeated'),
+    pytest.param(lambda segments: segments[:-1] + [segments[-1][:-1]], id='truncated mid-segment'),
+    pytest.param(lambda segments: segments[:-1] + [segments[-1][:1] + bytes([segments[-1][1] ^ 1]) + segments[-1][2:]],
+                 id='bit flipped'),
+])
+def test_tampered_segments_rejected(app, tmp_path, tamper):
+    encryptor, container = encrypt(app, tmp_path, bytes(3 * SEGMENT_SIZE + 100))
+    head, segments = split(app, encryptor, container)
+    assert len(segments) == 4
+    assert decrypt(app, encryptor, tmp_path, head + b''.join(tamper(segments))) is None
+
+
+def test_stripped_final_flag_rejected(app, tmp_path):
+    """Segments that all authenticate, but none sealed final, are a truncated file"""
+    data = bytes(2 * SEGMENT_SIZE)
+    encryptor, container = encrypt(app, tmp_path, data)
+    head, _ = split(app, encryptor, container)
+    header = encryptor.read_header(io.BytesIO(container))
+    key = file_key(app, encryptor, header)
+    unfinished = encryptor.encrypt_chunk([data], key, header, 0, last=False)
+    assert decrypt(app, encryptor, tmp_path, head + unfinished) is None
+    assert decrypt(app, encryptor, tmp_path, head + encryptor.encrypt_chunk([data], key, header, 0, last=True)) == data
+
+
+def test_unknown_version_refused(app, tmp_path):
+    encryptor, container = encrypt(app, tmp_path, b'data')
+    magic = app.encryptor.FORMAT_MAGIC
+    for version in (1, app.encryptor.FORMAT_VERSION + 1):
+        changed = magic + bytes([version]) + container[len(magic) + 1:]
+        with pytest.raises(ValueError, match='Unsupported container version'):
+            encryptor.read_header(io.BytesIO(changed))
+        assert decrypt(app, encryptor, tmp_path, changed) is None
+
+
+def test_truncated_header_refused(app, tmp_path):
+    encryptor, container = encrypt(app, tmp_path, b'data')
+    head, _ = split(app, encryptor, container)
+    for length in (len(app.encryptor.FORMAT_MAGIC) + 2, len(head) - 1):
+        with pytest.raises(ValueError, match='Truncated container header'):
+            encryptor.read_header(io.BytesIO(container[:length]))
+
+
+def test_unknown_header_field_refused(app, tmp_path):
+    encryptor, container = encrypt(app, tmp_path, b'data')
+    _, segments = split(app, encryptor, container)
+    header = encryptor.read_header(io.BytesIO(container))
+    del header['header_size']
+    header['future_field'] = 1
+    with pytest.raises(ValueError, match='fields this version cannot read'):
+        encryptor.read_header(io.BytesIO(encryptor.pack_header(header) + b''.join(segments)))
+
+
+def test_range_decrypts_covering_segments(app, tmp_path):
+    data = bytes(range(256)) * 16
+    encryptor, container = encrypt(app, tmp_path, data)
+    f = io.BytesIO(container)
+    header = encryptor.read_header(f)
+    key = file_key(app, encryptor, header)
+    assert encryptor.plaintext_size(header, len(container)) == len(data)
+    for start, stop in ((0, 1), (1000, 1030), (SEGMENT_SIZE, 2 * SEGMENT_SIZE), (4000, len(data))):
+        assert b''.join(encryptor.iter_decrypt_range(f, key, header, start, stop)) == data[start:stop]
@@ -0,0 +1,80 @@
+"""Deduplicated objects: names are hard links, and the link count is the reference count (key_based)."""
+import os
+
+import pytest
+
+
+@pytest.fixture
+def store(key_based, tmp_path):
+    catalog = key_based.catalog.Catalog(str(tmp_path / 'catalog.db'), str(tmp_path / 'uploads'))
+    return key_based.dedup.DedupStore(catalog, collect_interval=3600)
+
+
+def publish(store, content_id: str, name: str, data: bytes = b'sealed container') -> bool:
+    """Publish a name for content_id the way /encrypt does; True if it linked an existing object"""
+    partial = store.catalog.path(f'.partial-{name}')
+    linked = store.link(content_id, partial)
+    if not linked:
+        with open(partial, 'wb') as f:
+            f.write(data)
+        store.store(content_id, partial)
+    store.catalog.publish(partial, name, 'encrypted')
+    return linked
+
+
+def write_partial(store, text: str) -> str:
+    """A finished output not yet published"""
+    path = store.catalog.path(f'.partial-{text.replace(" ", "-")}')
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def test_identical_content_stored_once(store):
+    assert not publish(store, 'c1', 'a.enc')
+    assert publish(store, 'c1', 'b.enc')
+    assert publish(store, 'c1', 'c.enc')
+    inodes = {os.stat(store.catalog.path(name)).st_ino for name in ('a.enc', 'b.enc', 'c.enc')}
+    assert inodes == {os.stat(store.path('c1')).st_ino}
+    assert store.refs('c1') == 3
+    assert store.usage() == (len(b'sealed container'), 1)
+
+
+def test_refcounts_after_delete(store):
+    for name in ('a.enc', 'b.enc', 'c.enc'):
+        publish(store, 'c1', name)
+    publish(store, 'c2', 'd.enc', b'other')
+    # Republishing a name drops its old link
+    store.catalog.publish(write_partial(store, 'replacement'), 'b.enc', 'encrypted')
+    assert store.refs('c1') == 2
+    # Eviction removes names oldest first: a.enc, c.enc, d.enc go, b.enc (republished last) stays
+    assert store.catalog.evict(max_bytes=len(b'replacement')) == ['a.enc', 'c.enc', 'd.enc']
+    assert store.refs('c1') == 0 and store.refs('c2') == 0
+    assert sorted(store.collect()) == ['c1', 'c2']
+    assert store.usage() == (0, 0)
+    assert os.listdir(store.catalog.path('.objects')) == []
+    assert open(store.catalog.path('b.enc'), 'rb').read() == b'replacement'
+
+
+def test_collect_keeps_referenced_objects(store):
+    publish(store, 'c1', 'a.enc')
+    publish(store, 'c1', 'b.enc')
+    os.remove(store.catalog.path('a.enc'))
+    assert store.collect() == [] and store.refs('c1') == 1
+    # A new upload of the same content still links the surviving object
+    assert publish(store, 'c1', 'c.enc') and store.refs('c1') == 2
+
+
+def test_lost_object_file_is_replaced(store):
+    publish(store, 'c1', 'a.enc')
+    os.remove(store.path('c1'))
+    assert not publish(store, 'c1', 'b.enc', b'again')
+    assert store.refs('c1') == 1 and store.usage()[1] == 1
+
+
+def test_store_race_links_to_the_first_object(store):
+    first, second = (write_partial(store, f'copy {i}') for i in range(2))
+    assert store.store('c1', first) is True
+    assert store.store('c1', second) is False
+    assert os.stat(first).st_ino == os.stat(second).st_ino == os.stat(store.path('c1')).st_ino
+
@@ -0,0 +1,90 @@
+"""Bounds on KDF parameters read from container headers (password_based)."""
+import io
+import json
+
+import pytest
+
+
+@pytest.fixture
+def kdf(password_based):
+    return password_based.kdf
+
+
+def test_minimum_parameters_accepted(kdf):
+    for name in kdf.KDFS:
+        kdf.check_kdf_params(kdf.MINIMUM_KDF_PARAMS[name])
+    kdf.check_kdf_params(dict(kdf.LEGACY_KDF, **kdf.MAX_KDF_PARAMS['pbkdf2-sha256']))
+
+
+@pytest.mark.parametrize('params', [
+    None,
+    'pbkdf2-sha256',
+    {},
+    {'name': 'bcrypt', 'rounds': 12},
+    {'name': 'pbkdf2-sha256'},
+    {'name': 'pbkdf2-sha256', 'iterations': 0},
+    {'name': 'pbkdf2-sha256', 'iterations': -1},
+    {'name': 'pbkdf2-sha256', 'iterations': True},
+    {'name': 'pbkdf2-sha256', 'iterations': 100000.0},
+    {'name': 'pbkdf2-sha256', 'iterations': '100000'},
+    {'name': 'pbkdf2-sha256', 'iterations': 10000001},
+    {'name': 'scrypt', 'n': 2 ** 21, 'r': 8, 'p': 1},
+    {'name': 'scrypt', 'n': 2 ** 14, 'r': 8},
+    # Each parameter within range, but together over MAX_KDF_MEMORY
+    {'name': 'scrypt', 'n': 2 ** 20, 'r': 16, 'p': 1},
+])
+def test_invalid_parameters_rejected(kdf, params):
+    with pytest.raises(ValueError):
+        kdf.check_kdf_params(params)
+
+
+def test_argon2id_bounds(kdf):
+    if 'argon2id' not in kdf.KDFS:
+        with pytest.raises(ValueError, match='not available'):
+            kdf.check_kdf_params(kdf.MINIMUM_KDF_PARAMS['argon2id'])
+        return
+    minimum = kdf.MINIMUM_KDF_PARAMS['argon2id']
+    for field, value in (('memory_kib', kdf.MAX_KDF_MEMORY // 1024 + 1), ('iterations', 65), ('lanes', 0)):
+        with pytest.raises(ValueError, match=field):
+            kdf.check_kdf_params(dict(minimum, **{field: value}))
+
+
+def test_host_limits(kdf):
+    own = dict(kdf.MINIMUM_KDF_PARAMS['scrypt'], p=2)
+    limits = kdf.kdf_limits(0, 32 * 1024 * 1024, 4, (own,))
+    kdf.check_kdf_params(own, limits)
+    kdf.check_kdf_params(dict(kdf.LEGACY_KDF, iterations=4 * kdf.LEGACY_KDF['iterations']), limits)
+    with pytest.raises(ValueError, match='time limit'):
+        kdf.check_kdf_params(dict(kdf.LEGACY_KDF, iterations=4 * kdf.LEGACY_KDF['iterations'] + 1), limits)
+    with pytest.raises(ValueError, match='memory cost exceeds'):
+        kdf.check_kdf_params(dict(own, n=2 ** 16), limits)
+
+
+def test_costly_header_refused_before_deriving(password_based, tmp_path):
+    """A header asking for more than this host allows fails without running the KDF"""
+    module = password_based.encryptor
+    limits = password_based.kdf.kdf_limits(0, 32 * 1024 * 1024, 2, (module.LEGACY_KDF,))
+    encryptor = module.FileEncryptor(segment_size=1024, kdf_limits=limits, log=lambda message: None)
+    (tmp_path / 'plain').write_bytes(b'data')
+    encryptor.encrypt_file(str(tmp_path / 'plain'), str(tmp_path / 'sealed'), 'secret')
+    container = (tmp_path / 'sealed').read_bytes()
+    header = encryptor.read_header(io.BytesIO(container))
+    body = container[header.pop('header_size'):]
+    header['kdf'] = {'name': 'pbkdf2-sha256', 'iterations': 10000000}
+    (tmp_path / 'sealed').write_bytes(encryptor.pack_header(header) + body)
+    calls = []
+    encryptor.run_kdf = lambda *args: calls.append(args)
+    assert not encryptor.decrypt_file(str(tmp_path / 'sealed'), str(tmp_path / 'opened'), 'secret')
+    assert calls == []
+
+
+def test_calibration_from_environment(password_based):
+    """KDF_CALIBRATION (set by gunicorn.conf.py) replaces calibrating in every worker"""
+    module = password_based.encryptor
+    params = dict(module.LEGACY_KDF, iterations=200000)
+    limits = {'pbkdf2-sha256': (0, 400000), 'scrypt': (1024, 2048)}
+    calibration = json.dumps({'kdf': params, 'limits': limits})
+    assert module.select_kdf(calibration=calibration) == params
+    assert module.select_kdf_limits(params, calibration=calibration) == {name: tuple(limit) for name, limit in limits.items()}
+    with pytest.raises(ValueError):
+        module.select_kdf(calibration=json.dumps({'kdf': {'name': 'pbkdf2-sha256', 'iterations': 0}, 'limits': limits}))
@@ -0,0 +1,83 @@
+"""Files written before the segmented container still decrypt."""
+import base64
+import os
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+DATA = os.urandom(100000)
+
+
+def decrypt(encryptor, tmp_path, sealed: bytes, *args):
+    (tmp_path / 'sealed').write_bytes(sealed)
+    if not encryptor.decrypt_file(str(tmp_path / 'sealed'), str(tmp_path / 'opened'), *args):
+        return None
+    return (tmp_path / 'opened').read_bytes()
+
+
+def pbkdf2(password: str, salt: bytes, iterations: int = 100000) -> bytes:
+    return PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=iterations).derive(password.encode())
+
+
+@pytest.fixture
+def key_encryptor(key_based):
+    return key_based.encryptor.FileEncryptor(segment_size=4096, log=lambda message: None)
+
+
+@pytest.fixture
+def password_encryptor(password_based):
+    return password_based.encryptor.FileEncryptor(segment_size=4096, log=lambda message: None)
+
+
+def test_key_based_nonce_ciphertext(key_encryptor, tmp_path):
+    key, nonce = os.urandom(32), os.urandom(12)
+    sealed = nonce + AESGCM(key).encrypt(nonce, DATA, None)
+    assert decrypt(key_encryptor, tmp_path, sealed, key.hex()) == DATA
+    assert decrypt(key_encryptor, tmp_path, sealed, base64.b64encode(key).decode()) == DATA
+
+
+def test_key_based_nonce_from_metadata(key_encryptor, tmp_path):
+    key, nonce = os.urandom(32), os.urandom(12)
+    sealed = bytes(12) + AESGCM(key).encrypt(nonce, DATA, None)
+    assert decrypt(key_encryptor, tmp_path, sealed, key.hex()) is None
+    assert decrypt(key_encryptor, tmp_path, sealed, key.hex(), base64.b64encode(nonce).decode()) == DATA
+
+
+def test_key_based_legacy_tampering_rejected(key_encryptor, tmp_path):
+    key, nonce = os.urandom(32), os.urandom(12)
+    sealed = bytearray(nonce + AESGCM(key).encrypt(nonce, DATA, None))
+    sealed[5000] ^= 1
+    assert decrypt(key_encryptor, tmp_path, bytes(sealed), key.hex()) is None
+    assert not (tmp_path / 'opened').exists()
+    assert decrypt(key_encryptor, tmp_path, bytes(sealed[:-1]), key.hex()) is None
+
+
+def test_password_based_salt_nonce_ciphertext(password_encryptor, tmp_path):
+    salt, nonce = os.urandom(16), os.urandom(12)
+    sealed = salt + nonce + AESGCM(pbkdf2('secret', salt)).encrypt(nonce, DATA, None)
+    assert decrypt(password_encryptor, tmp_path, sealed, 'secret') == DATA
+    assert decrypt(password_encryptor, tmp_path, sealed, 'wrong') is None
+
+
+def test_password_based_salt_nonce_from_metadata(password_encryptor, tmp_path):
+    salt, nonce = os.urandom(16), os.urandom(12)
+    sealed = bytes(28) + AESGCM(pbkdf2('secret', salt)).encrypt(nonce, DATA, None)
+    assert decrypt(password_encryptor, tmp_path, sealed, 'secret', base64.b64encode(salt).decode(),
+                   base64.b64encode(nonce).decode()) == DATA
+
+
+def test_password_based_version_2_iterations_header(password_based, password_encryptor, tmp_path):
+    """Version 2 containers name their PBKDF2 cost in "iterations" instead of "kdf\""""
+    module = password_based.encryptor
+    salt, prefix = os.urandom(16), os.urandom(module.NONCE_PREFIX_SIZE)
+    header = {'segment_size': 4096, 'salt': base64.b64encode(salt).decode(),
+              'nonce': base64.b64encode(prefix).decode(), 'iterations': 100000}
+    head = password_encryptor.pack_header(header)
+    head = head[:len(module.FORMAT_MAGIC)] + bytes([2]) + head[len(module.FORMAT_MAGIC) + 1:]
+    aead = AESGCM(pbkdf2('secret', salt))
+    segments = [DATA[i:i + 4096] for i in range(0, len(DATA), 4096)]
+    body = b''.join(aead.encrypt(password_encryptor.segment_nonce(prefix, counter, counter == len(segments) - 1),
+                                 segment, None) for counter, segment in enumerate(segments))
+    assert decrypt(password_encryptor, tmp_path, head + body, 'secret') == DATA
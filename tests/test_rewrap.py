@@ -0,0 +1,67 @@
+"""Key rotation of envelope containers: only the wrapped data key in the header changes (key_based)."""
+import os
+import shutil
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+DATA = os.urandom(3 * 4096 + 7)
+
+
+@pytest.fixture
+def encryptor(key_based):
+    return key_based.encryptor.FileEncryptor(segment_size=4096, envelope=True, log=lambda message: None)
+
+
+def seal(encryptor, tmp_path, key: bytes) -> str:
+    (tmp_path / 'plain').write_bytes(DATA)
+    encryptor.encrypt_file(str(tmp_path / 'plain'), str(tmp_path / 'sealed'), key.hex())
+    return str(tmp_path / 'sealed')
+
+
+def opens(encryptor, tmp_path, path: str, key: bytes) -> bool:
+    output = str(tmp_path / 'opened')
+    return encryptor.decrypt_file(path, output, key.hex()) and open(output, 'rb').read() == DATA
+
+
+def test_rewrap_then_decrypt_under_new_key(encryptor, tmp_path):
+    old_key, new_key = os.urandom(32), os.urandom(32)
+    path = seal(encryptor, tmp_path, old_key)
+    before = open(path, 'rb').read()
+    with open(path, 'r+b') as f:
+        encryptor.rewrap(f, old_key, new_key)
+    after = open(path, 'rb').read()
+    assert opens(encryptor, tmp_path, path, new_key)
+    assert not opens(encryptor, tmp_path, path, old_key)
+    # Same size and segments: only the header was rewritten
+    header = encryptor.read_header(open(path, 'rb'))
+    assert len(after) == len(before) and after[header['header_size']:] == before[header['header_size']:]
+    assert after[:header['header_size']] != before[:header['header_size']]
+
+
+def test_rewrap_twice(encryptor, tmp_path):
+    keys = [os.urandom(32) for _ in range(3)]
+    path = seal(encryptor, tmp_path, keys[0])
+    for old_key, new_key in zip(keys, keys[1:]):
+        with open(path, 'r+b') as f:
+            encryptor.rewrap(f, old_key, new_key)
+    assert opens(encryptor, tmp_path, path, keys[2])
+
+
+def test_rewrap_with_wrong_old_key_leaves_file_alone(encryptor, tmp_path):
+    key = os.urandom(32)
+    path = seal(encryptor, tmp_path, key)
+    before = open(path, 'rb').read()
+    with open(path, 'r+b') as f, pytest.raises(InvalidTag):
+        encryptor.rewrap(f, os.urandom(32), os.urandom(32))
+    assert open(path, 'rb').read() == before
+
+
+def test_rewrap_refuses_direct_containers(key_based, encryptor, tmp_path):
+    key = os.urandom(32)
+    direct = key_based.encryptor.FileEncryptor(segment_size=4096, envelope=False, log=lambda message: None)
+    path = seal(direct, tmp_path, key)
+    shutil.copy(path, tmp_path / 'copy')
+    with open(tmp_path / 'copy', 'r+b') as f, pytest.raises(ValueError, match='Only envelope-encrypted'):
+        encryptor.rewrap(f, key, os.urandom(32))
+    assert opens(encryptor, tmp_path, path, key)
@@ -0,0 +1,84 @@
+"""Resumable uploads: chunks sealed separately, at fixed offsets, form one container (both apps)."""
+import pytest
+
+from helpers import SEGMENT_SIZE, decrypt, file_key, new_encryptor
+
+CHUNK_SIZE = 4 * SEGMENT_SIZE
+
+
+def new_upload(app) -> tuple:
+    """(encryptor, header, key, packed header) the way POST /uploads sets them up"""
+    encryptor = new_encryptor(app)
+    if app.modules.name == 'key_based':
+        header = encryptor.new_header(encryptor.parse_key(app.secret))
+    else:
+        header = encryptor.new_header()
+    head = encryptor.pack_header(header)
+    header['header_size'] = len(head)
+    return encryptor, header, file_key(app, encryptor, header), head
+
+
+def seal_chunks(encryptor, header: dict, key: bytes, data: bytes, order) -> dict:
+    """Seal data chunk by chunk in the given order, as PUT /uploads/<id>/chunks/<index> does: offset -> sealed"""
+    count = max(1, -(-len(data) // CHUNK_SIZE))
+    sealed = {}
+    for index in order(range(count)):
+        chunk = data[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+        # Small request-body blocks, which encrypt_chunk regroups into segments
+        blocks = [chunk[i:i + 1000] for i in range(0, len(chunk), 1000)]
+        sealed[encryptor.chunk_offset(header, CHUNK_SIZE, index)] = encryptor.encrypt_chunk(
+            blocks, key, header, index * (CHUNK_SIZE // SEGMENT_SIZE), index == count - 1)
+    return sealed
+
+
+def assemble(head: bytes, sealed: dict) -> bytes:
+    container = bytearray(head)
+    for offset, chunk in sorted(sealed.items()):
+        assert offset == len(container)
+        container += chunk
+    return bytes(container)
+
+
+def test_chunk_offset(app):
+    encryptor, header, _, head = new_upload(app)
+    assert encryptor.chunk_offset(header, CHUNK_SIZE, 0) == len(head)
+    assert encryptor.chunk_offset(header, CHUNK_SIZE, 3) == len(head) + 3 * (CHUNK_SIZE + 4 * app.encryptor.TAG_SIZE)
+
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK_SIZE, CHUNK_SIZE + 1, 3 * CHUNK_SIZE - 5])
+@pytest.mark.parametrize('order', [lambda indexes: indexes, lambda indexes: reversed(indexes)], ids=['in order', 'reversed'])
+def test_chunks_form_one_container(app, tmp_path, size, order):
+    encryptor, header, key, head = new_upload(app)
+    data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    container = assemble(head, seal_chunks(encryptor, header, key, data, order))
+    assert len(container) == len(head) + encryptor.sealed_size(header, size)
+    assert decrypt(app, encryptor, tmp_path, container) == data
+
+
+def test_sealed_and_opened_sizes(app):
+    encryptor, header, _, _ = new_upload(app)
+    for size in (0, 1, SEGMENT_SIZE, SEGMENT_SIZE + 1, CHUNK_SIZE):
+        assert encryptor.opened_size(header, encryptor.sealed_size(header, size)) == size
+    # Lengths no plaintext seals to
+    assert encryptor.opened_size(header, app.encryptor.TAG_SIZE - 1) is None
+    assert encryptor.opened_size(header, SEGMENT_SIZE + app.encryptor.TAG_SIZE + 1) is None
+
+
+def test_chunk_sealed_under_wrong_segment_numbers_rejected(app, tmp_path):
+    encryptor, header, key, head = new_upload(app)
+    data = bytes(2 * CHUNK_SIZE)
+    sealed = seal_chunks(encryptor, header, key, data, lambda indexes: indexes)
+    # The second chunk numbered from 0, as if it were the first
+    second = encryptor.chunk_offset(header, CHUNK_SIZE, 1)
+    sealed[second] = encryptor.encrypt_chunk([data[CHUNK_SIZE:]], key, header, 0, True)
+    assert decrypt(app, encryptor, tmp_path, assemble(head, sealed)) is None
+
+
+def test_last_chunk_missing_or_unfinished_rejected(app, tmp_path):
+    encryptor, header, key, head = new_upload(app)
+    data = bytes(2 * CHUNK_SIZE + 10)
+    sealed = seal_chunks(encryptor, header, key, data, lambda indexes: indexes)
+    last = encryptor.chunk_offset(header, CHUNK_SIZE, 2)
+    assert decrypt(app, encryptor, tmp_path, assemble(head, {k: v for k, v in sealed.items() if k != last})) is None
+    sealed[last] = encryptor.encrypt_chunk([data[2 * CHUNK_SIZE:]], key, header, 2 * CHUNK_SIZE // SEGMENT_SIZE, False)
+    assert decrypt(app, encryptor, tmp_path, assemble(head, sealed)) is None